@@ -1,9 +1,24 @@
 import argparse
+import os
+import yaml
+
+# Polars sizes its thread pool when it is first imported, so apply
+# resources.max_threads before anything imports it
+if os.path.exists('config.yaml'):
+    with open('config.yaml') as f:
+        _max_threads = (yaml.safe_load(f).get('resources') or {}).get('max_threads')
+    if _max_threads:
+        os.environ.setdefault("POLARS_MAX_THREADS", str(_max_threads))
+
+import polars as pl
+from concurrent.futures import ThreadPoolExecutor
 from src.pipeline.step_01_define_cohort import define_cohort
 from src.pipeline.step_02_build_subject_info import build_subject_info
 # Import the new Stage 3 scripts
 from src.pipeline.step_03a_extract_events import extract_events
+from src.pipeline.step_03a_extract_drug_events import extract_drug_events
 from src.pipeline.step_03b_sort_events import sort_events
+from src.pipeline.step_03ab_extract_sorted_events import extract_sorted_events
 from src.pipeline.step_03c_process_events import map_and_save_events
 from src.pipeline.step_04a_profile_measurements import profile_measurements
 from src.pipeline.step_05a_clean_events import clean_events
@@ -11,13 +26,38 @@ from src.utils.create_rules_template import create_rules_template
 from src.utils.debug_icd10_mapping import debug_mapping
 from src.utils.debug_csv import debug_csv
 from src.utils.analyse_mappings import analyze_coverage
+from src.utils.timeline import get_timeline, TIMELINE_STAGES
+from src.pipeline.debug_patient_trajectory import debug_trajectories
+
+
+def run_extraction(config_path: str):
+    """
+    Runs observation and drug issue extraction at the same time. Polars releases
+    the GIL while it works, so threads are enough to overlap the two scans.
+
+    No later stage reads the drug events yet, so this only runs for --stage 3a-all.
+    """
+    with ThreadPoolExecutor(max_workers=2) as pool:
+        futures = [pool.submit(extract_events, config_path), pool.submit(extract_drug_events, config_path)]
+        for future in futures:
+            future.result()
+
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Run the data processing pipeline.")
     parser.add_argument(
-        "--stage", type=str, required=True, choices=['1', '2', '3', '3a', '3b', '3c', '4', '5', 'debug'],
+        "--stage", type=str, required=True, choices=['1', '2', '3', '3a', '3a-all', '3a-obs', '3a-drugs', '3ab', '3b', '3c', '4', '5', 'debug', 'timeline', 'trajectories'],
         help="Which pipeline stage to run."
     )
+    parser.add_argument(
+        "--subjects", type=str,
+        help="For --stage timeline: comma-separated subject IDs, or a file with one subject ID per line. "
+             "For --stage trajectories: a file of subject IDs (one per line, or a CSV with a subject_id column)."
+    )
+    parser.add_argument(
+        "--timeline-stage", type=str, default="cleaned", choices=TIMELINE_STAGES,
+        help="For --stage timeline: which stage's events to show."
+    )
     args = parser.parse_args()
 
     if args.stage == '1':
@@ -25,13 +65,18 @@ if __name__ == "__main__":
     elif args.stage == '2':
         build_subject_info('config.yaml')
     elif args.stage == '3':
-        # Run all parts of stage 3 followed by 5 in order
-        extract_events('config.yaml')
-        sort_events('config.yaml')
+        # Run all parts of stage 3 followed by 5 in order, extracting and sorting in one pass
+        extract_sorted_events('config.yaml')
         map_and_save_events('config.yaml')
         clean_events('config.yaml')
-    elif args.stage == '3a':
+    elif args.stage in ('3a', '3a-obs'):
         extract_events('config.yaml')
+    elif args.stage == '3a-all':
+        run_extraction('config.yaml')
+    elif args.stage == '3a-drugs':
+        extract_drug_events('config.yaml')
+    elif args.stage == '3ab':
+        extract_sorted_events('config.yaml')
     elif args.stage == '3b':
         sort_events('config.yaml')
     elif args.stage == '3c':
@@ -45,4 +90,19 @@ if __name__ == "__main__":
         # debug_mapping('config.yaml')
         # debug_csv('config.yaml')
         analyze_coverage('config.yaml')
-        
\ No newline at end of file
+    elif args.stage == 'timeline':
+        if not args.subjects:
+            parser.error("--stage timeline needs --subjects")
+        if os.path.isfile(args.subjects):
+            with open(args.subjects) as f:
+                subject_ids = [int(line) for line in f if line.strip()]
+        else:
+            subject_ids = [int(s) for s in args.subjects.split(",") if s.strip()]
+        timeline_df = get_timeline(subject_ids, stage=args.timeline_stage, config_path='config.yaml')
+        with pl.Config(tbl_rows=-1, tbl_cols=-1, fmt_str_lengths=80):
+            print(timeline_df)
+        
+    elif args.stage == 'trajectories':
+        if not args.subjects:
+            parser.error("--stage trajectories needs --subjects")
+        debug_trajectories('config.yaml', args.subjects)
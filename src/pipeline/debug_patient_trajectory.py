@@ -1,7 +1,10 @@
 import polars as pl
 import yaml
-import glob
-import os
+
+from src.utils.ingest_cache import scan_raw_dir
+from src.utils.cohort_filter import cohort_filter_expr
+from src.utils.dates import decode_dates_expr, date_failure_exprs
+from src.utils.trajectory import add_trajectory_window, in_trajectory_window
 
 def debug_patient_trajectory(config_path: str, patient_id: int):
     """
@@ -37,33 +40,23 @@ def debug_patient_trajectory(config_path: str, patient_id: int):
 
     # --- 2. Load ALL Events for This Patient ---
     print("\nStep 2: Loading all raw events for this patient...")
-    DATE_FORMAT = "%d/%m/%Y"
-    observation_files = glob.glob(os.path.join(PATHS['observation_data_dir'], "*.txt"))
-    
-    observation_dtypes = {
-        "e_patid": pl.Int64,
-        "obsdate": pl.String,
-        "medcodeid": pl.String,
-    }
+    observation_columns = ["e_patid", "obsdate", "medcodeid"]
 
     patient_events_lf = pl.concat(
         [
-            pl.scan_csv(
-                f, 
-                separator="\t", 
-                has_header=True,
-                schema_overrides=observation_dtypes # Enforce types for the columns we read
-            )
-            .filter(pl.col('e_patid') == patient_id)
-            .select(observation_dtypes.keys()) # Only select the columns we need
-            for f in observation_files
+            lf.filter(pl.col('e_patid') == patient_id)
+            .select(observation_columns) # Only select the columns we need
+            for lf in scan_raw_dir(PATHS['observation_data_dir'], PATHS.get('ingest_cache_dir'))
         ],
         how="vertical"
     ).with_columns(
-        time=pl.col("obsdate").str.to_date(DATE_FORMAT, strict=False)
+        time=decode_dates_expr("obsdate")
     )
     
-    patient_events_df = patient_events_lf.collect().drop_nulls('time')
+    patient_events_df = patient_events_lf.collect()
+    n_undated = patient_events_df.select(**date_failure_exprs('obsdate', 'time')).row(0, named=True)
+    print(f"  - Events with missing obsdate: {n_undated['missing_dates']}, unparseable obsdate: {n_undated['unparseable_dates']}")
+    patient_events_df = patient_events_df.drop_nulls('time')
     
     if patient_events_df.is_empty():
         print("No observation events found for this patient.")
@@ -82,16 +75,9 @@ def debug_patient_trajectory(config_path: str, patient_id: int):
         .with_columns(cancerdate=pl.col("cancerdate").str.to_datetime().cast(pl.Date))
 
     # Join context and apply window functions
-    calculated_df = patient_events_df.lazy().join(subjects_lf, on="e_patid", how="inner") \
-        .with_columns(last_event_date=pl.max("time").over("e_patid")) \
-        .with_columns(
-            end_date=pl.when(pl.col("is_case") == 1)
-                       .then(pl.col("cancerdate"))
-                       .otherwise(pl.col("last_event_date").dt.offset_by("-1y")),
-            start_date=pl.when(pl.col("is_case") == 1)
-                        .then(pl.col("cancerdate").dt.offset_by("-5y"))
-                        .otherwise(pl.col("last_event_date").dt.offset_by("-6y"))
-        ).collect()
+    calculated_df = add_trajectory_window(
+        patient_events_df.lazy().join(subjects_lf, on="e_patid", how="inner"), id_col="e_patid"
+    ).collect()
 
     if calculated_df.is_empty():
         print("Could not calculate trajectory window. The join might have failed.")
@@ -106,9 +92,7 @@ def debug_patient_trajectory(config_path: str, patient_id: int):
     print(f"Calculated End Date for filtering:   {final_end_date}")
 
     # --- 5. Show Final Filtered Trajectory ---
-    final_trajectory = calculated_df.filter(
-        pl.col("time").is_between(pl.col("start_date"), pl.col("end_date"))
-    )
+    final_trajectory = calculated_df.filter(in_trajectory_window())
     
     if not final_trajectory.is_empty():
         final_min_date = final_trajectory.get_column('time').min()
@@ -123,6 +107,93 @@ def debug_patient_trajectory(config_path: str, patient_id: int):
     print("--------------------------")
 
 
+def read_subject_ids(ids_file: str) -> pl.Series:
+    """Reads subject IDs from a CSV with a subject_id column, or a plain file with one ID per line."""
+    with open(ids_file) as f:
+        first_line = f.readline().strip()
+    if first_line.split(",")[0] == "subject_id":
+        ids = pl.read_csv(ids_file)["subject_id"]
+    else:
+        ids = pl.read_csv(ids_file, has_header=False, new_columns=["subject_id"])["subject_id"]
+    return ids.cast(pl.Int64).drop_nulls().unique().sort()
+
+
+def debug_trajectories(config_path: str, ids_file: str, output_path: str = None) -> pl.DataFrame:
+    """
+    Batch version of debug_patient_trajectory: audits the trajectory window of
+    every subject in `ids_file` with one pass over the raw observation files.
+
+    Writes one row per subject with its first and last observation dates,
+    computed window, and how many events fall inside it, to `output_path`
+    (default outputs.trajectory_diagnostics_file).
+    """
+    print("--- Batch Trajectory Diagnostics ---")
+
+    # --- 1. Load Configuration and Subject Info ---
+    print("Step 1: Loading subject IDs and subject information...")
+    with open(config_path, 'r') as f:
+        config = yaml.safe_load(f)
+    cancer_type = config['study_params']['cancer_type']
+    PATHS = {key: val.format(cancer_type=cancer_type) for key, val in config.get('paths', {}).items()}
+    OUTPUTS = {key: val.format(cancer_type=cancer_type) for key, val in config.get('outputs', {}).items()}
+    output_path = output_path or OUTPUTS['trajectory_diagnostics_file']
+
+    subject_ids = read_subject_ids(ids_file)
+    subject_info = pl.read_csv(OUTPUTS['subject_information_file']) \
+        .with_columns(pl.col('subject_id').cast(pl.Int64)) \
+        .filter(pl.col('subject_id').is_in(subject_ids))
+    print(f"  - {subject_ids.len()} subject IDs, {subject_info.height} found in subject_information.csv")
+
+    # --- 2. One Pass Over the Raw Observations of All Subjects ---
+    print("Step 2: Scanning raw observation events for all subjects...")
+    subjects_lf = subject_info.lazy().rename({"subject_id": "e_patid"}) \
+        .select("e_patid", "is_case", cancerdate=pl.col("cancerdate").str.to_datetime().cast(pl.Date))
+    events_lf = pl.concat(
+        [
+            lf.select("e_patid", "obsdate")
+            for lf in scan_raw_dir(PATHS['observation_data_dir'], PATHS.get('ingest_cache_dir'))
+            if "e_patid" in lf.collect_schema().names()
+        ],
+        how="vertical",
+    ).filter(cohort_filter_expr(subject_info["subject_id"])) \
+        .with_columns(time=decode_dates_expr("obsdate"))
+
+    # --- 3. Apply the Same Trajectory Logic to Every Subject ---
+    print("Step 3: Applying trajectory window logic...")
+    undated_lf = events_lf.group_by("e_patid").agg(**date_failure_exprs('obsdate', 'time'))
+    windowed_lf = add_trajectory_window(
+        events_lf.drop_nulls("time").join(subjects_lf, on="e_patid", how="inner"), id_col="e_patid"
+    )
+    summary_lf = windowed_lf.group_by("e_patid").agg(
+        n_events=pl.len(),
+        first_event_date=pl.col("time").min(),
+        last_event_date=pl.col("time").max(),
+        start_date=pl.col("start_date").first(),
+        end_date=pl.col("end_date").first(),
+        n_kept=in_trajectory_window().sum(),
+        first_kept_date=pl.col("time").filter(in_trajectory_window()).min(),
+        last_kept_date=pl.col("time").filter(in_trajectory_window()).max(),
+    )
+    undated_df, summary_df = pl.collect_all([undated_lf, summary_lf])
+
+    # Subjects without any dated observation still get a row
+    diagnostics_df = subjects_lf.collect() \
+        .join(summary_df, on="e_patid", how="left") \
+        .join(undated_df, on="e_patid", how="left") \
+        .rename({"e_patid": "subject_id"}) \
+        .with_columns(pl.col("n_events", "n_kept", "missing_dates", "unparseable_dates").fill_null(0)) \
+        .sort("subject_id")
+
+    # --- 4. Report and Save ---
+    n_missing_subjects = subject_ids.len() - subject_info.height
+    print(f"  - Subjects not in subject_information.csv: {n_missing_subjects}")
+    print(f"  - Subjects without dated observations:     {diagnostics_df.filter(pl.col('n_events') == 0).height}")
+    print(f"  - Subjects with no events kept:            {diagnostics_df.filter(pl.col('n_kept') == 0).height}")
+    diagnostics_df.write_csv(output_path)
+    print(f"Per-subject trajectory diagnostics saved to: {output_path}")
+    return diagnostics_df
+
+
 if __name__ == '__main__':
     # --- EDIT THIS LINE ---
     PATIENT_TO_DEBUG = 362864450976 
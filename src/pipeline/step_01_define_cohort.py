@@ -1,15 +1,56 @@
 # src/pipeline/step_01_define_cohort.py
 
 import pandas as pd
+import polars as pl
 import numpy as np
 import yaml
-import glob
 from pathlib import Path
 
+from src.utils.ingest_cache import scan_raw_dir
+from src.utils.matching import band_join, sample_controls
+from src.utils.stata_loader import load_stata
+from src.utils.subject_log import SubjectLog
+
+def _identify_cases(mode: str, cancer_type: str, STUDY_PARAMS: dict, available_patients: pd.DataFrame,
+                    predefined_cases: pd.DataFrame = None, cancer_df: pd.DataFrame = None) -> pd.DataFrame:
+    """Returns the cases for one cancer type with the columns needed for matching."""
+    if mode == 'predefined':
+        # Filter for the specific cancer and ensure it's in our available patient pool
+        cases_predefined = predefined_cases[predefined_cases[cancer_type] == 1].rename(columns={'epatid': 'subject_id'})
+        cases_predefined['subject_id'] = cases_predefined['subject_id'].astype('int64')
+        
+        # Join with available_patients. This creates 'gender_x' (from this file) and 'gender_y' (from patient files)
+        cases_predefined = pd.merge(cases_predefined, available_patients, on='subject_id', how='inner')
+
+        # Derive year of birth (yob)
+        # Add the specific format for dates like '20feb2014' to remove the warning
+        cases_predefined['cancerdate_dt'] = pd.to_datetime(cases_predefined['cancerdate'], format='%d%b%Y')
+        cases_predefined['yob'] = (cases_predefined['cancerdate_dt'].dt.year - cases_predefined['ageatindex']).astype(int)
+        
+        # --- FIX: Use the correct column 'gender_x' and assign to a new 'gender' column ---
+        cases_predefined['gender'] = np.where(cases_predefined['gender_x'] == 'male', 1, 2)
+        
+        # Create the final 'cases' DataFrame with the required columns for matching
+        return cases_predefined[['subject_id', 'e_pracid', 'gender', 'yob']].copy()
+
+    # 'discovery' mode (your previous logic)
+    cases_with_site = cancer_df[
+        (cancer_df['site'] == cancer_type) &
+        (cancer_df['cancerdate'] >= pd.to_datetime(STUDY_PARAMS['start_date']))
+    ].rename(columns={'epatid': 'subject_id'})
+    cases_with_site['subject_id'] = cases_with_site['subject_id'].astype('int64')
+    return pd.merge(cases_with_site[['subject_id']], available_patients, on='subject_id', how='inner')
+
+
 def define_cohort(config_path: str):
     """
     Defines the study cohort by either discovering cases from a registry
     or loading a predefined set of cases, then matching controls.
+
+    If study_params.cancer_types lists several cancers, the patient files and
+    the cancer registry are loaded once and every study's cohort is defined from
+    that shared pool, in the listed order. Subjects taken by an earlier study
+    are not available to later ones, exactly as with separate runs.
     """
     # --- 1. Load Configuration ---
     print("Step 1: Loading configuration...")
@@ -17,106 +58,94 @@ def define_cohort(config_path: str):
         config = yaml.safe_load(f)
 
     STUDY_PARAMS = config['study_params']
-    cancer_type = STUDY_PARAMS['cancer_type']
-    PATHS = {key: val.format(cancer_type=cancer_type) for key, val in config['paths'].items()}
-    OUTPUTS = {key: val.format(cancer_type=cancer_type) for key, val in config['outputs'].items()}
-    
-    Path(OUTPUTS['output_dir']).mkdir(parents=True, exist_ok=True)
+    cancer_types = STUDY_PARAMS.get('cancer_types') or [STUDY_PARAMS['cancer_type']]
+    PATHS = {key: val.format(cancer_type=cancer_types[0]) for key, val in config['paths'].items()}
 
     # --- 2. Handle Master Subject Log ---
     print("Step 2: Loading master subject log...")
-    master_log_path = Path(PATHS['master_subject_log'])
-    try:
-        master_log = pd.read_csv(master_log_path)
-    except FileNotFoundError:
-        master_log = pd.DataFrame({'subject_id': []})
-        master_log.to_csv(master_log_path, index=False)
-
-    # --- 3. Load All Available Patients ---
+    subject_log = SubjectLog(PATHS['master_subject_log'], legacy_csv=PATHS.get('legacy_master_subject_log'))
+    print(f"Master log currently tracks {len(subject_log)} subjects.")
+
+    # --- 3. Load All Available Patients and Shared Case Sources (once for all studies) ---
     print("Step 3: Loading all available patients...")
-    patient_files = glob.glob(f"{PATHS['raw_patient_data_dir']}/*.txt")
-    all_patients = pd.concat(
-        [pd.read_csv(f, sep='\t', usecols=['e_patid', 'e_pracid', 'gender', 'yob']) for f in patient_files],
-        ignore_index=True
-    ).rename(columns={'e_patid': 'subject_id'}).drop_duplicates(subset=['subject_id'])
+    patient_scans = scan_raw_dir(PATHS['raw_patient_data_dir'], PATHS.get('ingest_cache_dir'))
+    all_patients = pl.concat(
+        [lf.select('e_patid', 'e_pracid', 'gender', 'yob') for lf in patient_scans],
+        how='vertical'
+    ).collect().to_pandas().rename(columns={'e_patid': 'subject_id'}).drop_duplicates(subset=['subject_id'])
     all_patients['subject_id'] = all_patients['subject_id'].astype('int64')
     
-    available_patients = all_patients[~all_patients['subject_id'].isin(master_log['subject_id'])]
+    available_patients = all_patients[~subject_log.contains(all_patients['subject_id'].to_numpy())]
 
-    # --- 4. Identify Cases (Based on Config Mode) ---
     mode = STUDY_PARAMS.get('cohort_definition_mode', 'discovery')
-    print(f"Step 4: Identifying cases using '{mode}' mode...")
-
+    predefined_cases, cancer_df = None, None
     if mode == 'predefined':
-        cases_predefined = pd.read_csv(PATHS['predefined_cases_file'])
-        
-        # Filter for the specific cancer and ensure it's in our available patient pool
-        cases_predefined = cases_predefined[cases_predefined[STUDY_PARAMS['cancer_type']] == 1].rename(columns={'epatid': 'subject_id'})
-        cases_predefined['subject_id'] = cases_predefined['subject_id'].astype('int64')
+        predefined_cases = pd.read_csv(PATHS['predefined_cases_file'])
+    else:
+        cancer_df = load_stata(
+            PATHS['raw_cancer_data'], ['epatid', 'site', 'cancerdate'], PATHS.get('ingest_cache_dir')
+        ).to_pandas()
+
+    all_cancer_ids = load_stata(PATHS['raw_cancer_data'], ['epatid'], PATHS.get('ingest_cache_dir')) \
+        .get_column('epatid').drop_nulls().cast(pl.Int64).unique().to_numpy()
+
+    for cancer_type in cancer_types:
+        print(f"\n=== Defining cohort for the '{cancer_type}' study ===")
+        OUTPUTS = {key: val.format(cancer_type=cancer_type) for key, val in config['outputs'].items()}
+        Path(OUTPUTS['output_dir']).mkdir(parents=True, exist_ok=True)
+
+        # Hold the master log from here until this study's subjects are appended, so a
+        # study running concurrently cannot select any of the same subjects
+        with subject_log.reserve():
+            available_patients = available_patients[~subject_log.contains(available_patients['subject_id'].to_numpy())]
+
+            # --- 4. Identify Cases (Based on Config Mode) ---
+            print(f"Step 4: Identifying cases using '{mode}' mode...")
+            cases = _identify_cases(mode, cancer_type, STUDY_PARAMS, available_patients, predefined_cases, cancer_df)
+            print(f"Found {len(cases)} valid cases for this study.")
+
+            # --- 5. Identify Potential Controls (Same for both modes) ---
+            print("Step 5: Identifying potential controls...")
+            potential_controls = available_patients[~available_patients['subject_id'].isin(all_cancer_ids)].copy()
+            potential_controls = potential_controls.rename(columns={'subject_id': 'control_id', 'yob': 'control_yob'})
+            print(f"Found {len(potential_controls)} potential controls.")
+
+            # --- 6, 7, 8, 9. Match, Sample, and Save (Same for both modes) ---
+            print("Step 6: Matching cases to controls...")
+            matches = band_join(
+                cases, potential_controls,
+                by=['e_pracid', 'gender'],
+                case_value='yob', control_value='control_yob',
+                window=STUDY_PARAMS['yob_window']
+            )
+
+            print(f"Step 7: Sampling up to {STUDY_PARAMS['controls_per_case']} controls per case...")
+            sampled_controls = sample_controls(
+                matches,
+                STUDY_PARAMS['controls_per_case'],
+                seed=STUDY_PARAMS.get('sampling_seed', 42),
+                without_replacement=STUDY_PARAMS.get('sample_controls_without_replacement', False)
+            )
+
+            print("Step 8: Generating final cohort file...")
+            cases_final = cases[['subject_id']].copy()
+            cases_final['is_case'] = 1
+            controls_final = sampled_controls[['control_id']].copy().rename(columns={'control_id': 'subject_id'}).drop_duplicates()
+            controls_final['is_case'] = 0
+            cohort = pd.concat([cases_final, controls_final], ignore_index=True)
+            cohort.to_csv(OUTPUTS['cohort_file'], index=False)
         
-        # Join with available_patients. This creates 'gender_x' (from this file) and 'gender_y' (from patient files)
-        cases_predefined = pd.merge(cases_predefined, available_patients, on='subject_id', how='inner')
+            print(f"Generated cohort file with {len(cohort)} total subjects.")
 
-        # Derive year of birth (yob)
-        # Add the specific format for dates like '20feb2014' to remove the warning
-        cases_predefined['cancerdate_dt'] = pd.to_datetime(cases_predefined['cancerdate'], format='%d%b%Y')
-        cases_predefined['yob'] = (cases_predefined['cancerdate_dt'].dt.year - cases_predefined['ageatindex']).astype(int)
-        
-        # --- FIX: Use the correct column 'gender_x' and assign to a new 'gender' column ---
-        cases_predefined['gender'] = np.where(cases_predefined['gender_x'] == 'male', 1, 2)
-        
-        # Create the final 'cases' DataFrame with the required columns for matching
-        cases = cases_predefined[['subject_id', 'e_pracid', 'gender', 'yob']].copy()
-
-
-    else: # 'discovery' mode (your previous logic)
-        cancer_df = pd.read_stata(PATHS['raw_cancer_data'])
-        cases_with_site = cancer_df[
-            (cancer_df['site'] == STUDY_PARAMS['cancer_type']) &
-            (cancer_df['cancerdate'] >= pd.to_datetime(STUDY_PARAMS['start_date']))
-        ].rename(columns={'epatid': 'subject_id'})
-        cases_with_site['subject_id'] = cases_with_site['subject_id'].astype('int64')
-        cases = pd.merge(cases_with_site[['subject_id']], available_patients, on='subject_id', how='inner')
-
-    print(f"Found {len(cases)} valid cases for this study.")
-
-    # --- 5. Identify Potential Controls (Same for both modes) ---
-    print("Step 5: Identifying potential controls...")
-    all_cancer_ids = pd.read_stata(PATHS['raw_cancer_data'])['epatid'].astype('int64').unique()
-    potential_controls = available_patients[~available_patients['subject_id'].isin(all_cancer_ids)].copy()
-    potential_controls = potential_controls.rename(columns={'subject_id': 'control_id', 'yob': 'control_yob'})
-    print(f"Found {len(potential_controls)} potential controls.")
-
-    # --- 6, 7, 8, 9. Match, Sample, and Save (Same for both modes) ---
-    # (This section is unchanged from your uploaded script)
-    print("Step 6: Matching cases to controls...")
-    matches = pd.merge(cases, potential_controls, on=['e_pracid', 'gender'], how='inner')
-    yob_window = STUDY_PARAMS['yob_window']
-    matches = matches[matches['control_yob'].between(matches['yob'] - yob_window, matches['yob'] + yob_window)]
-
-    print(f"Step 7: Sampling up to {STUDY_PARAMS['controls_per_case']} controls per case...")
-    sampled_controls = matches.groupby('subject_id')['control_id'].apply(
-        lambda x: x.sample(n=min(len(x), STUDY_PARAMS['controls_per_case']), random_state=42)
-    ).reset_index(name='control_id')[['subject_id', 'control_id']]
-
-    print("Step 8: Generating final cohort file...")
-    cases_final = cases[['subject_id']].copy()
-    cases_final['is_case'] = 1
-    controls_final = sampled_controls[['control_id']].copy().rename(columns={'control_id': 'subject_id'}).drop_duplicates()
-    controls_final['is_case'] = 0
-    cohort = pd.concat([cases_final, controls_final], ignore_index=True)
-    cohort.to_csv(OUTPUTS['cohort_file'], index=False)
-    
-    print(f"Generated cohort file with {len(cohort)} total subjects.")
+            print("Step 9: Updating master subject log...")
+            subject_log.append(cohort['subject_id'].to_numpy())
+            print(f"Master log updated. Total subjects tracked: {len(subject_log)}.")
+
+        # Later studies in this run must not reuse this study's subjects
+        available_patients = available_patients[~available_patients['subject_id'].isin(cohort['subject_id'])]
 
-    print("Step 9: Updating master subject log...")
-    new_subjects_to_log = cohort[['subject_id']]
-    updated_log = pd.concat([master_log, new_subjects_to_log]).drop_duplicates()
-    updated_log.to_csv(master_log_path, index=False)
-    
-    print(f"Master log updated. Total subjects tracked: {len(updated_log)}.")
     print("--- Stage 1: Cohort Definition COMPLETE ✅ ---")
 
 
 if __name__ == '__main__':
-    define_cohort('config.yaml')
\ No newline at end of file
+    define_cohort('config.yaml')
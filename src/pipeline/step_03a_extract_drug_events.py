@@ -0,0 +1,135 @@
+# src/pipeline/step_03a_extract_drug_events.py
+
+import polars as pl
+import yaml
+import glob
+import os
+from pathlib import Path
+import time
+
+from src.utils.ingest_cache import scan_raw_file, file_state_key
+from src.utils.cohort_filter import cohort_filter_expr, sink_with_stats
+from src.utils.dates import decode_dates_expr, date_failure_exprs
+from src.utils.drug_lookup import compile_product_lookup
+from src.utils.file_tasks import TaskManifest, run_file_tasks
+from src.utils.resource_plan import resource_budget, plan_extract_workers, MemoryMonitor
+from src.utils.trajectory import load_subject_windows, in_trajectory_window
+from src.pipeline.step_03a_extract_events import windows_run_key
+
+# Shared state of an extraction worker, set once per process by _init_worker
+_WORKER = {}
+
+
+def _init_worker(windows_df: pl.DataFrame, cache_dir: str, product_dictionary: str):
+    _WORKER['windows_df'] = windows_df
+    _WORKER['cohort_ids'] = windows_df["e_patid"]
+    _WORKER['cache_dir'] = cache_dir
+    _WORKER['product_lookup_lf'] = compile_product_lookup(product_dictionary, cache_dir)
+
+
+def _extract_drug_file(drug_file: str, output_path: str) -> dict:
+    """Extracts one raw drug issue file's windowed, mapped cohort prescriptions into `output_path`."""
+    raw_lf = scan_raw_file(drug_file, _WORKER['cache_dir']) \
+        .select("e_patid", "issuedate", "prodcodeid", "quantity", "duration").cache()
+    cohort_drugs_lf = raw_lf \
+        .filter(cohort_filter_expr(_WORKER['cohort_ids'])) \
+        .with_columns(time=decode_dates_expr("issuedate")) \
+        .cache()
+    drug_lf = cohort_drugs_lf \
+        .join(_WORKER['windows_df'].lazy(), on="e_patid", how="inner") \
+        .filter(in_trajectory_window()) \
+        .join(_WORKER['product_lookup_lf'], on="prodcodeid", how="inner") \
+        .select("e_patid", "time", "code", "quantity", "duration")
+    # The pruning counts come from the same pass that writes the output
+    return sink_with_stats(drug_lf, output_path, [
+        raw_lf.select(raw_rows=pl.len()),
+        cohort_drugs_lf.select(cohort_rows=pl.len(), **date_failure_exprs("issuedate", "time")),
+    ])
+
+
+def extract_drug_events(config_path: str):
+    """
+    Stage 3a (drugs): Extracts all drug issues for the cohort, maps prodcodeids
+    to PRESCRIPTION codes and applies the same trajectory windows as the
+    observation events.
+
+    The windows are computed per subject up front, so each drug issue file is
+    streamed straight through (cohort filter, date parsing, window filter,
+    code lookup) into its own Parquet file. Files are extracted in parallel and
+    recorded in a manifest, exactly as for the observation files.
+    """
+    print("--- Running Stage 3a: Extract & Standardise Drug Issues ---")
+
+    # --- 1. Load Configuration ---
+    print("Step 1: Loading configuration...")
+    with open(config_path, 'r') as f:
+        config = yaml.safe_load(f)
+    STUDY_PARAMS = config['study_params']
+    cancer_type = STUDY_PARAMS['cancer_type']
+    PATHS = {key: val.format(cancer_type=cancer_type) for key, val in config['paths'].items()}
+    OUTPUTS = {key: val.format(cancer_type=cancer_type) for key, val in config['outputs'].items()}
+    RESOURCES = config.get('resources', {})
+
+    # --- 2. Load Subject Data and Trajectory Windows ---
+    print("Step 2: Loading subject data and trajectory windows...")
+    windows_df = load_subject_windows(OUTPUTS['subject_information_file'], PATHS)
+    print(f"  - Cohort: {windows_df.height} subjects")
+
+    # --- 3. Compile the Product Lookup ---
+    # Compiled once here so the workers only ever read the finished Parquet file
+    print("Step 3: Loading product dictionary lookup...")
+    compile_product_lookup(PATHS['product_dictionary'], PATHS.get('ingest_cache_dir'))
+
+    # --- 4. Extract Each Drug Issue File ---
+    drug_files = sorted(glob.glob(os.path.join(PATHS['medication_data_dir'], "*drugissue*.txt")))
+    max_workers = plan_extract_workers(RESOURCES, drug_files)
+    print(f"Step 4: Extracting {len(drug_files)} drug issue file(s) with {max_workers} worker(s)...")
+    output_dir = Path(OUTPUTS['intermediate_drug_dir'])
+    output_dir.mkdir(parents=True, exist_ok=True)
+    jobs = [(f, output_dir / f"{Path(f).stem}.parquet") for f in drug_files]
+
+    # Remove outputs that no current input file produces, so later stages never read stale files
+    expected_outputs = {str(output_path) for _, output_path in jobs}
+    for old_file in output_dir.glob("*.parquet"):
+        if str(old_file) not in expected_outputs:
+            old_file.unlink()
+
+    start_time = time.time()
+    # The lookup's state is part of the run key, so editing ProdDict re-maps every file
+    run_key = windows_run_key(windows_df) + file_state_key(PATHS['product_dictionary'])
+    manifest = TaskManifest(output_dir / "manifest.json", run_key)
+    with MemoryMonitor(resource_budget(RESOURCES)['memory_gb']) as monitor:
+        failed_files = run_file_tasks(
+            _extract_drug_file, jobs, manifest, max_workers,
+            max_attempts=RESOURCES.get('extract_max_attempts', 3),
+            initializer=_init_worker,
+            initargs=(windows_df, PATHS.get('ingest_cache_dir'), PATHS['product_dictionary']),
+            monitor=monitor,
+        )
+    print(f'Finished extraction in: {time.time() - start_time:.2f} seconds')
+
+    # --- 5. Report ---
+    done = [manifest.entries[f] for f, _ in jobs if f not in failed_files]
+    n_raw, n_cohort, n_missing, n_unparseable, n_written = (
+        sum(entry[key] for entry in done)
+        for key in ('raw_rows', 'cohort_rows', 'missing_dates', 'unparseable_dates', 'rows')
+    )
+    print(f"  - Raw drug issue rows:                        {n_raw}")
+    print(f"  - Pruned, subject not in cohort:              {n_raw - n_cohort}")
+    print(f"  - Pruned, missing issuedate:                  {n_missing}")
+    print(f"  - Pruned, unparseable issuedate:              {n_unparseable}")
+    print(f"  - Pruned, outside window or unmapped product: {n_cohort - n_missing - n_unparseable - n_written}")
+    print(f"  - Drug events written:                        {n_written}")
+    for drug_file, _ in jobs:
+        if drug_file not in failed_files and manifest.entries[drug_file]['unparseable_dates']:
+            print(f"Warning: {manifest.entries[drug_file]['unparseable_dates']} unparseable issuedate value(s) in {drug_file}")
+    if failed_files:
+        print(f"WARNING: {len(failed_files)} drug issue file(s) failed and are missing from the output:")
+        for failed_file in failed_files:
+            print(f"    {failed_file}")
+        print("Re-run stage 3a to retry them; completed files will not be processed again.")
+    print("--- Stage 3a (drugs) COMPLETE ---")
+
+
+if __name__ == '__main__':
+    extract_drug_events('config.yaml')
@@ -2,107 +2,245 @@
 
 import polars as pl
 import yaml
+import functools
 import glob
+import hashlib
 import os
 from pathlib import Path
 import time
 
-def extract_events(config_path: str):
-    """
-    Stage 3a: Extracts and standardises all raw observation events for the cohort,
-    applying dynamic trajectory windows in a single, memory-efficient pass.
-    """
-    print("--- Running Stage 3a: Extract & Standardise Events (Optimized) ---")
-    
-    # --- 1. Load Configuration and Raw Data ---
-    print("Step 1: Loading configuration and raw observation data...")
-    DATE_FORMAT = "%d/%m/%Y"
-    with open(config_path, 'r') as f:
-        config = yaml.safe_load(f)
-    STUDY_PARAMS = config['study_params']
-    cancer_type = STUDY_PARAMS['cancer_type']
-    PATHS = {key: val.format(cancer_type=cancer_type) for key, val in config['paths'].items()}
-    OUTPUTS = {key: val.format(cancer_type=cancer_type) for key, val in config['outputs'].items()}
-    
-    observation_files = glob.glob(os.path.join(PATHS['observation_data_dir'], "*.txt"))
-    observation_dtypes = {
-        "e_patid": pl.Int64, "obsdate": pl.String, "medcodeid": pl.String,
-        "value": pl.Float64, "numunitid": pl.Int64,
-    }
-    # Lazily scan all observation files and standardize the time column
-    obs_standardized_lf = pl.concat(
-        [pl.scan_csv(f, separator="\t", has_header=True, schema_overrides=observation_dtypes).select(observation_dtypes.keys()) for f in observation_files],
-        how="vertical",
-    ).with_columns(
-        time=pl.col("obsdate").str.to_date(DATE_FORMAT, strict=False)
-    )
+from src.utils.ingest_cache import scan_raw_file
+from src.utils.cohort_filter import cohort_filter_expr, sink_with_stats
+from src.utils.dates import decode_dates_expr, date_failure_exprs
+from src.utils.event_schema import UNSORTED_EVENT_SCHEMA, cast_failure_exprs, invalid_medcodeid_expr, subject_index
+from src.utils.file_tasks import TaskManifest, run_file_tasks
+from src.utils.hashing import stable_hash_expr
+from src.utils.resource_plan import resource_budget, plan_extract_workers, MemoryMonitor
+from src.utils.trajectory import load_subject_windows, in_trajectory_window
 
-    # --- 2. Load Subject Data ---
-    print("Step 2: Loading subject data...")
-    subjects_lf = pl.scan_csv(OUTPUTS['subject_information_file']) \
-        .rename({"subject_id": "e_patid"}) \
-        .with_columns(
-            cancerdate=pl.col("cancerdate").str.to_datetime().cast(pl.Date)
-        )
+OBSERVATION_COLUMNS = ["e_patid", "obsdate", "medcodeid", "value", "numunitid"]
 
-    # --- 3. Build and Apply Trajectory Filter in a Single Pass ---
-    print("Step 3: Calculating trajectory windows and filtering events...")
-    
-    # Join subject info onto the full event stream first
-    events_with_context_lf = obs_standardized_lf.join(
-        subjects_lf, on="e_patid", how="inner"
-    )
-    
-    events_with_dates_lf = events_with_context_lf.with_columns(
-        last_event_date=pl.max("time").over("e_patid")
-    ).with_columns(
-        end_date=pl.when(pl.col("is_case") == 1)
-                   .then(pl.col("cancerdate"))
-                   .otherwise(pl.col("last_event_date").dt.offset_by("-1y")),
-        start_date=pl.when(pl.col("is_case") == 1)
-                    .then(pl.col("cancerdate").dt.offset_by("-5y"))
-                    .otherwise(pl.col("last_event_date").dt.offset_by("-6y"))
-    )
+# Shared state of an extraction worker, set once per process by _init_worker
+_WORKER = {}
+# Most subject buckets that memory pressure re-plans extraction into; each one
+# costs a scan of every remaining file
+MAX_EXTRACT_BUCKETS = 16
 
-    # Step 3b: Apply the filter in a separate step
-    filtered_medical_events_lf = events_with_dates_lf.filter(
-        pl.col("time").is_between(pl.col("start_date"), pl.col("end_date"))
+
+def subject_bucket_expr(id_col: str, num_buckets: int) -> pl.Expr:
+    """Hash bucket (0..num_buckets-1) of each subject, stable across runs."""
+    return (stable_hash_expr(pl.col(id_col)) % num_buckets).cast(pl.Int32)
+
+
+def _init_worker(windows_df: pl.DataFrame, cache_dir: str, num_buckets: int = 1):
+    _WORKER['windows_df'] = windows_df
+    _WORKER['cache_dir'] = cache_dir
+    _WORKER['num_buckets'] = num_buckets
+    _WORKER['bucket_windows'] = {}
+
+
+def _bucket_windows(num_buckets: int) -> list:
+    """Each bucket's windows, with its subjects' IDs sorted for the cohort filter; built once per bucket count."""
+    if num_buckets not in _WORKER['bucket_windows']:
+        windows_df = _WORKER['windows_df']
+        _WORKER['bucket_windows'][num_buckets] = [
+            windows_df.filter(subject_bucket_expr("e_patid", num_buckets) == bucket).sort("e_patid")
+            for bucket in range(num_buckets)
+        ]
+    return _WORKER['bucket_windows'][num_buckets]
+
+
+def cohort_observation_events(raw_lf: pl.LazyFrame, cohort_ids: pl.Series) -> pl.LazyFrame:
+    """Raw observation rows of the cohort, with their obsdate parsed into `time`."""
+    # Membership on integer e_patid runs while scanning; only cohort rows get their dates parsed
+    return raw_lf.select(OBSERVATION_COLUMNS).filter(cohort_filter_expr(cohort_ids)).with_columns(
+        time=decode_dates_expr("obsdate")
     )
-    
+
+
+def windowed_observation_events(cohort_events_lf: pl.LazyFrame, windows_df: pl.DataFrame) -> pl.LazyFrame:
+    """
+    Keeps the cohort events inside their subject's trajectory window, in the
+    stage 3a output schema. `windows_df` carries each subject's subject_idx.
+    Events whose medcodeid is not an integer are dropped, and unit ids that do
+    not fit the schema become null (see cast_failure_exprs).
+    """
+    # Join each subject's precomputed window and keep the events inside it
+    events_with_dates_lf = cohort_events_lf.filter(~invalid_medcodeid_expr()) \
+        .join(windows_df.lazy(), on="e_patid", how="inner")
+    filtered_medical_events_lf = events_with_dates_lf.filter(in_trajectory_window())
+
     # --- Optional Debugging Block ---
     # To use this, uncomment the lines and set a patient ID.
     # It will print the calculated dates for one patient before saving.
     # -----------------------------------------------------------
-    # patient_to_debug = 362864450976 
+    # patient_to_debug = 362864450976
     # if patient_to_debug:
     #     print(f"--- Debugging patient {patient_to_debug} ---")
     #     debug_df = events_with_dates_lf.filter(pl.col('e_patid') == patient_to_debug).collect()
-    #     print(debug_df.select("e_patid", "time", "is_case", "start_date", "end_date"))
+    #     print(debug_df.select("e_patid", "time", "start_date", "end_date"))
     #     print("--- End Debugging ---")
     # -----------------------------------------------------------
 
-    # Final selection of columns
-    final_lf = filtered_medical_events_lf.select(
-        "e_patid", 
-        "time", 
+    # Final selection of columns, in the compact stage 3a schema
+    return filtered_medical_events_lf.select(
+        "subject_idx",
+        "time",
+        "medcodeid",
         "numunitid",
-        code=pl.lit("medcodeid//") + pl.col("medcodeid"),
         numeric_value=pl.col("value")
-    )
+    ).select(list(UNSORTED_EVENT_SCHEMA)).cast(UNSORTED_EVENT_SCHEMA, strict=False)
+
+
+def _sink_observation_events(raw_lf: pl.LazyFrame, windows_df: pl.DataFrame, output_path: str) -> dict:
+    """
+    Streams the windowed events of `windows_df`'s subjects into `output_path`
+    and returns the row counts of every pruning step, computed in the same
+    pass. `raw_lf` must be cached, so the raw file is scanned once.
+    """
+    cohort_events_lf = cohort_observation_events(raw_lf, windows_df["e_patid"]).cache()
+    return sink_with_stats(windowed_observation_events(cohort_events_lf, windows_df), output_path, [
+        raw_lf.select(raw_rows=pl.len()),
+        cohort_events_lf.select(cohort_rows=pl.len(), **date_failure_exprs("obsdate", "time")),
+        # Cast failures are only counted for dated rows, so no row is counted as pruned twice
+        cohort_events_lf.filter(pl.col("time").is_not_null()).select(**cast_failure_exprs()),
+    ])
+
+
+def _extract_observation_file(obs_file: str, output_path: str, num_buckets: int = None) -> dict:
+    """
+    Extracts one raw observation file's windowed cohort events into `output_path`,
+    in `num_buckets` subject buckets (by default the worker's planned count).
+
+    With more than one subject bucket, the file is extracted one bucket at a
+    time: each bucket is streamed into its own temporary file and the buckets
+    are then streamed into `output_path` in bucket order, so no bucket is ever
+    held in memory; the cost is one scan of the cached file per bucket.
+    """
+    num_buckets = num_buckets or _WORKER['num_buckets']
+    raw_lf = scan_raw_file(obs_file, _WORKER['cache_dir']).select(OBSERVATION_COLUMNS).cache()
+    if num_buckets == 1:
+        return _sink_observation_events(raw_lf, _WORKER['windows_df'], output_path)
+
+    bucket_paths = [f"{output_path}.bucket{bucket:03d}" for bucket in range(num_buckets)]
+    try:
+        bucket_stats = [
+            _sink_observation_events(raw_lf, bucket_windows_df, bucket_path)
+            for bucket_path, bucket_windows_df in zip(bucket_paths, _bucket_windows(num_buckets))
+        ]
+        pl.scan_parquet(bucket_paths).sink_parquet(output_path, compression='snappy')
+    finally:
+        for bucket_path in bucket_paths:
+            Path(bucket_path).unlink(missing_ok=True)
+    # Every bucket scans the whole file, so raw_rows is the same in each
+    return {
+        **{key: sum(stats[key] for stats in bucket_stats) for key in bucket_stats[0]},
+        'raw_rows': bucket_stats[0]['raw_rows'],
+    }
+
+
+def windows_run_key(windows_df: pl.DataFrame) -> str:
+    """Hash of the cohort's trajectory windows; extraction outputs are only valid for one set of windows."""
+    return hashlib.sha1(windows_df.write_csv().encode()).hexdigest()[:16]
+
+
+def extract_events(config_path: str):
+    """
+    Stage 3a: Extracts and standardises all raw observation events for the cohort,
+    applying each subject's trajectory window.
+
+    Every raw observation file is extracted by its own task on a process pool
+    sized by the resource planner from resources.max_threads and
+    resources.max_memory_gb, and written to its own Parquet file. Within a
+    file, subjects are hash-partitioned into resources.extract_num_buckets
+    buckets that are extracted one after another; when memory use stays near
+    resources.max_memory_gb, the remaining files use twice as many buckets.
+    A manifest records each finished file with its row counts and checksum, so
+    a re-run only processes files that are missing, changed or failed. Files
+    that still fail after resources.extract_max_attempts tries are reported
+    rather than aborting the stage.
+    """
+    print("--- Running Stage 3a: Extract & Standardise Events (Optimized) ---")
+
+    # --- 1. Load Configuration ---
+    print("Step 1: Loading configuration...")
+    with open(config_path, 'r') as f:
+        config = yaml.safe_load(f)
+    STUDY_PARAMS = config['study_params']
+    cancer_type = STUDY_PARAMS['cancer_type']
+    PATHS = {key: val.format(cancer_type=cancer_type) for key, val in config['paths'].items()}
+    OUTPUTS = {key: val.format(cancer_type=cancer_type) for key, val in config['outputs'].items()}
+    RESOURCES = config.get('resources', {})
+
+    # --- 2. Load Subject Data and Trajectory Windows ---
+    print("Step 2: Loading subject data and trajectory windows...")
+    windows_df = load_subject_windows(OUTPUTS['subject_information_file'], PATHS)
+    print(f"  - Cohort: {windows_df.height} subjects")
 
-    # --- 4. Save the Filtered Events ---
-    print('Step 4: Saving filtered, unsorted events...')
+    # --- 3. Extract Each Observation File ---
+    obs_files = sorted(glob.glob(os.path.join(PATHS['observation_data_dir'], "*.txt")))
+    max_workers = plan_extract_workers(RESOURCES, obs_files)
+    num_buckets = RESOURCES.get('extract_num_buckets') or 1
+    print(f"Step 3: Extracting {len(obs_files)} observation file(s) with {max_workers} worker(s) "
+          f"in {num_buckets} subject bucket(s) each...")
     output_dir = Path(OUTPUTS['intermediate_unsorted_dir'])
     output_dir.mkdir(parents=True, exist_ok=True)
-    
+    jobs = [(f, output_dir / f"{Path(f).stem}.parquet") for f in obs_files]
+
+    # Remove outputs that no current input file produces, so stage 3b never reads stale files
+    expected_outputs = {str(output_path) for _, output_path in jobs}
+    for old_file in output_dir.glob("*.parquet"):
+        if str(old_file) not in expected_outputs:
+            old_file.unlink()
+
     start_time = time.time()
-    final_lf.sink_parquet(
-        output_dir / "data.parquet",
-        compression='snappy'
+    # Outputs written with another event schema are redone, so every file has the same schema
+    schema_key = hashlib.sha1(str(UNSORTED_EVENT_SCHEMA).encode()).hexdigest()[:8]
+    manifest = TaskManifest(output_dir / "manifest.json", windows_run_key(windows_df) + schema_key)
+
+    def more_buckets(task):
+        # Memory use did not recover: extract the remaining files in twice as many subject buckets
+        nonlocal num_buckets
+        if num_buckets >= MAX_EXTRACT_BUCKETS:
+            return task
+        num_buckets = min(2 * num_buckets, MAX_EXTRACT_BUCKETS)
+        print(f"  - Memory use stays near the budget; extracting the remaining files in {num_buckets} subject bucket(s)")
+        return functools.partial(_extract_observation_file, num_buckets=num_buckets)
+
+    with MemoryMonitor(resource_budget(RESOURCES)['memory_gb']) as monitor:
+        failed_files = run_file_tasks(
+            _extract_observation_file, jobs, manifest, max_workers,
+            max_attempts=RESOURCES.get('extract_max_attempts', 3),
+            initializer=_init_worker, initargs=(windows_df, PATHS.get('ingest_cache_dir'), num_buckets),
+            monitor=monitor, replan=more_buckets,
+        )
+    print(f'Finished extraction in: {time.time() - start_time:.2f} seconds')
+
+    # --- 4. Report ---
+    done = [manifest.entries[f] for f, _ in jobs if f not in failed_files]
+    n_raw, n_cohort, n_missing, n_unparseable, n_invalid_codes, n_bad_units, n_written = (
+        sum(entry[key] for entry in done)
+        for key in ('raw_rows', 'cohort_rows', 'missing_dates', 'unparseable_dates',
+                    'invalid_medcodeids', 'out_of_range_units', 'rows')
     )
-    print(f'Finished save in: {time.time() - start_time:.2f} seconds')
+    print(f"  - Raw observation rows:                    {n_raw}")
+    print(f"  - Pruned, subject not in cohort:           {n_raw - n_cohort}")
+    print(f"  - Pruned, missing obsdate:                 {n_missing}")
+    print(f"  - Pruned, unparseable obsdate:             {n_unparseable}")
+    print(f"  - Pruned, non-numeric medcodeid:           {n_invalid_codes}")
+    print(f"  - Pruned, outside trajectory window:       {n_cohort - n_missing - n_unparseable - n_invalid_codes - n_written}")
+    print(f"  - Events written:                          {n_written}")
+    print(f"  - numunitid out of range, set to null:     {n_bad_units} (dated cohort rows)")
+    for obs_file, _ in jobs:
+        if obs_file not in failed_files and manifest.entries[obs_file]['unparseable_dates']:
+            print(f"Warning: {manifest.entries[obs_file]['unparseable_dates']} unparseable obsdate value(s) in {obs_file}")
+    if failed_files:
+        print(f"WARNING: {len(failed_files)} observation file(s) failed and are missing from the output:")
+        for failed_file in failed_files:
+            print(f"    {failed_file}")
+        print("Re-run stage 3a to retry them; completed files will not be processed again.")
     print("--- Stage 3a COMPLETE ---")
 
 
 if __name__ == '__main__':
-    extract_events('config.yaml')
\ No newline at end of file
+    extract_events('config.yaml')
@@ -0,0 +1,142 @@
+# src/pipeline/step_03ab_extract_sorted_events.py
+
+import polars as pl
+import yaml
+from pathlib import Path
+import time
+
+from src.utils.ingest_cache import scan_raw_dir
+from src.utils.cohort_filter import cohort_filter_expr
+from src.utils.external_sort import (
+    rows_per_bucket, plan_bucket_bounds, max_held_bytes, partition_to_buckets, sort_buckets, remove_spill_dir,
+)
+from src.utils.resource_plan import resource_budget, plan_sort, plan_batch_rows, MemoryMonitor
+from src.utils.row_group_index import build_row_group_index
+from src.utils.trajectory import load_subject_windows
+from src.pipeline.step_03a_extract_events import (
+    OBSERVATION_COLUMNS, cohort_observation_events, windowed_observation_events,
+)
+from src.utils.event_schema import (
+    SORTED_PARTS_GLOB, invalid_medcodeid_expr, subject_index, build_code_vocabulary, encode_codes, write_vocabularies,
+)
+from src.pipeline.step_03b_sort_events import make_birth_events, sort_subject_events
+
+# In-memory size of one compact event row (subject_idx, time, code_id, numeric_value, numunitid)
+EVENT_BYTES_PER_ROW = 24
+
+
+def extract_sorted_events(config_path: str):
+    """
+    Stage 3a+3b (fused): Extracts the cohort's windowed observation events and
+    writes them already sorted, without the intermediate_unsorted_dir hop.
+
+    The raw files are read twice. A first pass over the cohort's raw rows
+    counts each subject's rows (an upper bound on its windowed events) and
+    collects the code vocabulary; from the counts, subjects are cut into
+    contiguous subject_idx ranges small enough to sort within the planned
+    sort memory. A second pass extracts the windowed events one raw file at a
+    time and partitions them, with the MEDS_BIRTH events, into the ranges,
+    exactly like stage 3b's external sort: ranges are held in memory and only
+    spilled to disk past the sort memory or under memory pressure, so when the
+    events fit they are never written twice. Each range is then sorted with the
+    same ordering as stage 3b and written to intermediate_sorted_dir as
+    part_NNNNN.parquet, so the parts in file name order are globally sorted.
+    Ranges wait to be loaded while memory use is near resources.max_memory_gb,
+    and are sorted as several smaller ranges if it does not come back down.
+    The parts use the same compact schema, subject index and code vocabulary
+    files as stage 3b.
+    """
+    print("--- Running Stage 3a+3b: Extract & Sort Events (Fused) ---")
+
+    # --- 1. Load Configuration ---
+    print("Step 1: Loading configuration...")
+    with open(config_path, 'r') as f:
+        config = yaml.safe_load(f)
+    STUDY_PARAMS = config['study_params']
+    cancer_type = STUDY_PARAMS['cancer_type']
+    PATHS = {key: val.format(cancer_type=cancer_type) for key, val in config['paths'].items()}
+    OUTPUTS = {key: val.format(cancer_type=cancer_type) for key, val in config['outputs'].items()}
+    RESOURCES = config.get('resources', {})
+    sort_memory_gb, sort_workers = plan_sort(RESOURCES)
+
+    # --- 2. Load Subject Data, Trajectory Windows and Birth Events ---
+    print("Step 2: Loading subject data, trajectory windows and birth events...")
+    windows_df = load_subject_windows(OUTPUTS['subject_information_file'], PATHS)
+    subjects_df = pl.read_csv(OUTPUTS['subject_information_file'])
+    subject_index_df = subject_index(subjects_df)
+    birth_events_df = make_birth_events(subjects_df, subject_index_df)
+    print(f"  - Cohort: {subjects_df.height} subjects")
+
+    raw_lfs = []
+    for lf in scan_raw_dir(PATHS['observation_data_dir'], PATHS.get('ingest_cache_dir')):
+        if "e_patid" in lf.collect_schema().names():
+            raw_lfs.append(lf)
+        else:
+            print("Warning: Skipping an observation file with no e_patid column.")
+    raw_lfs = [lf.select(OBSERVATION_COLUMNS) for lf in raw_lfs]
+    raw_lf = pl.concat(raw_lfs, how="vertical")
+
+    # --- 3. Plan Subject Range Buckets and Build the Code Vocabulary ---
+    print("Step 3: Planning subject range buckets and building the code vocabulary...")
+    cohort_rows_lf = raw_lf.select("e_patid", "medcodeid").filter(cohort_filter_expr(windows_df["e_patid"]))
+    cohort_counts, medcodeids = pl.collect_all([
+        cohort_rows_lf.group_by("e_patid").agg(n_rows=pl.len()),
+        cohort_rows_lf.filter(~invalid_medcodeid_expr()).select(pl.col("medcodeid").unique()),
+    ], engine="streaming")
+    subject_counts = pl.concat([
+        cohort_counts.join(windows_df.select("e_patid", "subject_idx"), on="e_patid", how="inner")
+                     .select("subject_idx", pl.col("n_rows").cast(pl.UInt32)),
+        birth_events_df.group_by("subject_idx").agg(n_rows=pl.len()),
+    ]).group_by("subject_idx").agg(pl.col("n_rows").sum())
+    # The vocabulary covers every valid cohort medcodeid, a superset of the windowed events' codes
+    code_vocabulary_df = build_code_vocabulary(medcodeids["medcodeid"].cast(pl.Int64))
+    max_rows = rows_per_bucket(EVENT_BYTES_PER_ROW, sort_memory_gb, sort_workers)
+    batch_rows = plan_batch_rows(RESOURCES, EVENT_BYTES_PER_ROW)
+    bounds = plan_bucket_bounds(subject_counts, max_rows, id_col="subject_idx")
+    print(f"  - {code_vocabulary_df.height} distinct codes")
+    print(f"  - {len(bounds) + 1} bucket(s) of at most {max_rows} rows ({sort_memory_gb:.1f} GB budget, {sort_workers} worker(s))")
+
+    output_dir = Path(OUTPUTS['intermediate_sorted_dir'])
+    output_dir.mkdir(parents=True, exist_ok=True)
+    # Remove outputs of earlier runs so stage 3c never reads stale files
+    for old_file in output_dir.glob("*.parquet"):
+        old_file.unlink()
+    write_vocabularies(output_dir, subject_index_df, code_vocabulary_df)
+    spill_dir = output_dir / "_spill"
+    remove_spill_dir(spill_dir)
+
+    # --- 4. Extract Events and Partition Them into Subject Range Buckets ---
+    print(f"Step 4: Extracting events and partitioning them into buckets in batches of {batch_rows} rows...")
+    start_time = time.time()
+    n_written = 0
+
+    def event_batches():
+        nonlocal n_written
+        yield birth_events_df
+        for file_lf in raw_lfs:
+            # One raw file's windowed events are held at a time
+            events_df = windowed_observation_events(
+                cohort_observation_events(file_lf, windows_df["e_patid"]), windows_df
+            ).collect(engine="streaming")
+            n_written += events_df.height
+            for batch_df in events_df.iter_slices(batch_rows):
+                yield encode_codes(batch_df, code_vocabulary_df)
+
+    with MemoryMonitor(resource_budget(RESOURCES)['memory_gb']) as monitor:
+        buckets = partition_to_buckets(event_batches(), bounds, spill_dir, max_held_bytes(sort_memory_gb),
+                                       id_col="subject_idx", monitor=monitor)
+
+        # --- 5. Sort Each Bucket and Save the Sorted Output ---
+        print(f"Step 5: Sorting buckets and writing sorted intermediate files to: {output_dir}")
+        sort_buckets(buckets, output_dir, sort_subject_events, max_workers=sort_workers, monitor=monitor,
+                     id_col="subject_idx")
+    remove_spill_dir(spill_dir)
+    build_row_group_index(output_dir, SORTED_PARTS_GLOB, "subject_idx")
+
+    print(f"  - Events written: {n_written} (+ {birth_events_df.height} birth events)")
+    print(f'Finished extraction and sort in: {time.time() - start_time:.2f} seconds')
+    print("--- Stage 3a+3b COMPLETE ---")
+
+
+if __name__ == '__main__':
+    extract_sorted_events('config.yaml')
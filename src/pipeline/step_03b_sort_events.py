@@ -2,95 +2,146 @@
 
 import polars as pl
 import yaml
+import glob
 from pathlib import Path
 import time
 
-def sort_events(config_path: str):
+from src.utils.external_sort import (
+    uncompressed_bytes_per_row, rows_per_bucket, plan_bucket_bounds,
+    iter_parquet_batches, max_held_bytes, partition_to_buckets, sort_buckets, remove_spill_dir,
+)
+from src.utils.resource_plan import resource_budget, plan_sort, plan_batch_rows, MemoryMonitor
+from src.utils.row_group_index import build_row_group_index
+from src.utils.event_schema import (
+    UNSORTED_EVENT_SCHEMA, SORTED_EVENT_SCHEMA, BIRTH_CODE_ID, SORTED_PARTS_GLOB,
+    subject_index, build_code_vocabulary, encode_codes, write_vocabularies,
+)
+
+
+def sort_subject_events(events_df: pl.DataFrame) -> pl.DataFrame:
     """
-    Stage 3b: Adds BIRTH events and performs an out-of-core sort on all events.
-    
-    Sorting order for each subject:
+    Sorts compact events by subject, then:
     1. The BIRTH event.
     2. Any events with a null timestamp.
     3. All remaining events in chronological order.
     """
+    # Priority 0: The MEDS_BIRTH event
+    # Priority 1: Any event where the timestamp is null
+    # Priority 2: All other events
+    custom_sort_key = (
+        pl.when(pl.col("code_id") == BIRTH_CODE_ID).then(0)
+        .when(pl.col("time").is_null()).then(1)
+        .otherwise(2)
+        .alias("_sort_priority")
+    )
+    return events_df.with_columns(custom_sort_key) \
+        .sort("subject_idx", "_sort_priority", "time") \
+        .drop("_sort_priority")
+
+
+def make_birth_events(subjects_df: pl.DataFrame, subject_index_df: pl.DataFrame) -> pl.DataFrame:
+    """One MEDS_BIRTH event (1 January of the year of birth) per subject, in SORTED_EVENT_SCHEMA."""
+    return subjects_df.join(subject_index_df, on="subject_id", how="inner").select(
+        pl.col("subject_idx"),
+        time=pl.date(pl.col("yob"), 1, 1),
+        code_id=pl.lit(BIRTH_CODE_ID),
+        numeric_value=pl.lit(None),
+        numunitid=pl.lit(None)
+    ).cast(SORTED_EVENT_SCHEMA)
+
+
+def sort_events(config_path: str):
+    """
+    Stage 3b: Adds BIRTH events and performs an out-of-core sort on all events.
+
+    The sort is external: events are range-partitioned by subject_idx into
+    buckets small enough to sort within the planned sort memory in one
+    streaming pass, then each bucket is sorted on its own (several at a time)
+    and written as part_NNNNN.parquet. Buckets stay in memory while they fit
+    the sort memory and are spilled to disk only past it or when memory use
+    nears resources.max_memory_gb. Buckets cover increasing subject ID ranges,
+    so the parts in file name order are globally sorted and the whole dataset
+    is never held in memory.
+
+    Events are kept in the compact SORTED_EVENT_SCHEMA: codes are stored as
+    code_ids into code_vocabulary.parquet and subjects as subject_idx into
+    subject_index.parquet, both written next to the parts.
+    """
     print("--- Running Stage 3b: Add Birth Events & Sort ---")
-    
+
     with open(config_path, 'r') as f:
         config = yaml.safe_load(f)
     STUDY_PARAMS = config['study_params']
     cancer_type = STUDY_PARAMS['cancer_type']
     PATHS = {key: val.format(cancer_type=cancer_type) for key, val in config['paths'].items()}
     OUTPUTS = {key: val.format(cancer_type=cancer_type) for key, val in config['outputs'].items()}
+    RESOURCES = config.get('resources', {})
+    sort_memory_gb, sort_workers = plan_sort(RESOURCES)
 
     # --- 1. Load Data Sources ---
     print("Step 1: Loading unsorted events and subject information...")
-    # Scan the unsorted medical events from Stage 3a
-    unsorted_events_lf = pl.scan_parquet(f"{OUTPUTS['intermediate_unsorted_dir']}/*.parquet") \
-                           .rename({"e_patid": "subject_id"}) \
-                           .select([    
-                              "subject_id", 
-                              "time", 
-                              "code", 
-                              "numeric_value", 
-                              "numunitid"
-                           ])
-
-    # Scan the subject info file to get the year of birth (yob)
-    subjects_lf = pl.scan_csv(OUTPUTS['subject_information_file'])
+    # The unsorted medical events from Stage 3a, one file per raw observation file
+    unsorted_files = sorted(glob.glob(f"{OUTPUTS['intermediate_unsorted_dir']}/*.parquet"))
+    unsorted_events_lf = pl.scan_parquet(unsorted_files).select(list(UNSORTED_EVENT_SCHEMA))
+
+    # Read the subject info file to get the year of birth (yob)
+    subjects_df = pl.read_csv(OUTPUTS['subject_information_file'])
+    subject_index_df = subject_index(subjects_df)
 
     # --- 2. Create MEDS_BIRTH Events ---
     print("Step 2: Creating MEDS_BIRTH events...")
-    birth_events_lf = subjects_lf.select(
-        pl.col("subject_id"),
-        pl.col("yob")
-    ).with_columns(
-        time=pl.date(pl.col("yob"), 1, 1),
-        code=pl.lit("MEDS_BIRTH"),
-        numeric_value=pl.lit(None, dtype=pl.Float64),
-        numunitid=pl.lit(None, dtype=pl.Int64)
-    ).drop("yob")
-
-    # --- 3. Combine All Events ---
-    print("Step 3: Combining birth events and medical events...")
-    all_events_lf = pl.concat([
-        unsorted_events_lf,
-        birth_events_lf
-    ])
-    
-    # --- 4. Define the Custom Multi-Level Sort Key ---
-    print("Step 4: Defining custom sort priority...")
-    # Priority 0: The MEDS_BIRTH event
-    # Priority 1: Any event where the timestamp is null
-    # Priority 2: All other events
-    custom_sort_key = (
-        pl.when(pl.col("code") == "MEDS_BIRTH").then(0)
-        .when(pl.col("time").is_null()).then(1)
-        .otherwise(2)
-        .alias("_sort_priority")
-    )
-    
-    # --- 5. Apply the Sort ---
-    print("Step 5: Sorting all events...")
-    sorted_lf = all_events_lf.with_columns(custom_sort_key) \
-        .sort("subject_id", "_sort_priority", "time") \
-        .drop("_sort_priority")
+    birth_events_df = make_birth_events(subjects_df, subject_index_df)
+
+    # --- 3. Plan Subject Range Buckets and Build the Code Vocabulary ---
+    print("Step 3: Planning sort buckets and building the code vocabulary...")
+    event_counts, medcodeids = pl.collect_all([
+        unsorted_events_lf.group_by("subject_idx").agg(n_rows=pl.len()),
+        unsorted_events_lf.select(pl.col("medcodeid").unique()),
+    ], engine="streaming")
+    subject_counts = pl.concat([
+        event_counts.cast({"n_rows": pl.UInt32}),
+        birth_events_df.group_by("subject_idx").agg(n_rows=pl.len()),
+    ]).group_by("subject_idx").agg(pl.col("n_rows").sum())
+    code_vocabulary_df = build_code_vocabulary(medcodeids["medcodeid"])
+    bytes_per_row = uncompressed_bytes_per_row(unsorted_files)
+    max_rows = rows_per_bucket(bytes_per_row, sort_memory_gb, sort_workers)
+    batch_rows = plan_batch_rows(RESOURCES, bytes_per_row)
+    bounds = plan_bucket_bounds(subject_counts, max_rows, id_col="subject_idx")
+    print(f"  - {subject_counts['n_rows'].sum()} events for {subject_counts.height} subjects, {code_vocabulary_df.height} distinct codes")
+    print(f"  - {len(bounds) + 1} bucket(s) of at most {max_rows} rows ({sort_memory_gb:.1f} GB budget, {sort_workers} worker(s))")
 
-    # --- 6. Save the Sorted Output ---
+    # --- 4. Partition Events into Subject Range Buckets ---
     output_dir = Path(OUTPUTS['intermediate_sorted_dir'])
     output_dir.mkdir(parents=True, exist_ok=True)
-    
-    print(f"Writing sorted intermediate file to: {output_dir}")
+    # Remove outputs of earlier runs so stage 3c never reads stale files
+    for old_file in output_dir.glob("*.parquet"):
+        old_file.unlink()
+    write_vocabularies(output_dir, subject_index_df, code_vocabulary_df)
+    spill_dir = output_dir / "_spill"
+    remove_spill_dir(spill_dir)
+
+    print(f"Step 4: Partitioning events into buckets in batches of {batch_rows} rows...")
     start_time = time.time()
-    sorted_lf.sink_parquet(
-        pl.PartitionMaxSize(
-            output_dir,
-            max_size=100_000,
-        )
-    )
-    end_time = time.time()
+
+    def event_batches():
+        yield birth_events_df
+        for batch_df in iter_parquet_batches(unsorted_files, columns=list(UNSORTED_EVENT_SCHEMA), batch_rows=batch_rows):
+            yield encode_codes(batch_df, code_vocabulary_df)
+
+    with MemoryMonitor(resource_budget(RESOURCES)['memory_gb']) as monitor:
+        buckets = partition_to_buckets(event_batches(), bounds, spill_dir, max_held_bytes(sort_memory_gb),
+                                       id_col="subject_idx", monitor=monitor)
+        n_buckets = len(buckets)
+
+        # --- 5. Sort Each Bucket and Save the Sorted Output ---
+        print(f"Step 5: Sorting buckets and writing sorted intermediate files to: {output_dir}")
+        sort_buckets(buckets, output_dir, sort_subject_events, max_workers=sort_workers, monitor=monitor,
+                     id_col="subject_idx")
+    remove_spill_dir(spill_dir)
+    build_row_group_index(output_dir, SORTED_PARTS_GLOB, "subject_idx")
+    print(f"  - Sorted {n_buckets} bucket(s) in {time.time() - start_time:.2f} seconds")
 
     print("--- Stage 3b COMPLETE ---")
 
 if __name__ == '__main__':
-    sort_events('config.yaml')
\ No newline at end of file
+    sort_events('config.yaml')
@@ -1,13 +1,54 @@
 # src/pipeline/step_03c_process_events.py
 
 import polars as pl
+import pyarrow.parquet as pq
 import yaml
 from pathlib import Path
 import os 
 import glob
 import time
 
-from src.utils.mapping_setup import map_all_codes
+from src.utils.mapping_setup import map_code_vocabulary
+from src.utils.event_schema import (
+    BIRTH_CODE, CODE_COLUMNS, SORTED_PARTS_GLOB, SUBJECT_INDEX_FILE, CODE_VOCABULARY_FILE, render_code,
+)
+from src.utils.dedup_rules import DEFAULT_DEDUP_RULES, load_dedup_rules, tag_dedup_rules, apply_dedup_rules
+from src.utils.event_shards import EventShardWriter, SHARD_SIZE
+from src.utils.row_group_index import load_row_group_index
+from src.utils.resource_plan import plan_shard_size
+
+def event_sort_key() -> pl.Expr:
+    """
+    One Int64 key with the output order of events: subject_idx, then MEDS_BIRTH,
+    events without a time, and the rest by date.
+    """
+    priority = pl.when(pl.col("code_type") == BIRTH_CODE).then(0) \
+        .when(pl.col("time").is_null()).then(1) \
+        .otherwise(2)
+    # Days since 1970 shifted to be non-negative (20 bits cover 1970 +/- 1400 years),
+    # then 2 bits of priority; subject_idx gets the remaining 41
+    days = (pl.col("time").cast(pl.Int32).cast(pl.Int64) + 2 ** 19).fill_null(0)
+    return pl.col("subject_idx").cast(pl.Int64) * 2 ** 22 + priority.cast(pl.Int64) * 2 ** 20 + days
+
+
+def drop_same_day_repeats(events_df: pl.DataFrame) -> pl.DataFrame:
+    """
+    Drops all but the first event of each (code_type, term) on the same subject
+    day, from events in _sort_key order. Only events that share their
+    _sort_key with a neighbour can be repeats; those are stably sorted by
+    code_type and term within the key, repeats are found by comparing each
+    row with the previous one, and the kept rows are merged back into place.
+    """
+    events_df = events_df.with_row_index("_row")
+    same_key = pl.col("_sort_key") == pl.col("_sort_key").shift(1)
+    shares_key = (same_key | (pl.col("_sort_key") == pl.col("_sort_key").shift(-1))).fill_null(False)
+
+    repeat_key = ["_sort_key", "code_type", "term"]
+    shared_df = events_df.filter(shares_key).sort(repeat_key, maintain_order=True)
+    is_repeat = pl.all_horizontal(pl.col(c).eq_missing(pl.col(c).shift(1)) for c in repeat_key)
+    kept_df = shared_df.filter(~is_repeat).sort("_row")
+    return events_df.filter(~shares_key).merge_sorted(kept_df, key="_row").drop("_row")
+
 
 def map_and_save_events(config_path: str):
     """
@@ -24,136 +65,126 @@ def map_and_save_events(config_path: str):
     cancer_type = CANCER_TYPE
     PATHS = {key: val.format(cancer_type=cancer_type) for key, val in config['paths'].items()}
     OUTPUTS = {key: val.format(cancer_type=cancer_type) for key, val in config['outputs'].items()}
-    
+    RESOURCES = config.get('resources', {})
 
-    sorted_events_lf = pl.scan_parquet(f"{OUTPUTS['intermediate_sorted_dir']}/*.parquet")
+    sorted_dir = OUTPUTS['intermediate_sorted_dir']
+    # Each sorted part holds a contiguous range of subjects
+    sorted_part_files = sorted(Path(sorted_dir).glob(SORTED_PARTS_GLOB))
+    subject_index_lf = pl.scan_parquet(f"{sorted_dir}/{SUBJECT_INDEX_FILE}")
+    code_vocabulary_df = pl.read_parquet(f"{sorted_dir}/{CODE_VOCABULARY_FILE}")
     subjects_lf = pl.scan_csv(OUTPUTS['subject_information_file']).select(["subject_id", "split", "cancerdate", "site"])
-
-    # --- 2. Isolate BIRTH events and prepare other events for mapping ---
-    print("Step 2: Isolating BIRTH events and preparing other events for mapping...")
-    birth_events_lf = sorted_events_lf.filter(pl.col('code') == "MEDS_BIRTH")
-    
-    events_to_map_lf = sorted_events_lf.filter(pl.col('code') != "MEDS_BIRTH") \
-        .with_columns(
-            raw_code=pl.col("code").str.extract(r"//(.*)$", 1)
-        )
-
-    # --- 3. Map All Other Event Codes ---
-    print("Step 3: Mapping all non-BIRTH event codes...")
-    mapped_lf = map_all_codes(events_to_map_lf, config)
-    
-    combined_events_lf = pl.concat([
-        birth_events_lf,
-        mapped_lf.select(pl.all().exclude('raw_code', 'codelist_mapped', 'icd10_mapped'))
-    ])
-
-    print("Step 3: Deduplicating lifestyle events (keeping first instance of each term)...")
-    
-    LIFESTYLE_TERMS = ["Non-drinker", "Drinker - unspecified", "Drinker - within limits", "Drinker - excess/disorder", "current or ex-smoker", "current smoker", "ex-smoker", "nicotine or tobacco use", "non-smoker"]
-    lifestyle_regex = "|".join(LIFESTYLE_TERMS)
-
-    combined_events_lf = combined_events_lf.with_columns(
-        numeric_value=pl.when(pl.col('code').str.contains(lifestyle_regex))
-                      .then(pl.lit(None, dtype=pl.Float64))
-                      .otherwise(pl.col('numeric_value'))
-    )
-
-    # Add a temporary column to identify the specific lifestyle term
-    events_with_shortcode_lf = combined_events_lf.with_columns(
-        _short_code=pl.col('code').str.extract(r"//(.*?//)", 1).fill_null("")
-    )
-
-    # Partition the data into lifestyle and other events
-    lifestyle_events_lf = events_with_shortcode_lf.filter(pl.col('_short_code').str.contains(lifestyle_regex))
-    other_events_lf = events_with_shortcode_lf.filter(~pl.col('_short_code').str.contains(lifestyle_regex))
-
-    # Deduplicate the lifestyle events partition, keeping the first occurrence of each term
-    deduplicated_lifestyle_lf = lifestyle_events_lf.unique(
-        subset=['subject_id', '_short_code'], keep='first'
-    )
-    
-    # Recombine the two partitions and drop the temporary column
-    final_cleaned_lf = pl.concat([other_events_lf, deduplicated_lifestyle_lf]) \
-        .drop('_short_code')
-    
-
-    # --- 4. Add Split Info, Collect, and Add Cancer Event ---
-    print("Step 4: Adding split information and collecting events...")
-    final_df = final_cleaned_lf.join(subjects_lf, on="subject_id", how="inner").collect()
-
-    # --- 5. Add a cancer diagnosis event for all cases ---
-    print("Step 5: Adding final cancer diagnosis events...")
-    cancer_cases = subjects_lf.filter(pl.col('cancerdate').is_not_null()).collect()
-    cancer_events = cancer_cases.select(
-        # Positional arguments first
-        pl.col('subject_id'),
-        pl.col('split'),
-        pl.col('cancerdate'),
-        pl.col('site'),
-        # Keyword arguments after
-        time=pl.col('cancerdate').str.to_datetime().cast(pl.Date),
-        code=pl.format(f"MEDICAL//{CANCER_TYPE}_cancer//"),
-        numeric_value=pl.lit(None, dtype=pl.Float64),
-        numunitid=pl.lit(None, dtype=pl.Int64)
-    )
-    
-    # Reorder columns to match before concatenating
-    cancer_events = cancer_events.select(final_df.columns)
-    final_df = pl.concat([final_df, cancer_events])
-
-    # --- 6. Perform Final Sort ---
-    print("Step 6: Performing final sort...")
-    sort_key = (
-        pl.when(pl.col("code") == "MEDS_BIRTH").then(0)
-        .when(pl.col("time").is_null()).then(1)
-        .otherwise(2)
-        .alias("_sort_priority")
-    )
-    # final_sorted_df = final_df.with_columns(sort_key).sort("subject_id", "_sort_priority", "time")
-
-    final_sorted_df = final_df.sort("time") \
-        .with_columns(
-            # Create a temporary 'short_code' for deduplication
-            _short_code=pl.when(pl.col('code').str.contains('//'))
-                          .then(pl.col('code').str.extract(r"^(.*?//.*?//)", 1))
-                          .otherwise(pl.col('code')) # Handles codes like 'BIRTH'
-        ) \
-        .unique(subset=['subject_id', 'time', '_short_code'], keep='first') \
-        .drop('_short_code') \
-        .with_columns(sort_key) \
-        .sort("subject_id", "_sort_priority", "time") # The final sort for output
-
-    # --- 7. Save Final Output Files ---
-    print("Step 7: Saving final event stream files in shards...")
+    if not PATHS.get('dedup_rules'):
+        print(f"Warning: No dedup_rules configured; using the default rules in {DEFAULT_DEDUP_RULES}.")
+    dedup_rules_df = load_dedup_rules(PATHS.get('dedup_rules'))
+
+    # --- 2. Map the distinct codes once ---
+    # The structured code columns and the dedup rule tags of each term are
+    # computed here on ~100k distinct codes, and joined back to the events by
+    # code_id, so no string work is done per event
+    print("Step 2: Mapping the distinct codes of the code vocabulary...")
+    mapped_codes_df = tag_dedup_rules(map_code_vocabulary(code_vocabulary_df, config), dedup_rules_df)
+    print(f"  - {dedup_rules_df.height} terms have dedup rules")
+
+    # --- 3. Prepare the cancer diagnosis events of all cases ---
+    print("Step 3: Preparing final cancer diagnosis events...")
+    subjects_df = subjects_lf.select("subject_id", "split").collect()
+    subject_index_df = subject_index_lf.collect()
+    cancer_events_df = subjects_lf.filter(pl.col('cancerdate').is_not_null()).collect() \
+        .join(subject_index_df, on="subject_id", how="inner") \
+        .select(
+            "subject_idx",
+            "subject_id",
+            time=pl.col('cancerdate').str.to_datetime().cast(pl.Date),
+            code_type=pl.lit("MEDICAL", dtype=CODE_COLUMNS["code_type"]),
+            term=pl.lit(f"{CANCER_TYPE}_cancer", dtype=CODE_COLUMNS["term"]),
+            source_code=pl.lit(None, dtype=CODE_COLUMNS["source_code"]),
+            source_vocab=pl.lit(None, dtype=CODE_COLUMNS["source_vocab"]),
+            numeric_value=pl.lit(None, dtype=pl.Float64),
+            numunitid=pl.lit(None, dtype=pl.Int64),
+        ).join(subjects_df, on="subject_id", how="inner") \
+        .with_columns(_sort_key=event_sort_key()) \
+        .sort("_sort_key")
+
+    # --- 4. Finalize one subject range at a time ---
+    # Each sorted part is already in output order: by subject, then MEDS_BIRTH,
+    # events without a time, and the rest by time. Within a part the dedup
+    # rules are applied, the cancer events are merged into place, and
+    # same-day repeats of a code are dropped, without sorting the whole part
+    def finalize_part(part_file, start_idx, end_idx):
+        part_df = pl.scan_parquet(part_file) \
+            .with_columns(has_value=pl.col("numeric_value").is_not_null()) \
+            .join(mapped_codes_df.lazy(), on=["code_id", "has_value"], how="inner", maintain_order="left") \
+            .join(subject_index_lf, on="subject_idx", how="left", maintain_order="left") \
+            .select(
+                "subject_idx",
+                "subject_id",
+                "time",
+                *CODE_COLUMNS,
+                numeric_value=pl.col('numeric_value').cast(pl.Float64),
+                numunitid=pl.col("numunitid").cast(pl.Int64),
+                _keep=pl.col('_keep'),
+                _drop_value=pl.col('_drop_value'),
+            )
+        part_df = apply_dedup_rules(part_df) \
+            .join(subjects_df.lazy(), on="subject_id", how="inner", maintain_order="left") \
+            .with_columns(_sort_key=event_sort_key()) \
+            .collect()
+        if (part_df["_sort_key"].diff() < 0).any():
+            print(f"Warning: {part_file} is not in subject/time order; sorting it.")
+            part_df = part_df.sort("_sort_key", maintain_order=True)
+
+        cancer_part_df = cancer_events_df.filter(pl.col("subject_idx").is_between(start_idx, end_idx, closed="left"))
+        # A linear merge of two inputs sorted on the same key; ties keep the part's event first
+        merged_df = part_df.merge_sorted(cancer_part_df.select(part_df.columns), key="_sort_key")
+        return drop_same_day_repeats(merged_df).drop("subject_idx", "_sort_key")
+
+    # The parts cover increasing subject ranges; a part's range runs up to the next part's first subject.
+    # Empty parts have no row groups in the index; they hold no events and get no range, so they
+    # cannot cut the previous part's range short. A part without statistics is scanned for its start.
+    part_starts = load_row_group_index(sorted_dir, SORTED_PARTS_GLOB, "subject_idx") \
+        .group_by("file").agg(pl.col("min_id").min())
+    part_starts = dict(part_starts.iter_rows())
+    sorted_part_files = [f for f in sorted_part_files if f.name in part_starts]
+    range_starts = [
+        part_starts[f.name] if part_starts[f.name] is not None
+        else pl.scan_parquet(f).select(pl.col("subject_idx").min()).collect().item()
+        for f in sorted_part_files
+    ]
+    if range_starts:
+        range_starts[0] = -1
+    range_ends = range_starts[1:] + [2 ** 31]
+
+    # --- 5. Save Final Output Files ---
+    print(f"Step 5: Finalizing {len(sorted_part_files)} subject range(s) and saving subject-aligned shards...")
     output_base_dir = OUTPUTS['event_stream_dir']
-    split_map = {'train': 'train', 'val': 'tuning', 'test': 'held_out'}
-    SHARD_SIZE = 1000
-    for subdir in split_map.values():
-        os.makedirs(os.path.join(output_base_dir, subdir), exist_ok=True)
-
-    for (split_name,), split_data in final_sorted_df.group_by('split'):
-        if split_name not in split_map:
-            continue
-        print(f"Processing '{split_name}' split...")
-        output_dir = os.path.join(output_base_dir, split_map[split_name])
-        subject_ids = split_data.get_column('subject_id').unique().to_list()
-        
-        for i in range(0, len(subject_ids), SHARD_SIZE):
-            shard_number = i // SHARD_SIZE
-            subject_id_chunk = subject_ids[i : i + SHARD_SIZE]
-            shard_data = split_data.filter(pl.col('subject_id').is_in(subject_id_chunk))
-            data_to_write = shard_data.select(
-                pl.col("subject_id"),
-                pl.col("time").cast(pl.Datetime(time_unit="us")),
-                pl.col("code"),
-                # pl.col("numeric_value").cast(pl.Float32).alias("value"),
-                pl.col("numeric_value").cast(pl.Float32),
-                pl.lit(None, dtype=pl.Utf8).alias("text_value"),
-                pl.col("numunitid").cast(pl.Int64)
+    # The MEDS columns with the rendered code string, then the structured code columns
+    output_columns = [
+        pl.col("subject_id"),
+        pl.col("time").cast(pl.Datetime(time_unit="us")),
+        render_code(),
+        # pl.col("numeric_value").cast(pl.Float32).alias("value"),
+        pl.col("numeric_value").cast(pl.Float32),
+        pl.lit(None, dtype=pl.Utf8).alias("text_value"),
+        pl.col("numunitid").cast(pl.Int64),
+        *[pl.col(c) for c in CODE_COLUMNS],
+    ]
+    writer = None
+    for part_file, start_idx, end_idx in zip(sorted_part_files, range_starts, range_ends):
+        final_df = finalize_part(part_file, start_idx, end_idx)
+        if writer is None:
+            # Stage 5 cleans one shard at a time, so size the shards to fit the memory
+            # budget, from the sorted parts' row count and the first range's row size
+            n_rows = sum(pq.ParquetFile(f).metadata.num_rows for f in sorted_part_files)
+            shard_size = plan_shard_size(
+                RESOURCES, n_rows, subject_index_df.height,
+                final_df.estimated_size() / max(1, final_df.height), SHARD_SIZE,
             )
-            output_path = os.path.join(output_dir, f"shard_{shard_number}.parquet")
-            print(f"  -> Saving shard {shard_number} with {len(subject_id_chunk)} subjects to {output_path}")
-            data_to_write.write_parquet(output_path)
+            print(f"  - {shard_size} subjects per shard")
+            writer = EventShardWriter(output_base_dir, output_columns, shard_size)
+        writer.add(final_df)
+    if writer is None:
+        writer = EventShardWriter(output_base_dir, output_columns)
+    writer.close()
 
     print(f"\nFinal event stream files saved to: {output_base_dir}")
     print("-" * 50)
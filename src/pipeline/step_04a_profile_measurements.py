@@ -1,6 +1,8 @@
 import polars as pl
 import yaml
 
+from src.utils.event_schema import term_identifier
+
 def profile_measurements(config_path: str):
     """
     Scans the event stream to produce a summary of all
@@ -27,8 +29,8 @@ def profile_measurements(config_path: str):
         pl.col('numeric_value').is_not_null() &
         pl.col('numunitid').is_not_null()
     ).with_columns(
-        # Extract the term (e.g., 'Hemoglobin' or '42W..00') from the code
-        identifier=pl.col('code').str.extract(r"//(.*?//)", 1).str.replace_all("/", "")
+        # The term of the code without '/' (e.g., 'Hemoglobin' or '42W..00')
+        identifier=term_identifier()
     )
 
     # --- 3. Group by Identifier and Unit, then Calculate Stats ---
@@ -3,11 +3,98 @@ import yaml
 import os
 import csv
 import pandas as pd
+import threading
+
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import nullcontext
+from pathlib import Path
+
+from src.utils.event_shards import (
+    SPLIT_DIRS, clear_event_shards, write_subject_aligned_parquet, write_shard_index,
+)
+from src.utils.event_schema import CODE_COLUMNS, term_identifier
+from src.utils.resource_plan import resource_budget, plan_shard_workers, MemoryMonitor
+
+
+def partition_events(events_lf: pl.LazyFrame) -> tuple:
+    """Splits events into (other, medical with value, LAB, MEASUREMENT) streams."""
+    # Isolate events that need cleaning (must have a numeric value)
+    events_with_value_lf = events_lf.filter(pl.col('numeric_value').is_not_null())
+    other_events_lf = events_lf.filter(pl.col('numeric_value').is_null())
+
+    lab_events_lf = events_with_value_lf.filter(pl.col('code_type') == "LAB")
+    measurement_events_lf = events_with_value_lf.filter(pl.col('code_type') == "MEASUREMENT")
+    # Any other events with values that aren't LAB or MEASUREMENT will be passed through
+    medical_value_events_lf = events_with_value_lf.filter(~pl.col('code_type').is_in(["LAB", "MEASUREMENT"]))
+    return other_events_lf, medical_value_events_lf, lab_events_lf, measurement_events_lf
+
+
+def measurement_stats(events_lf: pl.LazyFrame) -> pl.DataFrame:
+    """Median and standard deviation of every MEASUREMENT test across the whole event stream."""
+    _, _, _, measurement_events_lf = partition_events(events_lf)
+    return measurement_events_lf.group_by(Identifier=term_identifier()).agg(
+        pl.median('numeric_value').alias('median'),
+        pl.std('numeric_value').alias('std')
+    ).collect(engine="streaming")
+
+
+def clean_shard(events_lf: pl.LazyFrame, lab_rules_df: pl.DataFrame, stats_df: pl.DataFrame) -> pl.DataFrame:
+    """Applies the LAB rules and MEASUREMENT outlier bounds to one shard of events."""
+    other_events_lf, medical_value_events_lf, lab_events_lf, measurement_events_lf = partition_events(events_lf)
+
+    # --- LAB stream (curated cleaning) ---
+    cleaned_lab_lf = lab_events_lf.join(
+        lab_rules_df.lazy(),
+        left_on=[term_identifier(), "numunitid"],
+        right_on=["Identifier", "UnitID"],
+        how="left"
+    ).with_columns(
+        # Apply the linear transformation
+        standardized_value = (pl.col('numeric_value') * pl.col('ConversionFactor')) + pl.col('ConversionBias').fill_null(0)
+    ).with_columns(
+        # Set values outside the valid range to null
+        cleaned_value=pl.when(
+            pl.col('standardized_value').is_between(pl.col('ValidMin'), pl.col('ValidMax'))
+        ).then(pl.col('standardized_value')).otherwise(pl.lit(None))
+    ).select(
+        pl.col("subject_id"), pl.col("time"), pl.col("code"),
+        pl.col("cleaned_value").alias("numeric_value"), # Replace original value
+        pl.col("text_value"), pl.col("numunitid"), *[pl.col(c) for c in CODE_COLUMNS]
+    )
+
+    # --- MEASUREMENT stream (automated cleaning): join the global stats and filter outliers ---
+    cleaned_measurement_lf = measurement_events_lf.join(
+        stats_df.lazy(), left_on=term_identifier(), right_on='Identifier', how='left'
+    ).with_columns(
+        lower_bound = pl.max_horizontal(0, pl.col('median') - 3 * pl.col('std')),
+        upper_bound = pl.col('median') + 3 * pl.col('std')
+    ).filter(
+        pl.col('numeric_value').is_between(pl.col('lower_bound'), pl.col('upper_bound'))
+    ).select(
+        pl.col("subject_id"), pl.col("time"), pl.col("code"), pl.col("numeric_value"),
+        pl.col("text_value"), pl.col("numunitid"), *[pl.col(c) for c in CODE_COLUMNS]
+    )
+
+    # --- Recombine ---
+    return pl.concat(pl.collect_all([
+        other_events_lf,
+        medical_value_events_lf,
+        cleaned_lab_lf,
+        cleaned_measurement_lf
+    ])).sort("subject_id", "time")
+
+
 
 def clean_events(config_path: str):
     """
     Final cleaning stage: Applies curated rules to LAB tests and automated
     outlier detection to MEASUREMENT tests.
+
+    The MEASUREMENT statistics are computed over the whole event stream in one
+    streaming pass; every event stream shard is then cleaned on its own and
+    written to the same shard path under final_cleaned_dir, so memory use is
+    bounded by the shard size. Shards are cleaned in parallel, as many at once
+    as the resource planner fits into resources.max_memory_gb.
     """
     print("--- Running Final Stage: Clean & Standardize Events ---")
     
@@ -20,8 +107,10 @@ def clean_events(config_path: str):
     cancer_type = STUDY_PARAMS['cancer_type']
     PATHS = {key: val.format(cancer_type=cancer_type) for key, val in config['paths'].items()}
     OUTPUTS = {key: val.format(cancer_type=cancer_type) for key, val in config['outputs'].items()}
+    RESOURCES = config.get('resources', {})
     
-    events_lf = pl.scan_parquet(f"{OUTPUTS['event_stream_dir']}/**/*.parquet")
+    input_base_dir = OUTPUTS['event_stream_dir']
+    events_lf = pl.scan_parquet(f"{input_base_dir}/**/*.parquet")
     try:
         rules_df_pd = pd.read_csv(PATHS['cleaning_rules_final'])
         
@@ -43,113 +132,45 @@ def clean_events(config_path: str):
         # In a real run, you might want to exit or handle this differently
         return
 
-    # --- 2. Partition the Event Stream ---
-    print("Step 2: Partitioning event stream into LAB, MEASUREMENT, and OTHER...")
-    
-    # Isolate events that need cleaning (must have a numeric value)
-    events_with_value_lf = events_lf.filter(pl.col('numeric_value').is_not_null())
-    other_events_lf = events_lf.filter(pl.col('numeric_value').is_null())
-
-    lab_events_lf = events_with_value_lf.filter(pl.col('code').str.starts_with("LAB//"))
-    measurement_events_lf = events_with_value_lf.filter(pl.col('code').str.starts_with("MEASUREMENT//"))
-    # Any other events with values that aren't LAB or MEASUREMENT will be passed through
-    medical_value_events_lf = events_with_value_lf.filter(
-        ~pl.col('code').str.starts_with("LAB//") & ~pl.col('code').str.starts_with("MEASUREMENT//")
-    )
-
-    # --- 3. Process the LAB Stream (Curated Cleaning) ---
-    print("Step 3: Applying curated rules to LAB tests...")
-    
-    # Prepare the rules lookup table
-    lab_rules_df = rules_df.filter(pl.col("IdentifierType") == "MedicalTerm")
-
-    cleaned_lab_lf = lab_events_lf.with_columns(
-        Identifier=pl.col('code').str.extract(r"//(.*?//)", 1).str.replace_all("/", "")
-    ).join(
-        lab_rules_df.lazy(),
-        left_on=["Identifier", "numunitid"],
-        right_on=["Identifier", "UnitID"],
-        how="left"
-    ).with_columns(
-        # Apply the linear transformation
-        standardized_value = (pl.col('numeric_value') * pl.col('ConversionFactor')) + pl.col('ConversionBias').fill_null(0)
-    ).with_columns(
-        # Set values outside the valid range to null
-        cleaned_value=pl.when(
-            pl.col('standardized_value').is_between(pl.col('ValidMin'), pl.col('ValidMax'))
-        ).then(pl.col('standardized_value')).otherwise(pl.lit(None))
-    ).select(
-        pl.col("subject_id"), pl.col("time"), pl.col("code"),
-        pl.col("cleaned_value").alias("numeric_value"), # Replace original value
-        pl.col("text_value"), pl.col("numunitid")
-    )
-    
-    # --- 4. Process the MEASUREMENT Stream (Automated Cleaning) ---
-    print("Step 4: Applying automated outlier detection to MEASUREMENT tests...")
+    # Prepare the rules lookup table, keyed by the events' term without '/' (term_identifier)
+    lab_rules_df = rules_df.filter(pl.col("IdentifierType") == "MedicalTerm") \
+        .with_columns(pl.col("Identifier").cast(pl.String))
 
-    # First, calculate stats (median, std) for each measurement group
-    stats_lf = measurement_events_lf.with_columns(
-        Identifier=pl.col('code').str.extract(r"//(.*?//)", 1).str.replace_all("/", "")
-    ).group_by('Identifier').agg(
-        pl.median('numeric_value').alias('median'),
-        pl.std('numeric_value').alias('std')
-    )
-
-    # Join stats back and filter outliers
-    cleaned_measurement_lf = measurement_events_lf.with_columns(
-        Identifier=pl.col('code').str.extract(r"//(.*?//)", 1).str.replace_all("/", "")
-    ).join(
-        stats_lf, on='Identifier', how='left'
-    ).with_columns(
-        lower_bound = pl.max_horizontal(0, pl.col('median') - 3 * pl.col('std')),
-        upper_bound = pl.col('median') + 3 * pl.col('std')
-    ).filter(
-        pl.col('numeric_value').is_between(pl.col('lower_bound'), pl.col('upper_bound'))
-    ).select(
-        pl.col("subject_id"), pl.col("time"), pl.col("code"), pl.col("numeric_value"),
-        pl.col("text_value"), pl.col("numunitid")
-              
-    )
+    # --- 2. MEASUREMENT Statistics over the Whole Event Stream ---
+    print("Step 2: Calculating MEASUREMENT statistics for outlier detection...")
+    stats_df = measurement_stats(events_lf)
 
-    # --- 5. Recombine and Save ---
-    print("Step 5: Recombining all streams and saving final output...")
-    
-    # Collect all parts. Using .collect() on each lazy frame before concat.
-    final_df = pl.concat([
-        other_events_lf.collect(),
-        medical_value_events_lf.collect(),
-        cleaned_lab_lf.collect(),
-        cleaned_measurement_lf.collect()
-    ]).sort("subject_id", "time")
-    
+    # --- 3. Clean and Save Each Shard ---
     # Get split info for saving
     subjects_df = pl.read_csv(OUTPUTS['subject_information_file']).select(["subject_id", "split"])
-    final_df = final_df.join(subjects_df, on="subject_id", how="inner")
-
     output_base_dir = OUTPUTS['final_cleaned_dir']
-    split_map = {'train': 'train', 'val': 'tuning', 'test': 'held_out'}
-    SHARD_SIZE = 1000
-    for subdir in split_map.values():
-        os.makedirs(os.path.join(output_base_dir, subdir), exist_ok=True)
-
-    for (split_name,), split_data in final_df.group_by('split'):
-        if split_name not in split_map: continue
-        print(f"Processing '{split_name}' split...")
-        output_dir = os.path.join(output_base_dir, split_map[split_name])
-        subject_ids = split_data.get_column('subject_id').unique().to_list()
-        
-        for i in range(0, len(subject_ids), SHARD_SIZE):
-            shard_number = i // SHARD_SIZE
-            subject_id_chunk = subject_ids[i : i + SHARD_SIZE]
-            shard_data = split_data.filter(pl.col('subject_id').is_in(subject_id_chunk))
-            
+    shard_files = [
+        (split_name, f"{subdir}/{path.name}")
+        for split_name, subdir in SPLIT_DIRS.items()
+        for path in sorted(Path(input_base_dir, subdir).glob("shard_*.parquet"))
+    ]
+    workers = plan_shard_workers(RESOURCES, [os.path.join(input_base_dir, f) for _, f in shard_files])
+    print(f"Step 3: Cleaning {len(shard_files)} shard(s) with {workers} worker(s) (LAB rules, MEASUREMENT outliers)...")
+    clear_event_shards(output_base_dir)
+    # Shards whose memory use does not recover are cleaned one at a time
+    one_at_a_time = threading.Lock()
+
+    def clean_one(shard):
+        split_name, shard_file = shard
+        with nullcontext() if monitor.wait_for_headroom() else one_at_a_time:
+            final_df = clean_shard(pl.scan_parquet(os.path.join(input_base_dir, shard_file)), lab_rules_df, stats_df) \
+                .join(subjects_df, on="subject_id", how="inner", maintain_order="left")
+            output_path = os.path.join(output_base_dir, shard_file)
+            print(f"  -> Saving cleaned shard to {output_path}")
             # Select final columns for output
-            data_to_write = shard_data.select(
-                "subject_id", "time", "code", "numeric_value", "text_value"
-            )
-            output_path = os.path.join(output_dir, f"shard_{shard_number}.parquet")
-            print(f"  -> Saving cleaned shard {shard_number} to {output_path}")
-            data_to_write.write_parquet(output_path)
+            return write_subject_aligned_parquet(
+                final_df.select("subject_id", "time", "code", "numeric_value", "text_value"), output_path
+            ).with_columns(split=pl.lit(split_name), shard=pl.lit(shard_file))
+
+    with MemoryMonitor(resource_budget(RESOURCES)['memory_gb']) as monitor, \
+            ThreadPoolExecutor(max_workers=workers) as pool:
+        index_parts = list(pool.map(clean_one, shard_files))
+    write_shard_index(index_parts, output_base_dir)
     
     print(f"\nFinal cleaned event stream files saved to: {output_base_dir}")
     print("-" * 50)
@@ -2,8 +2,17 @@
 
 import polars as pl
 import yaml
-from src.utils.mapping_setup import  expand_codes
-import pandas as pd
+from src.utils.mapping_setup import compile_code_mapping, MAPPING_RULES, MAPPING_READ_ERRORS
+from src.utils.medcode_index import build_medcode_index, medcode_counts
+from src.utils.event_schema import CODE_VOCABULARY_FILE, BIRTH_CODE_ID
+
+RULE_LABELS = {
+    "medcodes": "Mapped by primary 'medcodes' list",
+    "ReadcodeList": "Mapped by 'ReadcodeList' fallback",
+    "medcodes2": "Mapped by 'medcodes2' fallback",
+    "read_chapter": "Fell back to just a Read Code",
+    "unmapped": "Remained completely unmapped",
+}
 
 def analyze_coverage(config_path: str):
     """
@@ -18,78 +27,66 @@ def analyze_coverage(config_path: str):
     PATHS = config['paths']
     OUTPUTS = config['outputs']
 
-    print("Step 1: Getting a sample of unique raw codes from your data...")
-    raw_codes_to_check_lf = pl.scan_parquet(f"{OUTPUTS['intermediate_sorted_dir']}/*.parquet") \
-        .filter(pl.col('code') != "MEDS_BIRTH") \
-        .select(
-            raw_code=pl.col("code").str.extract(r"//(.*)$", 1)
-        ) \
-        .drop_nulls() \
-        .unique() \
-        .head(100_000)
-        
-    df_codes_to_check = raw_codes_to_check_lf.collect()
+    if PATHS.get('ingest_cache_dir') and PATHS.get('medcode_index_dir'):
+        # Every code in the raw release, with how many observation rows use it
+        print("Step 1: Getting all raw codes and their row counts from the medcode index...")
+        index_dir = build_medcode_index(PATHS['observation_data_dir'], PATHS['ingest_cache_dir'], PATHS['medcode_index_dir'])
+        df_codes_to_check = medcode_counts(index_dir) \
+            .select(pl.col('medcodeid').alias('raw_code'), pl.col('n_rows')) \
+            .drop_nulls('raw_code')
+    else:
+        print("Step 1: Getting a sample of unique raw codes from your data...")
+        raw_codes_to_check_lf = pl.scan_parquet(f"{OUTPUTS['intermediate_sorted_dir']}/{CODE_VOCABULARY_FILE}") \
+            .filter(pl.col('code_id') != BIRTH_CODE_ID) \
+            .select(
+                raw_code=pl.col("medcodeid").cast(pl.Utf8)
+            ) \
+            .drop_nulls() \
+            .head(100_000)
+            
+        df_codes_to_check = raw_codes_to_check_lf.collect()
     total_codes = len(df_codes_to_check)
     if total_codes == 0:
         print("No codes found to analyze.")
         return
     print(f"Analyzing {total_codes} unique raw codes...")
 
-    # --- 2. Build the same mapping tables used in the pipeline ---
-    print("Step 2: Building the mapping tables...")
-
-    # --- FIX: Use the robust Pandas reader for the problematic codelist CSV ---
+    # --- 2. Load the same compiled mapping used in the pipeline ---
+    print("Step 2: Loading the compiled code mapping...")
     try:
-        codelists_pd = pd.read_csv(PATHS['cleaned_codelists'], skip_blank_lines=True)
-        codelists_pd.columns = codelists_pd.columns.str.strip()
-        codelists_lf = pl.from_pandas(codelists_pd).lazy()
-    except Exception as e:
+        code_mapping_lf = compile_code_mapping(
+            PATHS['cleaned_codelists'], PATHS['medical_dictionary'], PATHS.get('ingest_cache_dir')
+        )
+    except MAPPING_READ_ERRORS as e:
         print(f"FATAL: Could not read the codelist file: {e}")
         return
-    
-    # --- The rest of the logic uses the cleaned codelists_lf ---
-    map1_df = expand_codes(codelists_lf, "medcodes", "MedicalTerm").rename({"code": "raw_code", "MedicalTerm": "map1_term"}).unique(subset=['raw_code'], keep='first').collect()
-    medcode_to_readcode_df = pl.scan_csv(PATHS['medical_dictionary']).select(pl.col("MedCodeId").cast(pl.Utf8).alias("raw_code"), pl.col("OriginalReadCode").alias("read_code")).drop_nulls().unique(subset=['raw_code'], keep='first').collect()
-    map3_df = expand_codes(codelists_lf, "ReadcodeList", "MedicalTerm").rename({"code": "read_code", "MedicalTerm": "map3_term"}).unique(subset=['read_code'], keep='first').collect()
-    map4_df = expand_codes(codelists_lf, "medcodes2", "MedicalTerm").rename({"code": "raw_code", "MedicalTerm": "map4_term"}).unique(subset=['raw_code'], keep='first').collect()
 
-    # --- 3. Perform sequential joins to see where codes get mapped ---
-    print("Step 3: Joining mapping tables to the sample codes...")
+    # --- 3. Look up the rule that maps each code ---
+    print("Step 3: Joining the compiled mapping to the sample codes...")
     results_df = df_codes_to_check \
-        .join(map1_df, on="raw_code", how="left") \
-        .join(medcode_to_readcode_df, on="raw_code", how="left") \
-        .join(map3_df, on="read_code", how="left") \
-        .join(map4_df, on="raw_code", how="left")
+        .with_columns(medcodeid=pl.col("raw_code").cast(pl.Int64, strict=False)) \
+        .join(code_mapping_lf.select("medcodeid", "rule").collect(), on="medcodeid", how="left") \
+        .with_columns(rule=pl.col("rule").fill_null("unmapped"))
 
     # --- 4. Calculate and Print the Statistics ---
     print("\n--- MAPPING COVERAGE REPORT ---")
-    
-    map1_count = results_df.get_column("map1_term").is_not_null().sum()
-    print(f"Mapped by primary 'medcodes' list:      {map1_count:>6} (~{map1_count/total_codes:.1%})")
+    rule_counts = dict(results_df.get_column("rule").value_counts().iter_rows())
+    for rule in MAPPING_RULES + ["unmapped"]:
+        count = rule_counts.get(rule, 0)
+        print(f"{RULE_LABELS[rule] + ':':<38}{count:>6} (~{count/total_codes:.1%})")
+    print("---------------------------------\n")
 
-    map3_count = results_df.filter(
-        pl.col("map1_term").is_null() & pl.col("map3_term").is_not_null()
-    ).height
-    print(f"Mapped by 'ReadcodeList' fallback:    {map3_count:>6} (~{map3_count/total_codes:.1%})")
+    if 'n_rows' in results_df.columns:
+        # The same hierarchy, weighted by how many observation rows use each code
+        total_rows = results_df.get_column('n_rows').sum()
+        row_shares = results_df.with_columns(
+            rule=pl.col('rule').replace_strict(RULE_LABELS)
+        ).group_by('rule').agg(pl.col('n_rows').sum()).sort('n_rows', descending=True)
 
-    map4_count = results_df.filter(
-        pl.col("map1_term").is_null() &
-        pl.col("map3_term").is_null() &
-        pl.col("map4_term").is_not_null()
-    ).height
-    print(f"Mapped by 'medcodes2' fallback:       {map4_count:>6} (~{map4_count/total_codes:.1%})")
-    
-    readcode_fallback_count = results_df.filter(
-        pl.col("map1_term").is_null() &
-        pl.col("map3_term").is_null() &
-        pl.col("map4_term").is_null() &
-        pl.col("read_code").is_not_null()
-    ).height
-    print(f"Fell back to just a Read Code:        {readcode_fallback_count:>6} (~{readcode_fallback_count/total_codes:.1%})")
-    
-    unmapped_count = total_codes - (map1_count + map3_count + map4_count + readcode_fallback_count)
-    print(f"Remained completely unmapped:         {unmapped_count:>6} (~{unmapped_count/total_codes:.1%})")
-    print("---------------------------------\n")
+        print("--- ROW-WEIGHTED COVERAGE ---")
+        for rule, n_rows in row_shares.iter_rows():
+            print(f"{rule + ':':<38}{n_rows:>12} (~{n_rows/total_rows:.1%})")
+        print("---------------------------------\n")
 
 if __name__ == '__main__':
     analyze_coverage('config.yaml')
\ No newline at end of file
@@ -0,0 +1,33 @@
+# src/utils/cohort_filter.py
+
+import polars as pl
+
+
+def cohort_filter_expr(cohort_ids: pl.Series, id_col: str = "e_patid") -> pl.Expr:
+    """
+    True for rows whose subject is in `cohort_ids` (a sorted integer Series).
+
+    The min/max range check is evaluated first, so Parquet row groups wholly
+    outside the cohort's ID range are skipped using their statistics alone.
+    Only that range check uses the sort order; is_in tests the remaining rows
+    against a hash set of the IDs.
+    """
+    if cohort_ids.len() == 0:
+        return pl.lit(False)
+    return pl.col(id_col).is_between(cohort_ids.min(), cohort_ids.max()) & pl.col(id_col).is_in(cohort_ids)
+
+
+def sink_with_stats(events_lf: pl.LazyFrame, output_path: str, stats_lfs: list) -> dict:
+    """
+    Streams `events_lf` into `output_path` and evaluates the one-row
+    aggregations `stats_lfs` in the same query, so an input they share with
+    `events_lf` through .cache() is scanned once. Returns the aggregations
+    merged into one dict, plus the number of rows written as 'rows'.
+    """
+    events_lf = events_lf.cache()
+    _, *stats = pl.collect_all([
+        events_lf.sink_parquet(output_path, compression='snappy', lazy=True),
+        events_lf.select(rows=pl.len()),
+        *stats_lfs,
+    ], engine="streaming")
+    return {key: value for stats_df in stats for key, value in stats_df.row(0, named=True).items()}
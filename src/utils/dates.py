@@ -0,0 +1,40 @@
+# src/utils/dates.py
+
+import polars as pl
+
+# Date format of every date column in the raw CPRD Aurum text files
+AURUM_DATE_FORMAT = "%d/%m/%Y"
+
+
+def decode_dates(values: pl.Series, fmt: str = AURUM_DATE_FORMAT) -> pl.Series:
+    """
+    Parses a Series of date strings by parsing each distinct string once.
+
+    The strings are dictionary-encoded into fresh categories, so the dictionary
+    holds only this Series' distinct strings; the dictionary is parsed, and the
+    parsed dates are gathered back by dictionary index. The result equals
+    values.str.to_date(fmt, strict=False): strings that do not match `fmt`
+    become null.
+    """
+    encoded = values.cast(pl.String).cast(pl.Categorical(pl.Categories.random()))
+    parsed = encoded.cat.get_categories().str.to_date(fmt, strict=False)
+    return parsed.gather(encoded.to_physical()).alias(values.name)
+
+
+def decode_dates_expr(column: str, fmt: str = AURUM_DATE_FORMAT) -> pl.Expr:
+    """Expression form of decode_dates, applied batch by batch (works in streaming plans)."""
+    return pl.col(column).map_batches(
+        lambda values: decode_dates(values, fmt), return_dtype=pl.Date, is_elementwise=True
+    )
+
+
+def date_failure_exprs(raw_column: str, parsed_column: str) -> dict:
+    """
+    Aggregations counting the rows whose date is missing (null or blank) and
+    the rows whose date is present but could not be parsed.
+    """
+    missing = pl.col(raw_column).is_null() | (pl.col(raw_column).str.strip_chars() == "")
+    return {
+        'missing_dates': missing.sum(),
+        'unparseable_dates': (~missing & pl.col(parsed_column).is_null()).sum(),
+    }
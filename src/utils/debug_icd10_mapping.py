@@ -3,6 +3,8 @@
 import polars as pl
 import yaml
 
+from src.utils.event_schema import CODE_VOCABULARY_FILE, BIRTH_CODE_ID
+
 def debug_mapping(config_path):
     """
     Performs a step-by-step check of the two-stage mapping process:
@@ -17,13 +19,13 @@ def debug_mapping(config_path):
 
     # --- 1. Get a sample of raw codes from your data that need mapping ---
     print("\nStep 1: Getting a sample of raw codes from your sorted events...")
-    raw_codes_to_check = pl.scan_parquet(f"{OUTPUTS['intermediate_sorted_dir']}/*.parquet") \
-        .filter(pl.col('code') != "MEDS_BIRTH") \
+    # The code vocabulary already holds each distinct code of the sorted events once
+    raw_codes_to_check = pl.scan_parquet(f"{OUTPUTS['intermediate_sorted_dir']}/{CODE_VOCABULARY_FILE}") \
+        .filter(pl.col('code_id') != BIRTH_CODE_ID) \
         .select(
-            raw_code=pl.col("code").str.extract(r"//(.*)$", 1).cast(pl.Utf8)
+            raw_code=pl.col("medcodeid").cast(pl.Utf8)
         ) \
         .drop_nulls() \
-        .unique() \
         .head(10000) # Check the first 10,000 unique codes
     
     df_codes_to_check = raw_codes_to_check.collect()
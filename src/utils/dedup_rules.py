@@ -0,0 +1,87 @@
+# src/utils/dedup_rules.py
+
+import polars as pl
+from pathlib import Path
+
+from src.utils.event_schema import CODE_COLUMNS
+
+# Rules used when paths.dedup_rules is not set
+DEFAULT_DEDUP_RULES = Path(__file__).resolve().parents[1] / "resources" / "dedup_rules.csv"
+
+# Which of a subject's events of a term are kept; a term has at most one
+KEEP_POLICY = pl.Enum(["keep_first", "keep_last", "keep_first_per_year"])
+# Policies that apply on top of the keep policy
+VALUE_POLICIES = ["drop_value"]
+
+
+def load_dedup_rules(rules_path: str = None) -> pl.DataFrame:
+    """
+    Reads a dedup rules CSV with one (Term, Policy) row per policy of a term
+    (lines starting with '#' are comments):
+
+    - keep_first:          keep only a subject's first event of the term
+    - keep_last:           keep only a subject's last event of the term
+    - keep_first_per_year: keep a subject's first event of the term in each calendar year
+    - drop_value:          remove the numeric value of the term's events
+
+    Returns one row per term (term, _keep, _drop_value). Raises ValueError for
+    an unknown policy or a term with more than one keep policy.
+    """
+    rules_path = rules_path or DEFAULT_DEDUP_RULES
+    rules_df = pl.read_csv(rules_path, infer_schema=False, comment_prefix="#").select(
+        term=pl.col("Term").str.strip_chars(),
+        policy=pl.col("Policy").str.strip_chars().str.to_lowercase().str.replace_all("-", "_"),
+    ).drop_nulls()
+
+    unknown = set(rules_df["policy"]) - set(KEEP_POLICY.categories) - set(VALUE_POLICIES)
+    if unknown:
+        raise ValueError(f"Unknown dedup policies in {rules_path}: {', '.join(sorted(unknown))}")
+
+    keep_df = rules_df.filter(pl.col("policy").is_in(KEEP_POLICY.categories.to_list())).unique()
+    conflicting = keep_df.filter(pl.len().over("term") > 1)["term"].unique()
+    if len(conflicting):
+        raise ValueError(f"Terms with more than one keep policy in {rules_path}: {', '.join(conflicting.sort())}")
+
+    return rules_df.group_by("term").agg(
+        _keep=pl.col("policy").filter(pl.col("policy").is_in(KEEP_POLICY.categories.to_list())).first(),
+        _drop_value=(pl.col("policy") == "drop_value").any(),
+    ).cast({"term": CODE_COLUMNS["term"], "_keep": KEEP_POLICY})
+
+
+def tag_dedup_rules(mapped_codes_df: pl.DataFrame, rules_df: pl.DataFrame) -> pl.DataFrame:
+    """Adds each mapped code's _keep policy (null for none) and _drop_value flag, by its term."""
+    return mapped_codes_df.join(rules_df, on="term", how="left").with_columns(
+        pl.col("_drop_value").fill_null(False)
+    )
+
+
+def apply_dedup_rules(events):
+    """
+    Applies the tagged rules to events of whole subjects in their stored order
+    (a DataFrame or LazyFrame of one subject range, sorted by subject and
+    time), and drops the _keep and _drop_value tags.
+
+    Only the events of terms with a keep policy are reordered: a stable sort
+    by subject, term and, for keep_first_per_year, year puts each group's
+    events next to each other in time order, so an event is the first (or
+    last) of its group when the previous (or next) row has another key. The
+    kept events are merged back into place by their original row number.
+    """
+    events = events.with_row_index("_row")
+    columns = events.collect_schema().names()
+    has_rule = pl.col("_keep").is_not_null()
+
+    group_key = ["subject_id", "term", "_year"]
+    ruled_events = events.filter(has_rule).with_columns(
+        _year=pl.when(pl.col("_keep") == "keep_first_per_year").then(pl.col("time").dt.year())
+    ).sort(group_key, maintain_order=True)
+    starts_group = pl.any_horizontal(pl.col(c).ne_missing(pl.col(c).shift(1)) for c in group_key)
+    ends_group = pl.any_horizontal(pl.col(c).ne_missing(pl.col(c).shift(-1)) for c in group_key)
+    kept_events = ruled_events.filter(
+        pl.when(pl.col("_keep") == "keep_last").then(ends_group).otherwise(starts_group)
+    ).select(columns).sort("_row")
+
+    return events.filter(~has_rule).select(columns).merge_sorted(kept_events, key="_row").with_columns(
+        numeric_value=pl.when(pl.col("_drop_value")).then(pl.lit(None, dtype=pl.Float64))
+                        .otherwise(pl.col("numeric_value"))
+    ).drop("_row", "_keep", "_drop_value")
@@ -0,0 +1,51 @@
+# src/utils/drug_lookup.py
+
+import polars as pl
+import os
+from pathlib import Path
+
+from src.utils.ingest_cache import file_state_key, private_tmp_path
+
+
+def _build_product_lookup(product_dictionary: str) -> pl.DataFrame:
+    """
+    Reads ProdDict and builds one PRESCRIPTION//{substance}//{prodcodeid} code per
+    product. The substance falls back to the product name (e.g. for appliances),
+    and '/' inside names is replaced so the code keeps exactly three parts.
+    """
+    prod_dict = pl.read_csv(product_dictionary, infer_schema=False)
+    substance = pl.coalesce(
+        pl.col("DrugSubstanceName").str.strip_chars().replace("", None),
+        pl.col("ProductName").str.strip_chars().replace("", None),
+        pl.lit("UNKNOWN"),
+    ).str.replace_all("/", "+", literal=True)
+
+    return prod_dict.select(
+        prodcodeid=pl.col("ProdCodeId").str.strip_chars(),
+        code=pl.format("PRESCRIPTION//{}//{}", substance, pl.col("ProdCodeId").str.strip_chars()),
+    ).drop_nulls("prodcodeid").unique(subset=["prodcodeid"], keep="first")
+
+
+def compile_product_lookup(product_dictionary: str, cache_dir: str = None) -> pl.LazyFrame:
+    """
+    Lazily scans the prodcodeid -> code lookup built from ProdDict.
+
+    With a cache directory the lookup is compiled to Parquet once, and rebuilt
+    only when the ProdDict file changes.
+    """
+    if not cache_dir:
+        return _build_product_lookup(product_dictionary).lazy()
+
+    lookup_dir = Path(cache_dir) / "lookups"
+    lookup_dir.mkdir(parents=True, exist_ok=True)
+    stem = Path(product_dictionary).stem
+    compiled_path = lookup_dir / f"{stem}.{file_state_key(product_dictionary)}.parquet"
+    if not compiled_path.exists():
+        print(f"  - Compiling product lookup {product_dictionary} -> {compiled_path}")
+        tmp_path = private_tmp_path(compiled_path)
+        _build_product_lookup(product_dictionary).write_parquet(tmp_path)
+        os.replace(tmp_path, compiled_path)
+        for stale in lookup_dir.glob(f"{stem}.*.parquet"):
+            if stale != compiled_path:
+                stale.unlink(missing_ok=True)
+    return pl.scan_parquet(compiled_path)
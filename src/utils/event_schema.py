@@ -0,0 +1,144 @@
+# src/utils/event_schema.py
+
+import polars as pl
+
+# Stage 3a output: one row per windowed observation, no strings
+UNSORTED_EVENT_SCHEMA = {
+    "subject_idx": pl.Int32,
+    "time": pl.Date,
+    "medcodeid": pl.Int64,
+    "numeric_value": pl.Float32,
+    "numunitid": pl.Int32,
+}
+# Stage 3b output: as above, with the code replaced by its code_id in the code vocabulary
+SORTED_EVENT_SCHEMA = {
+    "subject_idx": pl.Int32,
+    "time": pl.Date,
+    "code_id": pl.UInt32,
+    "numeric_value": pl.Float32,
+    "numunitid": pl.Int32,
+}
+
+BIRTH_CODE = "MEDS_BIRTH"
+BIRTH_CODE_ID = 0
+
+# Stage 3c and 5 events carry their code as these columns next to the
+# rendered "code_type//term//source_code" string (see render_code), so later
+# stages can filter and join on the parts without parsing the string
+CODE_TYPE = pl.Enum([BIRTH_CODE, "MEDICAL", "LAB", "MEASUREMENT"])
+SOURCE_VOCAB = pl.Enum(["medcodeid", "readcode"])
+CODE_COLUMNS = {
+    "code_type": CODE_TYPE,
+    "term": pl.Categorical,
+    "source_code": pl.Categorical,
+    "source_vocab": SOURCE_VOCAB,
+}
+
+# Files written next to the sorted parts in intermediate_sorted_dir
+SORTED_PARTS_GLOB = "part_*.parquet"
+CODE_VOCABULARY_FILE = "code_vocabulary.parquet"
+SUBJECT_INDEX_FILE = "subject_index.parquet"
+
+
+def subject_index(subjects_df: pl.DataFrame) -> pl.DataFrame:
+    """
+    Dense Int32 index of the cohort's subjects (subject_idx, subject_id), in
+    subject_id order, so sorting by subject_idx is the same as sorting by
+    subject_id.
+    """
+    return subjects_df.select(pl.col("subject_id").cast(pl.Int64)).unique().sort("subject_id") \
+        .with_row_index("subject_idx").with_columns(pl.col("subject_idx").cast(pl.Int32)) \
+        .select("subject_idx", "subject_id")
+
+
+def cast_failure_exprs() -> dict:
+    """
+    Aggregations over raw observation rows counting the medcodeids that are not
+    integers (such events are dropped) and the numunitids outside the range of
+    UNSORTED_EVENT_SCHEMA (such units are set to null).
+    """
+    return {
+        'invalid_medcodeids': invalid_medcodeid_expr().sum(),
+        'out_of_range_units': (
+            pl.col("numunitid").is_not_null()
+            & pl.col("numunitid").cast(UNSORTED_EVENT_SCHEMA["numunitid"], strict=False).is_null()
+        ).sum(),
+    }
+
+
+def invalid_medcodeid_expr() -> pl.Expr:
+    """True for raw rows whose medcodeid is present but not an integer."""
+    return pl.col("medcodeid").is_not_null() & pl.col("medcodeid").cast(pl.Int64, strict=False).is_null()
+
+
+def build_code_vocabulary(medcodeids: pl.Series) -> pl.DataFrame:
+    """
+    Code vocabulary (code_id, medcodeid, code) of MEDS_BIRTH (code_id 0)
+    followed by every distinct medcodeid in ascending order.
+    """
+    medcodes_df = medcodeids.drop_nulls().unique().sort().to_frame("medcodeid")
+    return pl.concat([
+        pl.DataFrame({"medcodeid": [None], "code": [BIRTH_CODE]}, schema={"medcodeid": pl.Int64, "code": pl.String}),
+        medcodes_df.select("medcodeid", code=pl.lit("medcodeid//") + pl.col("medcodeid").cast(pl.String)),
+    ]).with_row_index("code_id").select("code_id", "medcodeid", "code")
+
+
+def encode_codes(events_df: pl.DataFrame, code_vocabulary_df: pl.DataFrame) -> pl.DataFrame:
+    """Replaces the medcodeid of stage 3a events with its code_id, in SORTED_EVENT_SCHEMA."""
+    return events_df.join(
+        code_vocabulary_df.select("medcodeid", "code_id"), on="medcodeid", how="left"
+    ).select(list(SORTED_EVENT_SCHEMA)).cast(SORTED_EVENT_SCHEMA)
+
+
+def write_vocabularies(output_dir, subject_index_df: pl.DataFrame, code_vocabulary_df: pl.DataFrame):
+    subject_index_df.write_parquet(f"{output_dir}/{SUBJECT_INDEX_FILE}")
+    code_vocabulary_df.write_parquet(f"{output_dir}/{CODE_VOCABULARY_FILE}")
+
+
+def decode_sorted_events(events_lf: pl.LazyFrame, sorted_dir: str) -> pl.LazyFrame:
+    """
+    Decodes compact sorted events back to subject_id and code strings through
+    the subject index and code vocabulary in `sorted_dir`. Values and unit ids
+    are widened to Float64 and Int64.
+    """
+    subject_index_lf = pl.scan_parquet(f"{sorted_dir}/{SUBJECT_INDEX_FILE}")
+    code_vocabulary_lf = pl.scan_parquet(f"{sorted_dir}/{CODE_VOCABULARY_FILE}").select("code_id", "code")
+    return events_lf \
+        .join(subject_index_lf, on="subject_idx", how="left", maintain_order="left") \
+        .join(code_vocabulary_lf, on="code_id", how="left", maintain_order="left") \
+        .select(
+            "subject_id",
+            "time",
+            "code",
+            pl.col("numeric_value").cast(pl.Float64),
+            pl.col("numunitid").cast(pl.Int64),
+        )
+
+
+def scan_sorted_events(sorted_dir: str) -> pl.LazyFrame:
+    """Scans the sorted stage 3b parts, decoded as in decode_sorted_events."""
+    return decode_sorted_events(pl.scan_parquet(f"{sorted_dir}/{SORTED_PARTS_GLOB}"), sorted_dir)
+
+
+def render_code() -> pl.Expr:
+    """
+    The MEDS-style code string of structured code columns: MEDS_BIRTH, or
+    "code_type//term//source_code" with a missing part left empty (e.g. the
+    cancer diagnosis event "MEDICAL//liver_cancer//").
+    """
+    return pl.when(pl.col("code_type") == BIRTH_CODE).then(pl.lit(BIRTH_CODE)).otherwise(
+        pl.concat_str([
+            pl.col("code_type").cast(pl.String),
+            pl.col("term").cast(pl.String).fill_null(""),
+            pl.col("source_code").cast(pl.String).fill_null(""),
+        ], separator="//")
+    ).alias("code")
+
+
+def term_identifier() -> pl.Expr:
+    """
+    The term with every '/' removed, the form used as Identifier by the
+    measurement profile and the cleaning rules (e.g. "Drinker - excess/disorder"
+    becomes "Drinker - excessdisorder").
+    """
+    return pl.col("term").cast(pl.String).str.replace_all("/", "", literal=True)
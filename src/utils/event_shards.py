@@ -0,0 +1,165 @@
+# src/utils/event_shards.py
+
+import numpy as np
+import polars as pl
+import pyarrow.parquet as pq
+import os
+from pathlib import Path
+
+SPLIT_DIRS = {'train': 'train', 'val': 'tuning', 'test': 'held_out'}
+SHARD_SIZE = 1000
+# Target rows per row group; row groups only ever end on a subject boundary
+ROW_GROUP_ROWS = 100_000
+# Sidecar index next to the split directories; not .parquet, so '**/*.parquet' scans skip it
+SHARD_INDEX_FILE = "subject_index.arrow"
+
+
+def write_subject_aligned_parquet(shard_df: pl.DataFrame, output_path, id_col: str = "subject_id",
+                                  row_group_rows: int = ROW_GROUP_ROWS) -> pl.DataFrame:
+    """
+    Writes `shard_df` with every subject's rows contiguous and row groups that
+    start and end on subject boundaries. Subjects are packed into row groups of
+    up to `row_group_rows` rows; a larger subject gets a row group of its own.
+    Rows keep their order within each subject.
+
+    Returns one row per subject: (id_col, row_group, row_offset, length), with
+    row_offset counted from the start of the row group.
+    """
+    shard_df = shard_df.sort(id_col, maintain_order=True)
+    runs = shard_df.select(pl.col(id_col).rle()).unnest(id_col)
+    lengths = runs["len"].to_numpy()
+
+    row_groups, offsets = np.empty(len(lengths), dtype=np.int32), np.empty(len(lengths), dtype=np.int64)
+    group, group_rows, group_sizes = 0, 0, []
+    for i, n_rows in enumerate(lengths):
+        if group_rows and group_rows + n_rows > row_group_rows:
+            group_sizes.append(group_rows)
+            group, group_rows = group + 1, 0
+        row_groups[i], offsets[i] = group, group_rows
+        group_rows += n_rows
+    group_sizes.append(group_rows)
+
+    table = shard_df.to_arrow()
+    with pq.ParquetWriter(output_path, table.schema, compression="zstd") as writer:
+        start = 0
+        for size in group_sizes:
+            if size:
+                writer.write_table(table.slice(start, size), row_group_size=size)
+            start += size
+
+    return pl.DataFrame({
+        id_col: runs["value"],
+        "row_group": row_groups,
+        "row_offset": offsets,
+        "length": lengths.astype(np.int64),
+    })
+
+
+def clear_event_shards(output_base_dir: str):
+    """Creates the split directories and removes shards of earlier runs, which a new index would not cover."""
+    for subdir in SPLIT_DIRS.values():
+        os.makedirs(os.path.join(output_base_dir, subdir), exist_ok=True)
+        for old_file in Path(output_base_dir, subdir).glob("shard_*.parquet"):
+            old_file.unlink()
+
+
+def write_shard_index(index_parts: list, output_base_dir: str):
+    """
+    Writes the sidecar SHARD_INDEX_FILE from the per-shard results of
+    write_subject_aligned_parquet, each carrying `split` and `shard` columns.
+    """
+    index_df = pl.concat(index_parts) if index_parts else pl.DataFrame(
+        schema={"subject_id": pl.Int64, "row_group": pl.Int32, "row_offset": pl.Int64,
+                "length": pl.Int64, "split": pl.String, "shard": pl.String}
+    )
+    index_df.select("subject_id", "split", "shard", "row_group", "row_offset", "length") \
+        .sort("subject_id") \
+        .write_ipc(os.path.join(output_base_dir, SHARD_INDEX_FILE))
+
+
+class EventShardWriter:
+    """
+    Writes events carrying a `split` column as output_base_dir/<split dir>/shard_N.parquet,
+    `shard_size` subjects per shard, with the `columns` expressions selected.
+    Events are added in subject_id order, a range of whole subjects at a time,
+    and each split's shard is written as soon as it has `shard_size` subjects,
+    so only one open shard per split is held in memory. Row groups are aligned
+    to subjects (see write_subject_aligned_parquet), and close() writes the
+    sidecar SHARD_INDEX_FILE mapping every subject_id to its split, shard
+    file, row group, row offset and length.
+
+        writer = EventShardWriter(base, columns, shard_size)
+        for range_df in ...:
+            writer.add(range_df)
+        writer.close()
+    """
+
+    def __init__(self, output_base_dir: str, columns: list, shard_size: int = SHARD_SIZE):
+        self.output_base_dir = output_base_dir
+        self.columns = columns
+        self.shard_size = shard_size
+        self.index_parts = []
+        self._pending = {split_name: [] for split_name in SPLIT_DIRS}
+        self._pending_subjects = {split_name: 0 for split_name in SPLIT_DIRS}
+        self._shard_numbers = {split_name: 0 for split_name in SPLIT_DIRS}
+        clear_event_shards(output_base_dir)
+
+    def add(self, events_df: pl.DataFrame):
+        for (split_name,), split_data in events_df.group_by('split', maintain_order=True):
+            if split_name not in SPLIT_DIRS:
+                continue
+            subject_ids = split_data.get_column('subject_id').unique(maintain_order=True)
+            start = 0
+            while start < len(subject_ids):
+                n_subjects = min(len(subject_ids) - start, self.shard_size - self._pending_subjects[split_name])
+                chunk_ids = subject_ids.slice(start, n_subjects)
+                self._pending[split_name].append(
+                    split_data.filter(pl.col('subject_id').is_in(chunk_ids)).select(self.columns)
+                )
+                self._pending_subjects[split_name] += n_subjects
+                start += n_subjects
+                if self._pending_subjects[split_name] == self.shard_size:
+                    self._flush(split_name)
+
+    def _flush(self, split_name: str):
+        if not self._pending[split_name]:
+            return
+        shard_number = self._shard_numbers[split_name]
+        shard_file = f"{SPLIT_DIRS[split_name]}/shard_{shard_number}.parquet"
+        output_path = os.path.join(self.output_base_dir, shard_file)
+        print(f"  -> Saving {split_name} shard {shard_number} with {self._pending_subjects[split_name]} subjects to {output_path}")
+        self.index_parts.append(
+            write_subject_aligned_parquet(pl.concat(self._pending[split_name]), output_path)
+            .with_columns(split=pl.lit(split_name), shard=pl.lit(shard_file))
+        )
+        self._pending[split_name], self._pending_subjects[split_name] = [], 0
+        self._shard_numbers[split_name] += 1
+
+    def close(self):
+        for split_name in SPLIT_DIRS:
+            self._flush(split_name)
+        write_shard_index(self.index_parts, self.output_base_dir)
+
+
+def read_shard_index(output_base_dir: str) -> pl.DataFrame:
+    return pl.read_ipc(os.path.join(output_base_dir, SHARD_INDEX_FILE))
+
+
+def read_subject_events(output_base_dir: str, subject_ids) -> pl.DataFrame:
+    """
+    Reads the events of `subject_ids` from shards written by EventShardWriter,
+    reading only the row groups that hold them. Subjects that are not in the
+    index are skipped.
+    """
+    wanted_df = read_shard_index(output_base_dir) \
+        .filter(pl.col("subject_id").is_in(pl.Series(subject_ids, dtype=pl.Int64)))
+    frames = []
+    for (shard_file,), shard_entries in wanted_df.sort("shard", "row_group").group_by("shard", maintain_order=True):
+        parquet_file = pq.ParquetFile(os.path.join(output_base_dir, shard_file))
+        for (row_group,), group_entries in shard_entries.group_by("row_group", maintain_order=True):
+            group_df = pl.from_arrow(parquet_file.read_row_group(row_group))
+            frames.extend(
+                group_df.slice(row_offset, length)
+                for row_offset, length in group_entries.select("row_offset", "length").iter_rows()
+            )
+    return pl.concat(frames) if frames else pl.DataFrame()
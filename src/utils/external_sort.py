@@ -0,0 +1,163 @@
+# src/utils/external_sort.py
+
+import numpy as np
+import polars as pl
+import pyarrow as pa
+import pyarrow.parquet as pq
+import shutil
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+# Peak memory of sorting a bucket, as a multiple of its uncompressed size
+SORT_OVERHEAD = 4
+BATCH_ROWS = 250_000
+# A bucket that memory use does not recover for is re-planned as this many smaller ones
+SPLIT_ON_PRESSURE = 4
+
+
+def uncompressed_bytes_per_row(parquet_files: list) -> float:
+    """Average uncompressed row size of a set of Parquet files, from their metadata."""
+    total_bytes, total_rows = 0, 0
+    for path in parquet_files:
+        metadata = pq.ParquetFile(path).metadata
+        total_rows += metadata.num_rows
+        total_bytes += sum(metadata.row_group(i).total_byte_size for i in range(metadata.num_row_groups))
+    return total_bytes / total_rows if total_rows else 1.0
+
+
+def rows_per_bucket(bytes_per_row: float, memory_gb: float, workers: int) -> int:
+    """Largest bucket (in rows) that `workers` buckets can sort at once within `memory_gb`."""
+    budget_bytes = memory_gb * 1024 ** 3 / max(1, workers)
+    return max(1, int(budget_bytes / (bytes_per_row * SORT_OVERHEAD)))
+
+
+def max_held_bytes(memory_gb: float) -> float:
+    """Size of partitioned batches to hold in memory before spilling: as much as `memory_gb` can sort."""
+    return memory_gb * 1024 ** 3 / SORT_OVERHEAD
+
+
+def plan_bucket_bounds(subject_counts: pl.DataFrame, max_rows: int, id_col: str = "subject_id") -> np.ndarray:
+    """
+    Cuts the subject ID range into contiguous buckets of at most `max_rows` rows,
+    given each subject's row count. A subject with more rows than `max_rows`
+    gets a bucket of its own. Returns the first subject ID of every bucket after
+    the first; a row's bucket is np.searchsorted(bounds, id, side='right').
+    """
+    counts = subject_counts.sort(id_col)
+    ids = counts[id_col].to_numpy()
+    n_rows = counts["n_rows"].to_numpy()
+
+    bounds, bucket_rows = [], 0
+    for subject_id, rows in zip(ids, n_rows):
+        if bucket_rows and bucket_rows + rows > max_rows:
+            bounds.append(subject_id)
+            bucket_rows = 0
+        bucket_rows += rows
+    return np.asarray(bounds, dtype=np.int64)
+
+
+def partition_to_buckets(frames, bounds: np.ndarray, spill_dir, max_held_bytes: float,
+                         id_col: str = "subject_id", monitor=None) -> dict:
+    """
+    Partitions DataFrame batches from `frames` into buckets, holding them in
+    memory. Once the held batches exceed `max_held_bytes`, or a MemoryMonitor
+    reports memory use near the budget, every held batch is appended to its
+    bucket's Arrow IPC spill file in `spill_dir` and released, so nothing is
+    written to disk while the data fits. Every batch must have the same schema.
+
+    Returns {bucket: (spill path or None, held DataFrames)} for the buckets that
+    received rows; a bucket's rows are its spill file's rows followed by its
+    held DataFrames.
+    """
+    spill_dir = Path(spill_dir)
+    writers, spill_paths, held = {}, {}, {}
+    held_bytes = 0
+
+    def spill_held():
+        spill_dir.mkdir(parents=True, exist_ok=True)
+        for bucket, bucket_frames in held.items():
+            for part_df in bucket_frames:
+                table = part_df.to_arrow()
+                if bucket not in writers:
+                    spill_paths[bucket] = spill_dir / f"bucket_{bucket:05d}.arrow"
+                    writers[bucket] = pa.ipc.new_stream(str(spill_paths[bucket]), table.schema)
+                writers[bucket].write_table(table)
+        held.clear()
+
+    try:
+        for batch_df in frames:
+            if batch_df.is_empty():
+                continue
+            buckets = np.searchsorted(bounds, batch_df[id_col].to_numpy(), side="right")
+            batch_df = batch_df.with_columns(_bucket=pl.Series(buckets, dtype=pl.Int64))
+            for (bucket,), part_df in batch_df.partition_by("_bucket", as_dict=True).items():
+                part_df = part_df.drop("_bucket")
+                held.setdefault(bucket, []).append(part_df)
+                held_bytes += part_df.estimated_size()
+            if held_bytes > max_held_bytes or (monitor is not None and monitor.near_budget()):
+                spill_held()
+                held_bytes = 0
+    finally:
+        for writer in writers.values():
+            writer.close()
+    return {
+        bucket: (spill_paths.get(bucket), held.get(bucket, []))
+        for bucket in sorted(set(spill_paths) | set(held))
+    }
+
+
+def iter_parquet_batches(parquet_files: list, columns: list = None, batch_rows: int = BATCH_ROWS):
+    """Yields each Parquet file's rows as DataFrames of at most `batch_rows` rows."""
+    for path in parquet_files:
+        for batch in pq.ParquetFile(path).iter_batches(batch_size=batch_rows, columns=columns):
+            yield pl.from_arrow(batch)
+
+
+def sort_buckets(buckets: dict, output_dir, sort_fn, max_workers: int = 1, monitor=None,
+                 id_col: str = "subject_id") -> list:
+    """
+    Sorts every bucket from partition_to_buckets with `sort_fn` (DataFrame ->
+    DataFrame) and writes it to output_dir/part_<bucket>.parquet. Buckets are
+    sorted in parallel, and since they cover increasing ID ranges, reading the
+    parts in file name order gives a globally sorted result. Each bucket's held
+    DataFrames are released once it is sorted. With a MemoryMonitor, each
+    bucket waits to be loaded while memory use is near the budget; if memory
+    use does not recover, the bucket is re-planned as SPLIT_ON_PRESSURE smaller
+    ID ranges, sorted one at a time into part_<bucket>_<range>.parquet. Returns
+    the written paths in file name order.
+    """
+    output_dir = Path(output_dir)
+
+    def sort_one(bucket):
+        recovered = monitor is None or monitor.wait_for_headroom()
+        spill_path, held_frames = buckets.pop(bucket)
+        if spill_path is not None:
+            with pa.memory_map(str(spill_path)) as source:
+                held_frames = [pl.from_arrow(pa.ipc.open_stream(source).read_all()), *held_frames]
+        bucket_df = pl.concat(held_frames)
+        del held_frames
+
+        if recovered:
+            output_paths = [output_dir / f"part_{bucket:05d}.parquet"]
+            sort_fn(bucket_df).write_parquet(output_paths[0])
+        else:
+            sub_bounds = plan_bucket_bounds(
+                bucket_df.group_by(id_col).agg(n_rows=pl.len()),
+                max(1, bucket_df.height // SPLIT_ON_PRESSURE), id_col=id_col,
+            )
+            print(f"  - Memory use stays near the budget; sorting bucket {bucket} as {len(sub_bounds) + 1} smaller range(s)")
+            sub_buckets = np.searchsorted(sub_bounds, bucket_df[id_col].to_numpy(), side="right")
+            output_paths = []
+            for sub_bucket in range(len(sub_bounds) + 1):
+                output_paths.append(output_dir / f"part_{bucket:05d}_{sub_bucket:03d}.parquet")
+                sort_fn(bucket_df.filter(pl.Series(sub_buckets == sub_bucket))).write_parquet(output_paths[-1])
+        if spill_path is not None:
+            Path(spill_path).unlink()
+        return output_paths
+
+    with ThreadPoolExecutor(max_workers=max(1, max_workers)) as pool:
+        return [path for output_paths in pool.map(sort_one, sorted(buckets)) for path in output_paths]
+
+
+def remove_spill_dir(spill_dir):
+    shutil.rmtree(spill_dir, ignore_errors=True)
@@ -0,0 +1,175 @@
+# src/utils/file_tasks.py
+
+import hashlib
+import json
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+from contextlib import contextmanager
+from pathlib import Path
+
+from src.utils.ingest_cache import file_state_key
+
+
+def scheduler_slots() -> int:
+    """Number of CPU slots granted by the scheduler (SGE's NSLOTS), or 1 outside a job."""
+    return max(1, int(os.environ.get("NSLOTS", "1")))
+
+
+def file_checksum(path) -> str:
+    """SHA-256 of a file's contents, read in 1 MB blocks."""
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+class TaskManifest:
+    """
+    Record of the input files a stage has already processed.
+
+    Each entry stores the input file's state key, its output file, the output's
+    row count and checksum, plus any per-file statistics. An entry only counts
+    as complete while the input is unchanged and the output still matches its
+    checksum. `run_key` identifies everything else the outputs depend on (such
+    as the cohort); when it changes, every entry is discarded.
+    """
+
+    def __init__(self, path, run_key: str):
+        self.path = Path(path)
+        self.run_key = run_key
+        self.entries = {}
+        if self.path.exists():
+            with open(self.path) as f:
+                saved = json.load(f)
+            if saved.get("run_key") == run_key:
+                self.entries = saved.get("files", {})
+
+    def is_complete(self, input_path: str, output_path) -> bool:
+        entry = self.entries.get(str(input_path))
+        return (
+            entry is not None
+            and entry["state"] == file_state_key(input_path)
+            and entry["output"] == str(output_path)
+            and Path(output_path).exists()
+            and entry["checksum"] == file_checksum(output_path)
+        )
+
+    def record(self, input_path: str, output_path, stats: dict):
+        self.entries[str(input_path)] = {
+            "state": file_state_key(input_path),
+            "output": str(output_path),
+            "checksum": file_checksum(output_path),
+            **stats,
+        }
+        self.save()
+
+    def save(self):
+        tmp_path = self.path.with_name(f"{self.path.name}.tmp{os.getpid()}")
+        with open(tmp_path, "w") as f:
+            json.dump({"run_key": self.run_key, "files": self.entries}, f, indent=1)
+        os.replace(tmp_path, self.path)
+
+
+@contextmanager
+def _polars_threads(n_threads: int):
+    """Sets POLARS_MAX_THREADS for worker processes started inside the block."""
+    previous = os.environ.get("POLARS_MAX_THREADS")
+    os.environ["POLARS_MAX_THREADS"] = str(n_threads)
+    try:
+        yield
+    finally:
+        if previous is None:
+            os.environ.pop("POLARS_MAX_THREADS", None)
+        else:
+            os.environ["POLARS_MAX_THREADS"] = previous
+
+
+def _run_one(task, input_path: str, output_path: str) -> dict:
+    """Runs one task into a temporary file, so a killed task never leaves a partial output."""
+    tmp_path = f"{output_path}.tmp"
+    try:
+        stats = task(input_path, tmp_path)
+        os.replace(tmp_path, output_path)
+    finally:
+        Path(tmp_path).unlink(missing_ok=True)
+    return stats
+
+
+def run_file_tasks(task, jobs: list, manifest: TaskManifest, max_workers: int,
+                   max_attempts: int = 3, initializer=None, initargs: tuple = (), monitor=None,
+                   replan=None) -> list:
+    """
+    Runs task(input_path, output_path) -> stats for every (input_path, output_path)
+    job that the manifest does not already hold, recording each one as it finishes.
+
+    Tasks run on a pool of spawned processes (one Polars thread each) and must be
+    module-level functions; `initializer(*initargs)` runs once per worker to set
+    up shared state. With one worker everything runs in this process instead.
+    Failed tasks are retried up to `max_attempts` times in total, and the input
+    paths that still fail are returned rather than raised. Tasks are handed to
+    the pool one at a time as workers free up; with a MemoryMonitor, the next
+    task waits while memory use is near the budget. If memory use does not
+    recover and `replan` is given, the remaining tasks run as replan(task)
+    instead, which should do the same work in smaller pieces.
+    """
+    pending = [(str(i), str(o)) for i, o in jobs if not manifest.is_complete(i, o)]
+    print(f"  - {len(jobs) - len(pending)} of {len(jobs)} file(s) already complete; {len(pending)} to process")
+
+    def wait_for_headroom(**wait_args):
+        nonlocal task
+        if monitor is not None and not monitor.wait_for_headroom(**wait_args) and replan is not None:
+            task = replan(task)
+
+    for attempt in range(1, max_attempts + 1):
+        if not pending:
+            break
+        if attempt > 1:
+            print(f"  - Retrying {len(pending)} failed file(s) (attempt {attempt}/{max_attempts})...")
+        for _, output_path in pending:
+            Path(output_path).unlink(missing_ok=True)
+
+        failed = []
+        n_workers = min(max_workers, len(pending))
+        if n_workers <= 1:
+            if initializer is not None:
+                initializer(*initargs)
+            for input_path, output_path in pending:
+                # No other task is running that could free memory, so there is nothing to wait for
+                wait_for_headroom(max_wait=0)
+                try:
+                    manifest.record(input_path, output_path, _run_one(task, input_path, output_path))
+                    print(f"  -> Completed {Path(input_path).name}")
+                except Exception as e:
+                    print(f"Warning: Failed to process {input_path}. Error: {e}")
+                    failed.append((input_path, output_path))
+        else:
+            with _polars_threads(1), ProcessPoolExecutor(
+                max_workers=n_workers, mp_context=multiprocessing.get_context("spawn"),
+                initializer=initializer, initargs=initargs,
+            ) as pool:
+                queued, running = list(pending), {}
+
+                def submit_next():
+                    if queued:
+                        wait_for_headroom()
+                        input_path, output_path = queued.pop(0)
+                        running[pool.submit(_run_one, task, input_path, output_path)] = (input_path, output_path)
+
+                for _ in range(n_workers):
+                    submit_next()
+                while running:
+                    finished, _ = wait(running, return_when=FIRST_COMPLETED)
+                    for future in finished:
+                        input_path, output_path = running.pop(future)
+                        try:
+                            manifest.record(input_path, output_path, future.result())
+                            print(f"  -> Completed {Path(input_path).name}")
+                        except Exception as e:
+                            print(f"Warning: Failed to process {input_path}. Error: {e}")
+                            failed.append((input_path, output_path))
+                        submit_next()
+        pending = failed
+
+    return [input_path for input_path, _ in pending]
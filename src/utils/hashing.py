@@ -0,0 +1,45 @@
+# src/utils/hashing.py
+
+import numpy as np
+import polars as pl
+
+
+def splitmix64(values: np.ndarray) -> np.ndarray:
+    """
+    SplitMix64 finaliser over a uint64 array. The output depends only on the
+    input values, so it is stable across runs, machines and library versions.
+    """
+    x = np.atleast_1d(values).astype(np.uint64) + np.uint64(0x9E3779B97F4A7C15)
+    x = (x ^ (x >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+    x = (x ^ (x >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+    return x ^ (x >> np.uint64(31))
+
+
+def stable_hash(values: np.ndarray, seed: int = 0) -> np.ndarray:
+    """Seeded 64-bit hash of an integer array."""
+    return splitmix64(np.atleast_1d(values).astype(np.uint64) ^ splitmix64(np.array([seed]))[0])
+
+
+def stable_pair_hash(left: np.ndarray, right: np.ndarray, seed: int = 0) -> np.ndarray:
+    """Seeded 64-bit hash of (left, right) integer pairs."""
+    return splitmix64(stable_hash(left, seed) ^ np.atleast_1d(right).astype(np.uint64))
+
+
+def splitmix64_expr(expr: pl.Expr) -> pl.Expr:
+    """Polars expression version of `splitmix64`; gives the same values."""
+    x = expr.cast(pl.UInt64) + pl.lit(0x9E3779B97F4A7C15, dtype=pl.UInt64)
+    # Polars has no bit-shift operator, so shift right with unsigned division
+    x = (x ^ (x // pl.lit(2**30, dtype=pl.UInt64))) * pl.lit(0xBF58476D1CE4E5B9, dtype=pl.UInt64)
+    x = (x ^ (x // pl.lit(2**27, dtype=pl.UInt64))) * pl.lit(0x94D049BB133111EB, dtype=pl.UInt64)
+    return x ^ (x // pl.lit(2**31, dtype=pl.UInt64))
+
+
+def stable_hash_expr(expr: pl.Expr, seed: int = 0) -> pl.Expr:
+    """Polars expression version of `stable_hash`; gives the same values."""
+    seed_mix = int(splitmix64(np.array([seed]))[0])
+    return splitmix64_expr(expr.cast(pl.UInt64) ^ pl.lit(seed_mix, dtype=pl.UInt64))
+
+
+def stable_uniform_expr(expr: pl.Expr, seed: int = 0) -> pl.Expr:
+    """Maps a seeded hash of `expr` to a float in [0, 1)."""
+    return (stable_hash_expr(expr, seed) // pl.lit(2**11, dtype=pl.UInt64)).cast(pl.Float64) / float(2**53)
@@ -0,0 +1,107 @@
+# src/utils/ingest_cache.py
+
+import polars as pl
+import hashlib
+import glob
+import os
+import uuid
+from pathlib import Path
+
+# Types for the CPRD Aurum columns we know about. Every other column is kept as
+# a string, so the cached copy never depends on per-file schema inference.
+# Date columns stay as strings; they are parsed by the stages that use them.
+AURUM_DTYPES = {
+    "e_patid": pl.Int64,
+    "e_pracid": pl.Int64,
+    "gender": pl.Int64,
+    "yob": pl.Int64,
+    "region": pl.Int64,
+    "medcodeid": pl.String,
+    "prodcodeid": pl.String,
+    "value": pl.Float64,
+    "numunitid": pl.Int64,
+    "quantity": pl.Float64,
+    "duration": pl.Int64,
+}
+
+# Rows per Parquet row group in the cached copies. Small enough that readers
+# can skip most of a file using row-group statistics.
+ROW_GROUP_SIZE = 250_000
+
+
+def file_state_key(path: str) -> str:
+    """Returns a short hash of a file's absolute path, size and mtime."""
+    stat = os.stat(path)
+    state = f"{os.path.abspath(path)}|{stat.st_size}|{stat.st_mtime_ns}"
+    return hashlib.sha1(state.encode()).hexdigest()[:16]
+
+
+def path_key(path: str) -> str:
+    """Returns a short hash of a file's absolute path, which names its cached copies."""
+    return hashlib.sha1(os.path.abspath(path).encode()).hexdigest()[:8]
+
+
+def private_tmp_path(path) -> Path:
+    """
+    Returns a temporary sibling of `path` that no other process or thread will
+    use, to write to before renaming it over `path`. The pid alone is not
+    enough, since stages run on threads of one process.
+    """
+    path = Path(path)
+    return path.with_name(f"{path.name}.tmp{os.getpid()}.{uuid.uuid4().hex[:8]}")
+
+
+def _scan_typed_txt(txt_path: str) -> pl.LazyFrame:
+    """Scans a raw text file with every column as a string, then applies AURUM_DTYPES."""
+    raw_lf = pl.scan_csv(txt_path, separator="\t", has_header=True, infer_schema=False)
+    columns = raw_lf.collect_schema().names()
+    return raw_lf.with_columns(
+        [pl.col(c).cast(AURUM_DTYPES[c], strict=False) for c in columns if c in AURUM_DTYPES]
+    )
+
+
+def cached_parquet_path(txt_path: str, cache_dir: str) -> Path:
+    """
+    Returns the Parquet copy of a raw tab-separated file, converting it first
+    if the cache has no copy for the file's current path, size and mtime.
+    """
+    cache_dir = Path(cache_dir)
+    cache_dir.mkdir(parents=True, exist_ok=True)
+
+    stem = Path(txt_path).stem
+    source_key = path_key(txt_path)
+    cached_path = cache_dir / f"{stem}.{source_key}.{file_state_key(txt_path)}.parquet"
+    if cached_path.exists():
+        return cached_path
+
+    print(f"  - Caching {txt_path} as Parquet...")
+    typed_lf = _scan_typed_txt(txt_path)
+
+    # Write to a private temporary file and rename, so concurrent runs never
+    # see a partially written copy.
+    tmp_path = private_tmp_path(cached_path)
+    typed_lf.sink_parquet(tmp_path, compression="zstd", row_group_size=ROW_GROUP_SIZE)
+    os.replace(tmp_path, cached_path)
+
+    # Drop copies made from older versions of the same raw file
+    for stale_path in cache_dir.glob(f"{stem}.{source_key}.*.parquet"):
+        if stale_path != cached_path:
+            stale_path.unlink(missing_ok=True)
+
+    return cached_path
+
+
+def scan_raw_file(txt_path: str, cache_dir: str = None) -> pl.LazyFrame:
+    """
+    Lazily scans one raw CPRD Aurum text file through the Parquet cache.
+    Without a cache directory the text file is scanned directly.
+    """
+    if cache_dir:
+        return pl.scan_parquet(cached_parquet_path(txt_path, cache_dir))
+    return _scan_typed_txt(txt_path)
+
+
+def scan_raw_dir(directory: str, cache_dir: str = None, pattern: str = "*.txt") -> list:
+    """Returns one LazyFrame per raw text file in a directory, in sorted file order."""
+    files = sorted(glob.glob(os.path.join(directory, pattern)))
+    return [scan_raw_file(f, cache_dir) for f in files]
@@ -1,6 +1,23 @@
 # src/utils/mapping_setup.py
 import polars as pl
 import pandas as pd
+import hashlib
+import os
+from pathlib import Path
+
+from src.utils.ingest_cache import private_tmp_path
+from src.utils.file_tasks import file_checksum
+from src.utils.event_schema import BIRTH_CODE, BIRTH_CODE_ID, CODE_COLUMNS
+
+# Part of the compiled mapping's key, so tables compiled before a rule change are rebuilt
+MAPPING_VERSION = "2"
+# The fallback hierarchy, in order; a medcodeid matched by none of them is dropped
+MAPPING_RULES = ["medcodes", "ReadcodeList", "medcodes2", "read_chapter"]
+# Errors raised when an input file of the mapping cannot be read; any other error is a bug and is raised
+MAPPING_READ_ERRORS = (OSError, UnicodeDecodeError, pd.errors.ParserError, pd.errors.EmptyDataError)
+
+LAB_TERMS = ['MVC','CRP','Hemoglobin','TIBC','HbA1c','plasma_viscosity','ESR','GGT','lymphocyte','platelets','AST','ALP','ferritin','MCH','calcium_serum','neutrophils','h_p_ylori','glucose','cholesterol_triglycerides','bilirubin','anti_ttg','plasma_proteins','BP','amylase','ALT','urea_serum','CA125','creatinine_serum','albumin_serum','WCC','creatinine_urine','iron']
+
 
 def expand_codes(df, code_col, term_col):
     """Helper to expand comma-separated codes into a long format DataFrame."""
@@ -12,85 +29,154 @@ def expand_codes(df, code_col, term_col):
     ).filter(pl.col("code").is_not_null() & (pl.col("code") != ""))
 
 
-def map_all_codes(events_lf: pl.LazyFrame, config: dict) -> pl.LazyFrame:
+def read_codelists(cleaned_codelists: str) -> pl.LazyFrame:
+    """Reads the codelist file with Pandas' more lenient CSV reader (it has bracketed lists in quoted fields)."""
+    codelists_pd = pd.read_csv(cleaned_codelists, skip_blank_lines=True)
+    codelists_pd.columns = codelists_pd.columns.str.strip()
+    return pl.from_pandas(codelists_pd).lazy()
+
+
+def _build_code_mapping(cleaned_codelists: str, medical_dictionary: str) -> pl.DataFrame:
     """
-    Maps raw medcodeids with updated LAB prefix, Read Code filtering,
-    and MEASUREMENT prefix logic.
+    Resolves the whole fallback hierarchy for every medcodeid the codelists or
+    MedicalDict know about, giving one row per mappable medcodeid:
+
+    - medcodeid:             Int64 key
+    - rule:                  the rule in MAPPING_RULES that mapped it
+    - code_type:             LAB or MEDICAL
+    - measurement_code_type: the code_type of an event with a numeric value;
+                             only the Read-chapter fallback differs (MEASUREMENT)
+    - term:                  the codelist term, or the Read chapter (e.g. 42W..00)
+    - source_code:           the listed medcodeid or Read code
+    - source_vocab:          medcodeid or readcode
     """
-    print("Mapping raw codes with all final cleaning rules...")
-    PATHS = config['paths']
-    
-    # Use Pandas' more lenient CSV reader for the problematic codelist file
-    try:
-        codelists_pd = pd.read_csv(PATHS['cleaned_codelists'], skip_blank_lines=True)
-        codelists_pd.columns = codelists_pd.columns.str.strip()
-        codelists_lf = pl.from_pandas(codelists_pd).lazy()
-    except Exception as e:
-        print(f"FATAL: Could not read the codelist file with Pandas: {e}")
-        return events_lf.with_columns(
-            code=pl.format("MEDICAL//MAPPING_FAILED//{}", pl.col("raw_code"))
-        )
-    
-    lab_terms = ['MVC','CRP','Hemoglobin','TIBC','HbA1c','plasma_viscosity','ESR','GGT','lymphocyte','platelets','AST','ALP','ferritin','MCH','calcium_serum','neutrophils','h_p_ylori','glucose','cholesterol_triglycerides','bilirubin','anti_ttg','plasma_proteins','BP','amylase','ALT','urea_serum','CA125','creatinine_serum','albumin_serum','WCC','creatinine_urine','iron']
+    codelists_lf = read_codelists(cleaned_codelists)
 
-    # Helper function to create a formatted code with the correct LAB/MEDICAL prefix
-    def format_code_with_prefix(term_col, code_col):
-        return pl.when(pl.col(term_col).is_in(lab_terms)) \
-                 .then(pl.format(f"LAB//{{}}//{{}}", pl.col(term_col), pl.col(code_col))) \
-                 .otherwise(pl.format(f"MEDICAL//{{}}//{{}}", pl.col(term_col), pl.col(code_col)))
+    # Helper function to create the structured code with the correct LAB/MEDICAL type
+    def listed_code(code_list, source_vocab, key_col, key_expr):
+        return expand_codes(codelists_lf, code_list, "MedicalTerm").select(
+            key_expr.alias(key_col),
+            code_type=pl.when(pl.col("MedicalTerm").is_in(LAB_TERMS)).then(pl.lit("LAB")).otherwise(pl.lit("MEDICAL")),
+            term=pl.col("MedicalTerm"),
+            source_code=pl.col("code"),
+            source_vocab=pl.lit(source_vocab),
+        ).drop_nulls(key_col).unique(subset=[key_col], keep='first')
+
+    medcode_key = pl.col("code").cast(pl.Int64, strict=False)
 
     # --- Create Mapping Tables ---
-    map1_lf = expand_codes(codelists_lf, "medcodes", "MedicalTerm").select(
-        pl.col("code").alias("raw_code"),
-        format_code_with_prefix("MedicalTerm", "code").alias("map1_code")
-    ).unique(subset=['raw_code'], keep='first')
-
-    medcode_to_readcode_lf = pl.scan_csv(PATHS['medical_dictionary']).select(
-        pl.col("MedCodeId").cast(pl.Utf8).alias("raw_code"),
-        pl.col("CleansedReadCode").alias("read_code") 
-    ).drop_nulls().unique(subset=['raw_code'], keep='first')
-
-    map3_lf = expand_codes(codelists_lf, "ReadcodeList", "MedicalTerm").select(
-        pl.col("code").alias("read_code"),
-        format_code_with_prefix("MedicalTerm", "code").alias("map3_code")
-    ).unique(subset=['read_code'], keep='first')
-        
-    map4_lf = expand_codes(codelists_lf, "medcodes2", "MedicalTerm").select(
-        pl.col("code").alias("raw_code"),
-        format_code_with_prefix("MedicalTerm", "code").alias("map4_code")
-    ).unique(subset=['raw_code'], keep='first')
-
-    # --- Perform Sequential Joins ---
-    events_lf = events_lf \
-        .join(map1_lf, on="raw_code", how="left") \
-        .join(medcode_to_readcode_lf, on="raw_code", how="left") \
-        .join(map3_lf, on="read_code", how="left") \
-        .join(map4_lf, on="raw_code", how="left")
-        
-    # --- Finalize Mapping with All New Rules ---
-    final_lf = events_lf.with_columns(
-        code=pl.coalesce(
-            pl.col("map1_code"),
-            pl.col("map3_code"),
-            pl.col("map4_code")
-        ).fill_null(
-            # This expression is evaluated only for rows where the coalesce result is null
-            pl.when(
-                pl.col("read_code").is_not_null() &
-                ~pl.col("read_code").str.starts_with('0') &
-                ~pl.col("read_code").str.starts_with('9') &
-                ~pl.col("read_code").str.starts_with("EMI") &
-                ~pl.col("read_code").str.starts_with("^ES")
-            ).then(
-                pl.when(pl.col("numeric_value").is_not_null())
-                  .then(pl.format("MEASUREMENT//{}//{}", pl.col("read_code").str.slice(0, 3) + pl.lit("..00"), pl.col("raw_code")))
-                  .otherwise(pl.format("MEDICAL//{}//{}", pl.col("read_code").str.slice(0, 3) + pl.lit("..00"), pl.col("raw_code")))
-            )
+    map1_lf = listed_code("medcodes", "medcodeid", "medcodeid", medcode_key)
+
+    medcode_to_readcode_lf = pl.scan_csv(medical_dictionary).select(
+        pl.col("MedCodeId").cast(pl.Int64, strict=False).alias("medcodeid"),
+        pl.col("CleansedReadCode").alias("read_code")
+    ).drop_nulls().unique(subset=['medcodeid'], keep='first')
+
+    map3_lf = listed_code("ReadcodeList", "readcode", "read_code", pl.col("code"))
+
+    map4_lf = listed_code("medcodes2", "medcodeid", "medcodeid", medcode_key)
+
+    # --- Resolve the hierarchy once per known medcodeid ---
+    medcodes_lf = pl.concat([
+        map1_lf.select("medcodeid"), medcode_to_readcode_lf.select("medcodeid"), map4_lf.select("medcodeid")
+    ]).unique()
+    resolved_lf = medcodes_lf \
+        .join(map1_lf, on="medcodeid", how="left") \
+        .join(medcode_to_readcode_lf, on="medcodeid", how="left") \
+        .join(map3_lf, on="read_code", how="left", suffix="_map3") \
+        .join(map4_lf, on="medcodeid", how="left", suffix="_map4")
+
+    # Read codes starting with these are administrative and never fall back to their chapter
+    has_chapter = pl.col("read_code").is_not_null() & \
+        ~pl.col("read_code").str.starts_with('0') & \
+        ~pl.col("read_code").str.starts_with('9') & \
+        ~pl.col("read_code").str.starts_with("EMI") & \
+        ~pl.col("read_code").str.starts_with("^ES")
+
+    rule = pl.when(pl.col("term").is_not_null()).then(pl.lit("medcodes")) \
+        .when(pl.col("term_map3").is_not_null()).then(pl.lit("ReadcodeList")) \
+        .when(pl.col("term_map4").is_not_null()).then(pl.lit("medcodes2")) \
+        .when(has_chapter).then(pl.lit("read_chapter"))
+
+    def resolve(col, chapter_value):
+        return pl.when(pl.col("term").is_not_null()).then(pl.col(col)) \
+            .when(pl.col("term_map3").is_not_null()).then(pl.col(f"{col}_map3")) \
+            .when(pl.col("term_map4").is_not_null()).then(pl.col(f"{col}_map4")) \
+            .when(has_chapter).then(chapter_value)
+
+    return resolved_lf.select(
+        "medcodeid",
+        rule=rule,
+        code_type=resolve("code_type", pl.lit("MEDICAL")),
+        measurement_code_type=resolve("code_type", pl.lit("MEASUREMENT")),
+        term=resolve("term", pl.col("read_code").str.slice(0, 3) + pl.lit("..00")),
+        source_code=resolve("source_code", pl.col("medcodeid").cast(pl.String)),
+        source_vocab=resolve("source_vocab", pl.lit("medcodeid")),
+    ).filter(pl.col("rule").is_not_null()) \
+        .sort("medcodeid") \
+        .collect()
+
+
+def compile_code_mapping(cleaned_codelists: str, medical_dictionary: str, cache_dir: str = None) -> pl.LazyFrame:
+    """
+    Lazily scans the medcodeid -> code mapping compiled from the codelists and
+    MedicalDict (see _build_code_mapping).
+
+    With a cache directory the mapping is compiled to Parquet once, and rebuilt
+    only when the contents of either input file change.
+    """
+    if not cache_dir:
+        return _build_code_mapping(cleaned_codelists, medical_dictionary).lazy()
+
+    lookup_dir = Path(cache_dir) / "lookups"
+    lookup_dir.mkdir(parents=True, exist_ok=True)
+    mapping_key = hashlib.sha1("|".join([
+        MAPPING_VERSION, file_checksum(cleaned_codelists), file_checksum(medical_dictionary)
+    ]).encode()).hexdigest()[:16]
+    compiled_path = lookup_dir / f"code_mapping.{mapping_key}.parquet"
+    if not compiled_path.exists():
+        print(f"  - Compiling code mapping {cleaned_codelists} + {medical_dictionary} -> {compiled_path}")
+        tmp_path = private_tmp_path(compiled_path)
+        _build_code_mapping(cleaned_codelists, medical_dictionary).write_parquet(tmp_path)
+        os.replace(tmp_path, compiled_path)
+        for stale in lookup_dir.glob("code_mapping.*.parquet"):
+            if stale != compiled_path:
+                stale.unlink(missing_ok=True)
+    return pl.scan_parquet(compiled_path)
+
+
+def map_code_vocabulary(code_vocabulary_df: pl.DataFrame, config: dict) -> pl.DataFrame:
+    """
+    Maps each distinct code of the stage 3b code vocabulary once, instead of
+    every event. Returns one row per (code_id, has_value) with the structured
+    code columns (CODE_COLUMNS), where has_value says whether the event has a
+    numeric value (which makes the Read-chapter fallback a MEASUREMENT).
+    MEDS_BIRTH keeps its own code_type; codes that failed all mapping rules
+    have no row, so an inner join on (code_id, has_value) drops their events.
+    """
+    print("Mapping the distinct raw codes with all final cleaning rules...")
+    PATHS = config['paths']
+    codes_df = code_vocabulary_df.filter(pl.col("code_id") != BIRTH_CODE_ID).select("code_id", "medcodeid")
+    birth_df = pl.DataFrame({"code_id": [BIRTH_CODE_ID], "code_type": [BIRTH_CODE]},
+                            schema={"code_id": code_vocabulary_df.schema["code_id"], "code_type": pl.String})
+
+    try:
+        code_mapping_df = compile_code_mapping(
+            PATHS['cleaned_codelists'], PATHS['medical_dictionary'], PATHS.get('ingest_cache_dir')
+        ).collect()
+        mapped_df = codes_df.join(code_mapping_df, on="medcodeid", how="inner")
+    except MAPPING_READ_ERRORS as e:
+        print(f"FATAL: Could not read the code mapping input files: {e}")
+        mapped_df = codes_df.with_columns(
+            code_type=pl.lit("MEDICAL"), measurement_code_type=pl.lit("MEDICAL"), term=pl.lit("MAPPING_FAILED"),
+            source_code=pl.col("medcodeid").cast(pl.String), source_vocab=pl.lit("medcodeid"),
         )
-    )
+    print(f"  - Mapped {mapped_df.height} of {codes_df.height} distinct raw codes")
 
-    # --- Drop events that failed all mapping rules (are null) or were filtered out ---
-    final_lf = final_lf.filter(pl.col("code").is_not_null())
-    
-    # Drop all intermediate columns used for mapping
-    return final_lf.drop(["map1_code", "read_code", "map3_code", "map4_code"])
\ No newline at end of file
+    code_columns = ["code_type", "term", "source_code", "source_vocab"]
+    return pl.concat([
+        pl.concat([birth_df, mapped_df.select("code_id", *code_columns)], how="diagonal")
+            .with_columns(has_value=pl.lit(False)),
+        pl.concat([birth_df, mapped_df.select("code_id", pl.col("measurement_code_type").alias("code_type"), *code_columns[1:])], how="diagonal")
+            .with_columns(has_value=pl.lit(True)),
+    ]).select("code_id", "has_value", *code_columns).cast(CODE_COLUMNS)
@@ -0,0 +1,108 @@
+# src/utils/matching.py
+
+import pandas as pd
+import numpy as np
+
+from src.utils.hashing import stable_pair_hash
+
+
+def band_join(cases: pd.DataFrame, controls: pd.DataFrame, by: list,
+              case_value: str, control_value: str, window: int) -> pd.DataFrame:
+    """
+    Pairs every case with the controls that share its `by` keys and whose
+    `control_value` is within `window` of its `case_value` (inclusive).
+
+    Controls are sorted by (by..., control_value) and each case's eligible range
+    is found by binary search, so memory scales with the number of eligible pairs
+    rather than with the size of each `by` group squared. The result has the same
+    columns as an inner merge on `by`.
+    """
+    cases = cases.dropna(subset=by + [case_value])
+    controls = controls.dropna(subset=by + [control_value])
+    result_columns = list(cases.columns) + [c for c in controls.columns if c not in by]
+    if cases.empty or controls.empty:
+        return pd.DataFrame(columns=result_columns)
+
+    # Give each distinct combination of `by` keys one integer id across both frames
+    keys = pd.concat([cases[by], controls[by]], ignore_index=True)
+    group_ids = keys.groupby(by, sort=False).ngroup().to_numpy(np.int64)
+    case_groups, control_groups = group_ids[:len(cases)], group_ids[len(cases):]
+
+    # Pack (group, value) into one sortable int64; each group owns a disjoint
+    # range of width `span`, so a window can never cross into another group.
+    case_values = cases[case_value].to_numpy(np.int64)
+    control_values = controls[control_value].to_numpy(np.int64)
+    base = min(case_values.min(), control_values.min()) - window
+    span = max(case_values.max(), control_values.max()) + window - base + 1
+    case_keys = case_groups * span + (case_values - base)
+    control_keys = control_groups * span + (control_values - base)
+
+    order = np.argsort(control_keys, kind='stable')
+    sorted_control_keys = control_keys[order]
+    lo = np.searchsorted(sorted_control_keys, case_keys - window, side='left')
+    hi = np.searchsorted(sorted_control_keys, case_keys + window, side='right')
+
+    # Expand each case's [lo, hi) range into explicit (case, control) row pairs
+    counts = hi - lo
+    case_rows = np.repeat(np.arange(len(cases)), counts)
+    offsets = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+    control_rows = order[np.repeat(lo, counts) + offsets]
+
+    pairs = pd.concat([
+        cases.iloc[case_rows].reset_index(drop=True),
+        controls.drop(columns=by).iloc[control_rows].reset_index(drop=True)
+    ], axis=1)
+    return pairs[result_columns]
+
+
+def sample_controls(matches: pd.DataFrame, controls_per_case: int, seed: int = 42,
+                    without_replacement: bool = False,
+                    case_col: str = 'subject_id', control_col: str = 'control_id') -> pd.DataFrame:
+    """
+    Samples up to `controls_per_case` controls for every case in one vectorized pass.
+
+    Each candidate (case, control) pair gets a random key from a seeded hash of the
+    pair, and the lowest keys per case are kept. The draw depends only on the seed
+    and the pairs themselves, not on row order. With `without_replacement`, no
+    control is sampled for more than one case.
+    """
+    pairs = matches[[case_col, control_col]].drop_duplicates()
+    pairs = pairs.assign(_key=stable_pair_hash(pairs[case_col].to_numpy(), pairs[control_col].to_numpy(), seed))
+    pairs = pairs.sort_values([case_col, '_key'], kind='stable')
+
+    if without_replacement:
+        sampled = _sample_without_replacement(pairs, controls_per_case, case_col, control_col)
+    else:
+        rank = pairs.groupby(case_col, sort=False).cumcount()
+        sampled = pairs[rank < controls_per_case]
+
+    return sampled.sort_values([case_col, '_key'])[[case_col, control_col]].reset_index(drop=True)
+
+
+def _sample_without_replacement(pairs: pd.DataFrame, controls_per_case: int,
+                                case_col: str, control_col: str) -> pd.DataFrame:
+    """
+    Greedy rounds over key-sorted pairs: every free control is offered to the case
+    where it has its lowest key, and each case accepts its best offers up to its
+    remaining quota. The lowest remaining key is always accepted, so every round
+    makes progress.
+    """
+    quota = pd.Series(controls_per_case, index=pairs[case_col].unique())
+    remaining = pairs
+    accepted_rounds = []
+    while not remaining.empty:
+        offers = remaining.sort_values('_key', kind='stable').drop_duplicates(control_col)
+        offers = offers.sort_values([case_col, '_key'], kind='stable')
+        rank = offers.groupby(case_col, sort=False).cumcount().to_numpy()
+        accepted = offers[rank < quota.reindex(offers[case_col]).to_numpy()]
+        accepted_rounds.append(accepted)
+
+        quota = quota.sub(accepted[case_col].value_counts(), fill_value=0)
+        full_cases = quota.index[quota <= 0]
+        remaining = remaining[
+            ~remaining[control_col].isin(accepted[control_col]) & ~remaining[case_col].isin(full_cases)
+        ]
+
+    if not accepted_rounds:
+        return pairs.iloc[:0]
+    return pd.concat(accepted_rounds)
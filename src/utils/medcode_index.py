@@ -0,0 +1,172 @@
+# src/utils/medcode_index.py
+
+import polars as pl
+import pyarrow.parquet as pq
+import hashlib
+import glob
+import json
+import os
+import shutil
+from pathlib import Path
+
+from src.utils.ingest_cache import cached_parquet_path, file_state_key, private_tmp_path
+from src.utils.dates import decode_dates, date_failure_exprs
+
+# Part of every release key, so indexes built before a layout change are rebuilt
+INDEX_VERSION = "2"
+
+
+def build_medcode_index(observation_dir: str, cache_dir: str, index_root: str) -> Path:
+    """
+    Builds the medcode inverted index for one raw observation release, or returns
+    the existing one.
+
+    For every cached observation file the index records which row groups contain
+    each medcodeid (locations/) and each patient (patients/), plus each
+    patient's first and last observation dates (patient_dates.parquet). The
+    release is identified by the path, size and mtime of every observation
+    file, so the index is rebuilt only when the raw data changes.
+    """
+    observation_files = sorted(glob.glob(os.path.join(observation_dir, "*.txt")))
+    release_key = hashlib.sha1(
+        "|".join([INDEX_VERSION] + [file_state_key(f) for f in observation_files]).encode()
+    ).hexdigest()[:16]
+    index_dir = Path(index_root) / f"release_{release_key}"
+    if (index_dir / "manifest.json").exists():
+        return index_dir
+
+    print(f"Building medcode index for {len(observation_files)} observation files in {index_dir}...")
+    build_dir = private_tmp_path(index_dir)
+    (build_dir / "locations").mkdir(parents=True, exist_ok=True)
+    (build_dir / "patients").mkdir(parents=True, exist_ok=True)
+    (build_dir / "patient_dates").mkdir(parents=True, exist_ok=True)
+
+    cached_files, unparseable_dates = [], {}
+    for file_number, txt_path in enumerate(observation_files):
+        cached_path = cached_parquet_path(txt_path, cache_dir)
+        parquet_file = pq.ParquetFile(cached_path)
+        if "e_patid" not in parquet_file.schema_arrow.names:
+            print(f"Warning: Skipping {txt_path} in medcode index (no e_patid column).")
+            continue
+        cached_files.append(str(cached_path))
+
+        locations, patient_locations, patient_dates = [], [], []
+        unparseable_dates[txt_path] = 0
+        for row_group in range(parquet_file.num_row_groups):
+            rows = pl.from_arrow(
+                parquet_file.read_row_group(row_group, columns=["e_patid", "obsdate", "medcodeid"])
+            )
+            rows = rows.with_columns(date=decode_dates(rows["obsdate"]))
+            unparseable_dates[txt_path] += rows.select(**date_failure_exprs("obsdate", "date"))["unparseable_dates"].item()
+            locations.append(
+                rows.group_by("medcodeid").agg(n_rows=pl.len())
+                    .with_columns(file_id=pl.lit(len(cached_files) - 1, dtype=pl.Int32),
+                                  row_group=pl.lit(row_group, dtype=pl.Int32))
+            )
+            patient_dates.append(
+                rows.group_by("e_patid").agg(
+                    first_date=pl.col("date").min(),
+                    last_date=pl.col("date").max(),
+                )
+            )
+            patient_locations.append(
+                patient_dates[-1].select("e_patid")
+                    .with_columns(file_id=pl.lit(len(cached_files) - 1, dtype=pl.Int32),
+                                  row_group=pl.lit(row_group, dtype=pl.Int32))
+            )
+
+        if locations:
+            pl.concat(locations).write_parquet(build_dir / "locations" / f"{file_number:05d}.parquet")
+            pl.concat(patient_locations).sort("e_patid") \
+                .write_parquet(build_dir / "patients" / f"{file_number:05d}.parquet")
+            pl.concat(patient_dates).write_parquet(build_dir / "patient_dates" / f"{file_number:05d}.parquet")
+
+    if not cached_files:
+        pl.DataFrame(schema={"medcodeid": pl.String, "n_rows": pl.UInt32, "file_id": pl.Int32, "row_group": pl.Int32}) \
+            .write_parquet(build_dir / "locations" / "empty.parquet")
+        pl.DataFrame(schema={"e_patid": pl.Int64, "file_id": pl.Int32, "row_group": pl.Int32}) \
+            .write_parquet(build_dir / "patients" / "empty.parquet")
+        pl.DataFrame(schema={"e_patid": pl.Int64, "first_date": pl.Date, "last_date": pl.Date}) \
+            .write_parquet(build_dir / "patient_dates" / "empty.parquet")
+
+    # A patient can appear in several row groups and files, so merge the partial ranges
+    pl.scan_parquet(build_dir / "patient_dates" / "*.parquet") \
+        .group_by("e_patid") \
+        .agg(pl.col("first_date").min(), pl.col("last_date").max()) \
+        .sort("e_patid") \
+        .sink_parquet(build_dir / "patient_dates.parquet")
+    shutil.rmtree(build_dir / "patient_dates")
+
+    with open(build_dir / "manifest.json", "w") as f:
+        json.dump({"observation_dir": observation_dir, "files": cached_files,
+                   "unparseable_dates": unparseable_dates}, f)
+
+    # Publish the finished index in one step; another job may have beaten us to it
+    try:
+        os.rename(build_dir, index_dir)
+    except OSError:
+        shutil.rmtree(build_dir, ignore_errors=True)
+    return index_dir
+
+
+def _read_located_rows(index_dir: str, locations: str, key_col: str, keys: pl.Series, columns: list = None) -> pl.DataFrame:
+    """
+    Returns the observation rows whose `key_col` is in `keys`, reading only the
+    row groups that the index's `locations` table says contain them.
+    """
+    index_dir = Path(index_dir)
+    with open(index_dir / "manifest.json") as f:
+        cached_files = json.load(f)["files"]
+
+    wanted = pl.scan_parquet(index_dir / locations / "*.parquet") \
+        .filter(pl.col(key_col).is_in(keys)) \
+        .select("file_id", "row_group") \
+        .unique() \
+        .sort("file_id", "row_group") \
+        .collect()
+
+    read_columns = None if columns is None else list(dict.fromkeys(columns + [key_col]))
+    parts = []
+    for (file_id,), row_groups in wanted.group_by("file_id", maintain_order=True):
+        table = pq.ParquetFile(cached_files[file_id]).read_row_groups(
+            row_groups["row_group"].to_list(), columns=read_columns
+        )
+        parts.append(pl.from_arrow(table).filter(pl.col(key_col).is_in(keys)))
+
+    if not parts:
+        schema = pl.scan_parquet(cached_files[0]).collect_schema() if cached_files else {c: pl.String for c in columns or []}
+        empty = pl.DataFrame(schema=schema)
+        return empty.select(columns) if columns else empty
+    rows = pl.concat(parts, how="vertical")
+    return rows.select(columns) if columns else rows
+
+
+def read_medcode_rows(index_dir: str, medcodes, columns: list = None) -> pl.DataFrame:
+    """
+    Returns the observation rows whose medcodeid is in `medcodes`, reading only
+    the row groups that the index says contain them.
+    """
+    return _read_located_rows(index_dir, "locations", "medcodeid",
+                              pl.Series("medcodeid", medcodes, dtype=pl.String), columns)
+
+
+def read_patient_rows(index_dir: str, patient_ids, columns: list = None) -> pl.DataFrame:
+    """
+    Returns the observation rows of the patients in `patient_ids`, reading only
+    the row groups that the index says contain them.
+    """
+    return _read_located_rows(index_dir, "patients", "e_patid",
+                              pl.Series("e_patid", patient_ids, dtype=pl.Int64), columns)
+
+
+def medcode_counts(index_dir: str) -> pl.DataFrame:
+    """Returns every medcodeid in the release with its total number of observation rows."""
+    return pl.scan_parquet(Path(index_dir) / "locations" / "*.parquet") \
+        .group_by("medcodeid") \
+        .agg(pl.col("n_rows").sum()) \
+        .collect()
+
+
+def scan_patient_dates(index_dir: str) -> pl.LazyFrame:
+    """Lazily scans each patient's first and last observation dates."""
+    return pl.scan_parquet(Path(index_dir) / "patient_dates.parquet")
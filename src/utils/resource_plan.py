@@ -0,0 +1,197 @@
+# src/utils/resource_plan.py
+
+import pyarrow.parquet as pq
+import os
+import threading
+import time
+from pathlib import Path
+
+from src.utils.file_tasks import scheduler_slots
+
+# Default memory budget when resources.max_memory_gb is not set
+DEFAULT_MEMORY_GB = 8
+# Share of the budget a stage plans to fill; the rest is headroom for Python,
+# Arrow buffers and estimation error
+PLANNED_FRACTION = 0.6
+# Resident memory of an idle Polars worker process
+WORKER_BASE_GB = 0.5
+# Peak memory of streaming one row group through a worker, as a multiple of its size
+STREAM_OVERHEAD = 3
+# Rows per row group of the ingest cache (see ingest_cache.ROW_GROUP_SIZE)
+STREAM_ROWS = 250_000
+# Peak memory of processing one shard in stages 3c and 5, as a multiple of its size
+SHARD_OVERHEAD = 8
+# Memory use, as a share of the budget, above which stages back off
+HIGH_WATERMARK = 0.85
+
+
+def resource_budget(RESOURCES: dict) -> dict:
+    """The job's total memory budget (resources.max_memory_gb) and thread count (resources.max_threads)."""
+    return {
+        'memory_gb': RESOURCES.get('max_memory_gb') or DEFAULT_MEMORY_GB,
+        'threads': RESOURCES.get('max_threads') or scheduler_slots(),
+    }
+
+
+def uncompressed_bytes(parquet_file: str) -> int:
+    """Uncompressed size of a Parquet file's data, from its footer."""
+    metadata = pq.ParquetFile(parquet_file).metadata
+    return sum(metadata.row_group(i).total_byte_size for i in range(metadata.num_row_groups))
+
+
+def sample_bytes_per_row(path: str, n_lines: int = 10_000) -> float:
+    """Average size of a text file's rows, from its first `n_lines` lines."""
+    total_bytes, total_lines = 0, 0
+    with open(path, "rb") as f:
+        f.readline()
+        for line in f:
+            total_bytes += len(line)
+            total_lines += 1
+            if total_lines >= n_lines:
+                break
+    return total_bytes / total_lines if total_lines else 1.0
+
+
+def plan_extract_workers(RESOURCES: dict, input_files: list) -> int:
+    """
+    Number of raw files to extract at once: resources.extract_workers if set,
+    otherwise as many worker processes as there are threads, files and memory
+    for. Each worker streams one row group at a time, so its size is estimated
+    from the largest sampled row size among the inputs.
+    """
+    if RESOURCES.get('extract_workers'):
+        return RESOURCES['extract_workers']
+    budget = resource_budget(RESOURCES)
+    bytes_per_row = max((sample_bytes_per_row(f) for f in input_files), default=1.0)
+    worker_gb = WORKER_BASE_GB + STREAM_ROWS * bytes_per_row * STREAM_OVERHEAD / 1024 ** 3
+    by_memory = int(budget['memory_gb'] * PLANNED_FRACTION / worker_gb)
+    return max(1, min(budget['threads'], len(input_files) or 1, by_memory))
+
+
+def plan_sort(RESOURCES: dict) -> tuple:
+    """
+    Memory budget (GB) and number of parallel workers of the external sort:
+    resources.sort_memory_gb and resources.sort_workers if set, otherwise the
+    planned share of max_memory_gb and max_threads.
+    """
+    budget = resource_budget(RESOURCES)
+    sort_memory_gb = RESOURCES.get('sort_memory_gb') or budget['memory_gb'] * PLANNED_FRACTION
+    sort_workers = RESOURCES.get('sort_workers') or budget['threads']
+    return sort_memory_gb, sort_workers
+
+
+def plan_batch_rows(RESOURCES: dict, bytes_per_row: float, max_rows: int = STREAM_ROWS) -> int:
+    """Rows per streamed batch, at most `max_rows` and small enough to take 1% of the memory budget."""
+    budget_bytes = resource_budget(RESOURCES)['memory_gb'] * 1024 ** 3 * 0.01
+    return max(1_000, min(max_rows, int(budget_bytes / max(bytes_per_row, 1.0))))
+
+
+def plan_shard_size(RESOURCES: dict, n_rows: int, n_subjects: int, bytes_per_row: float, max_subjects: int) -> int:
+    """
+    Subjects per output shard: at most `max_subjects`, and few enough that one
+    shard of average subjects can be processed within the planned memory.
+    """
+    budget_bytes = resource_budget(RESOURCES)['memory_gb'] * 1024 ** 3 * PLANNED_FRACTION
+    subject_bytes = max(1.0, n_rows / max(1, n_subjects) * bytes_per_row * SHARD_OVERHEAD)
+    return max(1, min(max_subjects, int(budget_bytes / subject_bytes)))
+
+
+def plan_shard_workers(RESOURCES: dict, shard_files: list) -> int:
+    """Number of shards to process at once, from the largest shard's uncompressed size."""
+    budget = resource_budget(RESOURCES)
+    largest_bytes = max((uncompressed_bytes(f) for f in shard_files), default=0)
+    shard_gb = max(largest_bytes * SHARD_OVERHEAD / 1024 ** 3, 0.01)
+    by_memory = int(budget['memory_gb'] * PLANNED_FRACTION / shard_gb)
+    return max(1, min(budget['threads'], len(shard_files) or 1, by_memory))
+
+
+def _process_rss_bytes(pid: int, page_size: int) -> int:
+    try:
+        with open(f"/proc/{pid}/statm") as f:
+            return int(f.read().split()[1]) * page_size
+    except (OSError, IndexError, ValueError):
+        return 0
+
+
+def _child_pids(pid: int) -> list:
+    children = []
+    for stat_path in Path("/proc").glob("[0-9]*/stat"):
+        try:
+            # The parent pid is the second field after the parenthesised command name
+            if int(stat_path.read_text().rsplit(")", 1)[1].split()[1]) == pid:
+                children.append(int(stat_path.parent.name))
+        except (OSError, IndexError, ValueError):
+            continue
+    return children
+
+
+class MemoryMonitor:
+    """
+    Samples the resident memory of this process and its worker processes in a
+    background thread, and records the peak. Stages call near_budget() or
+    wait_for_headroom() before starting more work, to back off when memory
+    use gets close to the budget, and split the work into smaller pieces when
+    it does not come back down. Reads /proc, so it only measures on Linux;
+    elsewhere it reports zero and never backs off.
+
+        with MemoryMonitor(budget['memory_gb']) as monitor:
+            ...
+    """
+
+    def __init__(self, budget_gb: float, interval: float = 0.5):
+        self.budget_bytes = budget_gb * 1024 ** 3
+        self.interval = interval
+        self.current_bytes = 0
+        self.peak_bytes = 0
+        self.n_backoffs = 0
+        self.n_replans = 0
+        self._page_size = os.sysconf("SC_PAGE_SIZE") if hasattr(os, "sysconf") else 4096
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def sample(self) -> int:
+        pid = os.getpid()
+        rss = _process_rss_bytes(pid, self._page_size)
+        rss += sum(_process_rss_bytes(child, self._page_size) for child in _child_pids(pid))
+        self.current_bytes = rss
+        self.peak_bytes = max(self.peak_bytes, rss)
+        return rss
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self.sample()
+
+    def __enter__(self):
+        self.sample()
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._thread.join()
+        print(f"  - Peak memory: {self.peak_bytes / 1024 ** 3:.2f} GB of a "
+              f"{self.budget_bytes / 1024 ** 3:.1f} GB budget; backed off {self.n_backoffs} time(s), "
+              f"re-planned {self.n_replans} time(s)")
+
+    def near_budget(self) -> bool:
+        """True (and counted as a back-off) when memory use is above the high watermark."""
+        if self.sample() < HIGH_WATERMARK * self.budget_bytes:
+            return False
+        self.n_backoffs += 1
+        return True
+
+    def wait_for_headroom(self, max_wait: float = 60.0) -> bool:
+        """
+        Waits up to `max_wait` seconds for memory use to fall below the high
+        watermark. Returns False if it did not, so the caller can re-plan the
+        work in smaller pieces instead of going ahead with the same plan.
+        """
+        if not self.near_budget():
+            return True
+        deadline = time.time() + max_wait
+        while self.sample() >= HIGH_WATERMARK * self.budget_bytes:
+            if time.time() >= deadline:
+                self.n_replans += 1
+                return False
+            time.sleep(self.interval)
+        return True
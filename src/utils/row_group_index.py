@@ -0,0 +1,82 @@
+# src/utils/row_group_index.py
+
+import numpy as np
+import polars as pl
+import pyarrow.parquet as pq
+import os
+from pathlib import Path
+
+# Sidecar written into the indexed directory; not .parquet, so '*.parquet' scans skip it
+ROW_GROUP_INDEX_FILE = "row_group_index.arrow"
+
+
+def _file_states(parquet_files: list) -> list:
+    return [(Path(path).name, os.stat(path).st_size, os.stat(path).st_mtime_ns) for path in parquet_files]
+
+
+def build_row_group_index(directory, pattern: str, id_col: str) -> pl.DataFrame:
+    """
+    Indexes every row group of the Parquet files matching `pattern` in
+    `directory` by the min and max of `id_col`, read from the file footers only,
+    and saves the index as ROW_GROUP_INDEX_FILE in the directory. Row groups
+    without statistics get null bounds and are always read.
+    """
+    directory = Path(directory)
+    parquet_files = sorted(directory.glob(pattern))
+    rows = []
+    for (file_name, size, mtime_ns), path in zip(_file_states(parquet_files), parquet_files):
+        metadata = pq.ParquetFile(path).metadata
+        column = metadata.schema.to_arrow_schema().get_field_index(id_col)
+        for row_group in range(metadata.num_row_groups):
+            group = metadata.row_group(row_group)
+            if group.num_rows == 0:
+                continue
+            stats = group.column(column).statistics if column >= 0 else None
+            has_bounds = stats is not None and stats.has_min_max
+            rows.append((file_name, size, mtime_ns, row_group,
+                         stats.min if has_bounds else None, stats.max if has_bounds else None))
+
+    index_df = pl.DataFrame(rows, orient="row", schema={
+        "file": pl.String, "size": pl.Int64, "mtime_ns": pl.Int64,
+        "row_group": pl.Int32, "min_id": pl.Int64, "max_id": pl.Int64,
+    })
+    index_df.write_ipc(directory / ROW_GROUP_INDEX_FILE)
+    return index_df
+
+
+def load_row_group_index(directory, pattern: str, id_col: str) -> pl.DataFrame:
+    """Reads a directory's row group index, rebuilding it if any indexed file was added, removed or changed."""
+    directory = Path(directory)
+    index_path = directory / ROW_GROUP_INDEX_FILE
+    if index_path.exists():
+        index_df = pl.read_ipc(index_path)
+        indexed = set(index_df.select("file", "size", "mtime_ns").unique().iter_rows())
+        if indexed == set(_file_states(sorted(directory.glob(pattern)))):
+            return index_df
+    return build_row_group_index(directory, pattern, id_col)
+
+
+def read_indexed_rows(directory, pattern: str, id_col: str, ids) -> pl.DataFrame:
+    """
+    Returns the rows of the Parquet files matching `pattern` whose `id_col` is
+    in `ids`, reading only the row groups whose min/max range can hold one of
+    them. Works best on files clustered or sorted by `id_col`.
+    """
+    directory = Path(directory)
+    index_df = load_row_group_index(directory, pattern, id_col)
+    ids = pl.Series(id_col, ids, dtype=pl.Int64).unique().sort()
+    id_values = ids.to_numpy()
+
+    lower = np.searchsorted(id_values, index_df["min_id"].fill_null(np.iinfo(np.int64).min).to_numpy(), side="left")
+    upper = np.searchsorted(id_values, index_df["max_id"].fill_null(np.iinfo(np.int64).max).to_numpy(), side="right")
+    wanted = index_df.filter(pl.Series(upper > lower))
+
+    parts = []
+    for (file_name,), row_groups in wanted.group_by("file", maintain_order=True):
+        table = pq.ParquetFile(directory / file_name).read_row_groups(row_groups["row_group"].to_list())
+        parts.append(pl.from_arrow(table).filter(pl.col(id_col).is_in(ids)))
+
+    if not parts:
+        files = sorted(directory.glob(pattern))
+        return pl.DataFrame(schema=pl.scan_parquet(files[0]).collect_schema()) if files else pl.DataFrame()
+    return pl.concat(parts, how="vertical")
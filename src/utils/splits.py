@@ -0,0 +1,30 @@
+# src/utils/splits.py
+
+import polars as pl
+
+from src.utils.hashing import stable_hash_expr
+
+
+def assign_splits(subjects_df: pl.DataFrame, seed: int = 42, val_fraction: float = 0.1,
+                  test_fraction: float = 0.1, stratify_col: str = 'is_case') -> pl.DataFrame:
+    """
+    Adds a 'split' column ('train', 'val' or 'test'), stratified by `stratify_col`.
+
+    Within each stratum, subjects are ordered by a seeded hash of subject_id and
+    the order is cut at the cumulative fractions, so every stratum gets the
+    target proportions up to rounding. The order of existing subjects does not
+    depend on the rest of the cohort, so when the cohort grows only subjects
+    near a cut point can change split. A null in `stratify_col` is an error.
+    """
+    n_missing = subjects_df.get_column(stratify_col).null_count()
+    if n_missing:
+        raise ValueError(f"Cannot stratify splits: {n_missing} subject(s) have no '{stratify_col}'")
+
+    rank = stable_hash_expr(pl.col('subject_id'), seed).rank('ordinal').over(stratify_col) - 1
+    stratum_size = pl.len().over(stratify_col)
+    train_fraction = 1.0 - val_fraction - test_fraction
+    return subjects_df.with_columns(
+        split=pl.when(rank < (stratum_size * train_fraction).round()).then(pl.lit('train'))
+                .when(rank < (stratum_size * (train_fraction + val_fraction)).round()).then(pl.lit('val'))
+                .otherwise(pl.lit('test'))
+    )
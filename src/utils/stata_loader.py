@@ -0,0 +1,72 @@
+# src/utils/stata_loader.py
+
+import polars as pl
+import pandas as pd
+import os
+from pathlib import Path
+
+from src.utils.ingest_cache import file_state_key, path_key, private_tmp_path
+
+# Frames already loaded by this process, keyed by (path, file state, columns)
+_LOADED = {}
+
+
+def _read_stata_as_polars(dta_path: str) -> pl.DataFrame:
+    """Decodes a .dta file, turning Stata value labels into plain strings."""
+    stata_pd = pd.read_stata(dta_path)
+    for col in stata_pd.select_dtypes(include='category').columns:
+        stata_pd[col] = stata_pd[col].astype(object).where(stata_pd[col].notna(), None)
+    return pl.from_pandas(stata_pd)
+
+
+def cached_stata_path(dta_path: str, cache_dir: str) -> Path:
+    """
+    Returns the Parquet copy of a .dta file, converting it first if the cache has
+    no copy for the file's current path, size and mtime.
+    """
+    cache_dir = Path(cache_dir) / 'stata'
+    cache_dir.mkdir(parents=True, exist_ok=True)
+
+    stem = Path(dta_path).stem
+    source_key = path_key(dta_path)
+    cached_path = cache_dir / f"{stem}.{source_key}.{file_state_key(dta_path)}.parquet"
+    if cached_path.exists():
+        return cached_path
+
+    print(f"  - Caching {dta_path} as Parquet...")
+    tmp_path = private_tmp_path(cached_path)
+    _read_stata_as_polars(dta_path).write_parquet(tmp_path, compression='zstd')
+    os.replace(tmp_path, cached_path)
+
+    # Drop copies made from older versions of the same file, but not those of
+    # another file with the same name in a different directory
+    for stale_path in cache_dir.glob(f"{stem}.{source_key}.*.parquet"):
+        if stale_path != cached_path:
+            stale_path.unlink(missing_ok=True)
+
+    return cached_path
+
+
+def load_stata(dta_path: str, columns: list = None, cache_dir: str = None) -> pl.DataFrame:
+    """
+    Loads a Stata file as a Polars DataFrame, reading only `columns` if given.
+
+    With a cache directory the file is decoded once into Parquet and later calls
+    read just the requested columns from that copy. Within a process, repeated
+    calls with the same columns return the already loaded frame.
+    """
+    load_key = (os.path.abspath(dta_path), file_state_key(dta_path), tuple(columns) if columns else None)
+    if load_key in _LOADED:
+        return _LOADED[load_key]
+
+    if cache_dir:
+        stata_lf = pl.scan_parquet(cached_stata_path(dta_path, cache_dir))
+    else:
+        full_key = load_key[:2] + (None,)
+        if full_key not in _LOADED:
+            _LOADED[full_key] = _read_stata_as_polars(dta_path)
+        stata_lf = _LOADED[full_key].lazy()
+
+    stata_df = stata_lf.select(columns).collect() if columns else stata_lf.collect()
+    _LOADED[load_key] = stata_df
+    return stata_df
@@ -0,0 +1,163 @@
+# src/utils/subject_log.py
+
+import numpy as np
+import pandas as pd
+import fcntl
+import json
+import os
+import threading
+from contextlib import contextmanager
+from pathlib import Path
+
+
+class SubjectLog:
+    """
+    Append-only log of every subject ID already used by a study.
+
+    The log is a directory of immutable, sorted int64 segments (.npy files) listed
+    in manifest.json. Writers hold an exclusive lock on the directory, so studies
+    launched at the same time cannot clobber each other; a study that holds
+    `reserve()` while it picks its subjects cannot pick any that another study is
+    picking. Readers take a shared lock just long enough to read the manifest and
+    map its segments, so compaction never deletes a segment a reader is opening.
+    Membership checks are binary searches over memory-mapped segments, so they
+    never load the whole log.
+    """
+    MANIFEST = 'manifest.json'
+    LOCK = '.lock'
+    # Merge segments in the background once there are more than this many
+    COMPACT_AFTER = 8
+
+    def __init__(self, root: str, legacy_csv: str = None):
+        self.root = Path(root)
+        self.root.mkdir(parents=True, exist_ok=True)
+        self._compaction = None
+        # Per-thread lock depth, so a thread holding the lock can keep using the log
+        self._held = threading.local()
+
+        if legacy_csv and Path(legacy_csv).exists() and not (self.root / self.MANIFEST).exists():
+            with self._locked():
+                if not (self.root / self.MANIFEST).exists():
+                    print(f"  - Importing legacy subject log from {legacy_csv}...")
+                    legacy_ids = pd.read_csv(legacy_csv)['subject_id'].dropna().astype('int64').to_numpy()
+                    self._write_manifest(self._add_segment(self._read_manifest(), legacy_ids))
+
+    @contextmanager
+    def _locked(self, operation: int = fcntl.LOCK_EX):
+        depth = getattr(self._held, 'depth', 0)
+        if depth > 0:
+            # This thread already holds the exclusive lock
+            self._held.depth = depth + 1
+            try:
+                yield
+            finally:
+                self._held.depth = depth
+            return
+
+        with open(self.root / self.LOCK, 'w') as lock_file:
+            fcntl.flock(lock_file, operation)
+            if operation == fcntl.LOCK_EX:
+                self._held.depth = 1
+            try:
+                yield
+            finally:
+                self._held.depth = 0
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def reserve(self):
+        """
+        Holds the log's exclusive lock. Reading the log, choosing subjects and
+        appending them inside one `with log.reserve():` block is atomic with
+        respect to every other study using the same log.
+        """
+        return self._locked()
+
+    def _read_manifest(self) -> dict:
+        try:
+            with open(self.root / self.MANIFEST) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {'segments': [], 'next_segment': 0, 'total': 0}
+
+    def _write_manifest(self, manifest: dict):
+        tmp_path = self.root / f"{self.MANIFEST}.tmp{os.getpid()}"
+        with open(tmp_path, 'w') as f:
+            json.dump(manifest, f)
+        os.replace(tmp_path, self.root / self.MANIFEST)
+
+    def _add_segment(self, manifest: dict, ids: np.ndarray) -> dict:
+        """Writes `ids` as a new sorted segment and returns the updated manifest."""
+        ids = np.unique(np.asarray(ids, dtype=np.int64))
+        name = f"segment_{manifest['next_segment']:06d}.npy"
+        np.save(self.root / name, ids)
+        return {
+            'segments': manifest['segments'] + [name],
+            'next_segment': manifest['next_segment'] + 1,
+            'total': manifest['total'] + len(ids),
+        }
+
+    def _load_segments(self) -> list:
+        # Compaction unlinks segments under the exclusive lock. Mapped segments stay
+        # readable after they are unlinked, so the shared lock is only needed until
+        # every segment in the manifest is open.
+        with self._locked(fcntl.LOCK_SH):
+            return [np.load(self.root / name, mmap_mode='r') for name in self._read_manifest()['segments']]
+
+    def __len__(self) -> int:
+        return self._read_manifest()['total']
+
+    def contains(self, subject_ids) -> np.ndarray:
+        """Returns a boolean array marking which of `subject_ids` are already logged."""
+        subject_ids = np.asarray(subject_ids, dtype=np.int64)
+        found = np.zeros(len(subject_ids), dtype=bool)
+        for segment in self._load_segments():
+            if len(segment) == 0:
+                continue
+            positions = np.minimum(np.searchsorted(segment, subject_ids), len(segment) - 1)
+            found |= segment[positions] == subject_ids
+        return found
+
+    def append(self, subject_ids) -> np.ndarray:
+        """
+        Adds `subject_ids` to the log and returns the ones that were already there
+        (for example, claimed by a study that finished while this one was running).
+        """
+        subject_ids = np.unique(np.asarray(subject_ids, dtype=np.int64))
+        with self._locked():
+            already_logged = self.contains(subject_ids)
+            manifest = self._read_manifest()
+            if not already_logged.all():
+                manifest = self._add_segment(manifest, subject_ids[~already_logged])
+                self._write_manifest(manifest)
+
+        if len(manifest['segments']) > self.COMPACT_AFTER:
+            self.compact_in_background()
+        return subject_ids[already_logged]
+
+    def compact(self):
+        """
+        Merges all segments into one. The new manifest replaces the old one
+        atomically, and the old segments are removed while the exclusive lock still
+        keeps readers out, so a reader sees either every old segment or the merged one.
+        """
+        with self._locked():
+            manifest = self._read_manifest()
+            if len(manifest['segments']) <= 1:
+                return
+            merged = np.unique(np.concatenate([np.asarray(s) for s in self._load_segments()]))
+            compacted = self._add_segment(
+                {'segments': [], 'next_segment': manifest['next_segment'], 'total': 0}, merged
+            )
+            self._write_manifest(compacted)
+            for name in manifest['segments']:
+                (self.root / name).unlink(missing_ok=True)
+
+    def compact_in_background(self) -> threading.Thread:
+        """
+        Starts compaction on a background thread. The thread is not a daemon, so
+        the process waits for it to finish before exiting.
+        """
+        if self._compaction is None or not self._compaction.is_alive():
+            self._compaction = threading.Thread(target=self.compact, name='subject-log-compaction')
+            self._compaction.start()
+        return self._compaction
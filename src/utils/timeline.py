@@ -0,0 +1,100 @@
+# src/utils/timeline.py
+
+import polars as pl
+import yaml
+
+from src.utils.ingest_cache import scan_raw_dir
+from src.utils.dates import decode_dates_expr
+from src.utils.medcode_index import build_medcode_index, read_patient_rows
+from src.utils.event_schema import (
+    SORTED_PARTS_GLOB, SUBJECT_INDEX_FILE, subject_index, decode_sorted_events,
+)
+from src.utils.event_shards import read_subject_events
+from src.utils.row_group_index import read_indexed_rows
+
+TIMELINE_STAGES = ("raw", "extracted", "sorted", "mapped", "cleaned")
+
+
+def _raw_timeline(PATHS: dict, subject_ids: pl.Series) -> pl.DataFrame:
+    """Raw observation rows, read through the medcode index's patient locations when one is configured."""
+    cache_dir = PATHS.get('ingest_cache_dir')
+    index_root = PATHS.get('medcode_index_dir')
+    if cache_dir and index_root:
+        index_dir = build_medcode_index(PATHS['observation_data_dir'], cache_dir, index_root)
+        rows_df = read_patient_rows(index_dir, subject_ids)
+    else:
+        print("Warning: No medcode index configured; scanning every raw observation file.")
+        rows_df = pl.concat(
+            [
+                lf.filter(pl.col("e_patid").is_in(subject_ids))
+                for lf in scan_raw_dir(PATHS['observation_data_dir'], cache_dir)
+                if "e_patid" in lf.collect_schema().names()
+            ],
+            how="diagonal_relaxed",
+        ).collect()
+    return rows_df.rename({"e_patid": "subject_id"}) \
+        .with_columns(time=decode_dates_expr("obsdate")) \
+        .sort("subject_id", "time", maintain_order=True)
+
+
+def _extracted_timeline(OUTPUTS: dict, subject_ids: pl.Series) -> pl.DataFrame:
+    """
+    Stage 3a events, decoded to subject_id and code strings. Stage 3a output is
+    not clustered by subject, so this scans every extracted file.
+    """
+    subject_index_df = subject_index(pl.read_csv(OUTPUTS['subject_information_file'])) \
+        .filter(pl.col("subject_id").is_in(subject_ids))
+    events_df = pl.scan_parquet(f"{OUTPUTS['intermediate_unsorted_dir']}/*.parquet") \
+        .filter(pl.col("subject_idx").is_in(subject_index_df["subject_idx"])) \
+        .collect()
+    return events_df.join(subject_index_df, on="subject_idx", how="inner").select(
+        "subject_id",
+        "time",
+        code=pl.lit("medcodeid//") + pl.col("medcodeid").cast(pl.String),
+        numeric_value=pl.col("numeric_value").cast(pl.Float64),
+        numunitid=pl.col("numunitid").cast(pl.Int64),
+    ).sort("subject_id", "time", maintain_order=True)
+
+
+def _sorted_timeline(OUTPUTS: dict, subject_ids: pl.Series) -> pl.DataFrame:
+    """Stage 3b events in their sorted order, decoded to subject_id and code strings."""
+    sorted_dir = OUTPUTS['intermediate_sorted_dir']
+    subject_idxs = pl.read_parquet(f"{sorted_dir}/{SUBJECT_INDEX_FILE}") \
+        .filter(pl.col("subject_id").is_in(subject_ids))["subject_idx"]
+    events_df = read_indexed_rows(sorted_dir, SORTED_PARTS_GLOB, "subject_idx", subject_idxs)
+    return decode_sorted_events(events_df.lazy(), sorted_dir).collect()
+
+
+def get_timeline(subject_ids, stage: str = "cleaned", config_path: str = "config.yaml") -> pl.DataFrame:
+    """
+    Returns the events of `subject_ids` as they stand after one pipeline stage:
+
+    - raw:       raw observation rows (stage 3a input)
+    - extracted: windowed events (stage 3a output)
+    - sorted:    sorted events with MEDS_BIRTH (stage 3b output)
+    - mapped:    the event stream shards (stage 3c output)
+    - cleaned:   the cleaned shards (stage 5 output)
+
+    The raw, sorted, mapped and cleaned stages are read through their own
+    subject index (medcode index patient locations, row group indexes or the
+    shard sidecar index), so only the row groups holding these subjects are
+    read. The extracted stage is a full scan of the stage 3a output.
+    """
+    with open(config_path, 'r') as f:
+        config = yaml.safe_load(f)
+    cancer_type = config['study_params']['cancer_type']
+    PATHS = {key: val.format(cancer_type=cancer_type) for key, val in config['paths'].items()}
+    OUTPUTS = {key: val.format(cancer_type=cancer_type) for key, val in config['outputs'].items()}
+    subject_ids = pl.Series("subject_id", list(subject_ids), dtype=pl.Int64)
+
+    if stage == "raw":
+        return _raw_timeline(PATHS, subject_ids)
+    if stage == "extracted":
+        return _extracted_timeline(OUTPUTS, subject_ids)
+    if stage == "sorted":
+        return _sorted_timeline(OUTPUTS, subject_ids)
+    if stage == "mapped":
+        return read_subject_events(OUTPUTS['event_stream_dir'], subject_ids)
+    if stage == "cleaned":
+        return read_subject_events(OUTPUTS['final_cleaned_dir'], subject_ids)
+    raise ValueError(f"Unknown timeline stage '{stage}'; expected one of {', '.join(TIMELINE_STAGES)}")
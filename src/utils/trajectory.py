@@ -0,0 +1,88 @@
+# src/utils/trajectory.py
+
+import polars as pl
+
+from src.utils.cohort_filter import cohort_filter_expr
+from src.utils.ingest_cache import scan_raw_dir
+from src.utils.medcode_index import build_medcode_index, scan_patient_dates
+from src.utils.dates import decode_dates_expr
+from src.utils.event_schema import subject_index
+
+
+def trajectory_window_exprs(last_event_date: pl.Expr) -> dict:
+    """
+    Returns the start_date/end_date expressions of the trajectory window.
+
+    Cases keep the 5 years up to their cancer date. Controls keep the 5 years
+    ending 1 year before their last event.
+    """
+    return {
+        'end_date': pl.when(pl.col("is_case") == 1)
+                      .then(pl.col("cancerdate"))
+                      .otherwise(last_event_date.dt.offset_by("-1y")),
+        'start_date': pl.when(pl.col("is_case") == 1)
+                        .then(pl.col("cancerdate").dt.offset_by("-5y"))
+                        .otherwise(last_event_date.dt.offset_by("-6y")),
+    }
+
+
+def add_trajectory_window(events_lf: pl.LazyFrame, id_col: str = "e_patid") -> pl.LazyFrame:
+    """
+    Adds last_event_date, start_date and end_date to events that already carry
+    each subject's is_case and cancerdate.
+    """
+    return events_lf.with_columns(
+        last_event_date=pl.max("time").over(id_col)
+    ).with_columns(
+        **trajectory_window_exprs(pl.col("last_event_date"))
+    )
+
+
+def in_trajectory_window() -> pl.Expr:
+    """True for events whose time falls inside their subject's trajectory window."""
+    return pl.col("time").is_between(pl.col("start_date"), pl.col("end_date"))
+
+
+def last_observation_dates(PATHS: dict, cohort_ids: pl.Series) -> pl.LazyFrame:
+    """
+    Each cohort subject's last observation date, which anchors the control
+    trajectory windows. Read from the medcode index when one is configured,
+    otherwise computed from the raw observation files.
+    """
+    cache_dir = PATHS.get('ingest_cache_dir')
+    index_root = PATHS.get('medcode_index_dir')
+    if cache_dir and index_root:
+        index_dir = build_medcode_index(PATHS['observation_data_dir'], cache_dir, index_root)
+        return scan_patient_dates(index_dir) \
+            .filter(cohort_filter_expr(cohort_ids)) \
+            .select("e_patid", last_event_date=pl.col("last_date"))
+
+    obs_lf = pl.concat(
+        [lf.select("e_patid", "obsdate") for lf in scan_raw_dir(PATHS['observation_data_dir'], cache_dir)],
+        how="vertical",
+    )
+    return obs_lf.filter(cohort_filter_expr(cohort_ids)) \
+        .group_by("e_patid") \
+        .agg(last_event_date=decode_dates_expr("obsdate").max())
+
+
+def load_subject_windows(subject_information_file: str, PATHS: dict) -> pl.DataFrame:
+    """
+    Returns every cohort subject's trajectory window (e_patid, subject_idx,
+    start_date, end_date), sorted by e_patid. Computing the windows up front
+    lets each raw file be filtered on its own, without seeing the subject's
+    other files.
+    """
+    subjects_df = pl.read_csv(subject_information_file)
+    subjects_df = subjects_df.join(subject_index(subjects_df), on="subject_id", how="left") \
+        .rename({"subject_id": "e_patid"}) \
+        .with_columns(
+            e_patid=pl.col("e_patid").cast(pl.Int64),
+            cancerdate=pl.col("cancerdate").str.to_datetime().cast(pl.Date),
+        )
+    cohort_ids = subjects_df["e_patid"].unique().sort()
+    return subjects_df.join(
+        last_observation_dates(PATHS, cohort_ids).collect(), on="e_patid", how="left"
+    ).with_columns(
+        **trajectory_window_exprs(pl.col("last_event_date"))
+    ).select("e_patid", "subject_idx", "start_date", "end_date").sort("e_patid")